@@ -1,6 +1,19 @@
 from PySide2 import QtCore, QtGui, QtWidgets
+from collections import OrderedDict
+import os
 import pydicom
 import sys
+import dicomtree
+
+DATASET_CACHE_SIZE = 64
+TREE_CACHE_SIZE = 16
+PREFETCH_COUNT = 4
+DIFF_COLORS = {
+	dicomtree.ADDED: QtGui.QColor(200, 255, 200),
+	dicomtree.REMOVED: QtGui.QColor(255, 200, 200),
+	dicomtree.CHANGED: QtGui.QColor(255, 240, 170),
+	dicomtree.UNCOMPARED: QtGui.QColor(220, 220, 220),
+}
 
 
 class DicomDumpApp(QtWidgets.QMainWindow):
@@ -9,11 +22,16 @@ class DicomDumpApp(QtWidgets.QMainWindow):
 		self.createInterface()
 		self.filename = dcmfile
 		self.dataset = None
-		self.ancestors = []
+		self.files = []
+		self.cache = dicomtree.DatasetCache(DATASET_CACHE_SIZE)
+		self.treecache = OrderedDict()
+		self.treekey = None
+		self.diffwindows = []
 		self.searchresults = []
 		self.currentsearchresult = None
 
 		if self.filename:
+			self.setFolder(os.path.dirname(os.path.abspath(self.filename)))
 			self.openFile()
 		
 	def createInterface(self):
@@ -29,6 +47,10 @@ class DicomDumpApp(QtWidgets.QMainWindow):
 		openbutton.clicked.connect(self.getFileName)
 		slayout.addWidget(openbutton)
 		
+		folderbutton = QtWidgets.QPushButton("Open folder...")
+		folderbutton.clicked.connect(self.getFolderName)
+		slayout.addWidget(folderbutton)
+		
 		slayout.addStretch(1)
 		
 		slayout.addWidget(QtWidgets.QLabel("Search:"))
@@ -57,7 +79,16 @@ class DicomDumpApp(QtWidgets.QMainWindow):
 		
 		slayout.addStretch(1)
 		
-		savebutton = QtWidgets.QPushButton("Save as txt...")
+		self.defervalues = QtWidgets.QCheckBox("defer large values")
+		self.defervalues.setChecked(True)
+		self.defervalues.stateChanged.connect(self.toggleDeferValues)
+		slayout.addWidget(self.defervalues)
+		
+		comparebutton = QtWidgets.QPushButton("Compare with...")
+		comparebutton.clicked.connect(self.compare)
+		slayout.addWidget(comparebutton)
+		
+		savebutton = QtWidgets.QPushButton("Save as...")
 		savebutton.clicked.connect(self.save)
 		slayout.addWidget(savebutton)
 		qbutton = QtWidgets.QPushButton("Quit")
@@ -71,8 +102,18 @@ class DicomDumpApp(QtWidgets.QMainWindow):
 		self.dicomtree.header().setSectionResizeMode(QtWidgets.QHeaderView.ResizeToContents)
 		self.dicomtree.setHeaderLabels(["Tree structure", "Tag", "Description", "VR", "VM", "Value"])
 		self.dicomtree.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+		self.dicomtree.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
+		self.dicomtree.customContextMenuRequested.connect(self.showContextMenu)
 		
-		mainlayout.addWidget(self.dicomtree)
+		self.filelist = QtWidgets.QListWidget()
+		self.filelist.currentRowChanged.connect(self.selectFile)
+		
+		splitter = QtWidgets.QSplitter()
+		splitter.addWidget(self.filelist)
+		splitter.addWidget(self.dicomtree)
+		splitter.setStretchFactor(1, 1)
+		splitter.setSizes([200, 1080])
+		mainlayout.addWidget(splitter)
 		
 		mainframe.setLayout(mainlayout)
 		self.setCentralWidget(mainframe)
@@ -90,81 +131,85 @@ class DicomDumpApp(QtWidgets.QMainWindow):
 	def getFileName(self):
 		self.filename = QtWidgets.QFileDialog.getOpenFileName(self, 'Open DICOM file', '.')[0]
 		if self.filename:
+			self.setFolder(os.path.dirname(os.path.abspath(self.filename)))
 			self.openFile()
+	
+	def getFolderName(self):
+		folder = QtWidgets.QFileDialog.getExistingDirectory(self, 'Open folder', '.')
+		if folder:
+			self.setFolder(folder)
+			if self.files:
+				self.filename = self.files[0]
+				self.openFile()
+	
+	def setFolder(self, folder):
+		self.files = sorted(os.path.join(folder, f) for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)))
+		self.filelist.blockSignals(True)
+		self.filelist.clear()
+		self.filelist.addItems([os.path.basename(f) for f in self.files])
+		self.filelist.blockSignals(False)
+	
+	def selectFile(self, row):
+		if row < 0:
+			return
+		self.filename = self.files[row]
+		self.openFile()
 		
 	def openFile(self):
-		self.dicomtree.clear()
+		self.storeTree()
 		self.dataset = None
+		defer = self.defervalues.isChecked()
+		filename = os.path.abspath(self.filename)
+		if filename in self.files:
+			row = self.files.index(filename)
+			self.filelist.blockSignals(True)
+			self.filelist.setCurrentRow(row)
+			self.filelist.blockSignals(False)
+			self.cache.prefetch(self.files[row+1:row+1+PREFETCH_COUNT] + self.files[max(row-1, 0):row], defer)
 		try:
-			self.dataset = pydicom.read_file(self.filename, force=True)
+			entry = self.cache.get(filename, defer)
 		except pydicom.filereader.InvalidDicomError:
 			self.messageBox('Error', 'Invalid DICOM file', self.filename + ' is not a valid DICOM file!')
 			self.filename = None
 			self.setWindowTitle('DicomDump')
 			return
 		
+		self.dataset = entry.dataset
 		self.setWindowTitle('DicomDump: '+self.filename)
-		self.loadTree()
-		
-	def loadTree(self):
-		self.dataset.decode()
-		
-		metainfoitem = QtWidgets.QTreeWidgetItem()
-		metainfoitem.setText(0, 'Metadata')
-		datasetitem = QtWidgets.QTreeWidgetItem()
-		datasetitem.setText(0, 'Dataset')
-		
-		self.ancestors = []
-		self.ancestors.append(metainfoitem)
-		self.handleDataset(self.dataset.file_meta)
-		self.dicomtree.addTopLevelItem(metainfoitem)
-		self.ancestors = []
-		
-		self.ancestors.append(datasetitem)
-		self.handleDataset(self.dataset)
-		self.dicomtree.addTopLevelItem(datasetitem)
-		
-		self.dicomtree.expandAll()
-		
-	def handleDataset(self, ds):
-		for de in ds:
-			tagitem = self.addTag(de)
-			
-			if de.VR == "SQ":
-				self.ancestors.append(tagitem)
-				self.handleSequence(de.value)
-				self.ancestors.pop()
-	
-	def handleSequence(self, sq):
-		for ds in sq:
-			self.ancestors.append(self.addTag())
-			self.handleDataset(ds)
-			self.ancestors.pop()
-		
-	def addTag(self, de=None):
-		tagitem = QtWidgets.QTreeWidgetItem()
-		
-		if not de:
-			tagitem.setText(0, 'item')
-			self.ancestors[-1].addChild(tagitem)
-			return tagitem
-
-		tagitem.setText(1, str(de.tag).replace(" ", ""))
-		tagitem.setText(2, str(de.description()))
-		tagitem.setText(3, str(de.VR))
-		tagitem.setText(4, str(de.VM))
-		if de.VR != "SQ":
-			tagitem.setText(5, str(de.value))
-			tagitem.setText(0, "element")
+		self.treekey = (filename, defer)
+		if self.treekey in self.treecache:
+			self.dicomtree.addTopLevelItems(self.treecache.pop(self.treekey))
+			self.dicomtree.expandAll()
 		else:
-			tagitem.setText(5, "Sequence of length "+str(len(de.value)))
-			tagitem.setText(0, "sequence")
-			
-		if len(self.ancestors) == 0:
-			self.dicomtree.addTopLevelItem(tagitem)
-		else:
-			self.ancestors[-1].addChild(tagitem)
-		return tagitem	
+			self.loadTree(entry.rows)
+		self.search(self.slineedit.text())
+	
+	def storeTree(self):
+		# Keep the items of the current file, so they can be shown again without rebuilding them
+		self.dicomtree.clearSelection()
+		items = self.dicomtree.invisibleRootItem().takeChildren()
+		if self.treekey is not None and items:
+			self.treecache[self.treekey] = items
+			while len(self.treecache) > TREE_CACHE_SIZE:
+				self.treecache.popitem(last=False)
+		self.treekey = None
+		
+	def loadTree(self, rows):
+		toplevelitems = []
+		ancestors = []
+		for row in rows:
+			item = QtWidgets.QTreeWidgetItem([row.kind] + row.columns)
+			if row.kind == "element":
+				item.setData(0, QtCore.Qt.UserRole, row.path)
+			del ancestors[row.depth:]
+			if row.depth == 0:
+				toplevelitems.append(item)
+			else:
+				ancestors[-1].addChild(item)
+			ancestors.append(item)
+		
+		self.dicomtree.addTopLevelItems(toplevelitems)
+		self.dicomtree.expandAll()
 	
 	def search(self, s):
 		self.dicomtree.clearSelection()
@@ -219,6 +264,49 @@ class DicomDumpApp(QtWidgets.QMainWindow):
 	def toggleIncludeValue(self, i):
 		self.search(self.slineedit.text())
 	
+	def toggleDeferValues(self, i):
+		if self.filename:
+			self.openFile()
+	
+	def showContextMenu(self, pos):
+		item = self.dicomtree.itemAt(pos)
+		if item is None or item.data(0, QtCore.Qt.UserRole) is None:
+			return
+		menu = QtWidgets.QMenu(self)
+		loadaction = menu.addAction("Load value")
+		hexaction = menu.addAction("Hex preview")
+		action = menu.exec_(self.dicomtree.viewport().mapToGlobal(pos))
+		if action == loadaction:
+			self.loadValue(item)
+		elif action == hexaction:
+			self.hexPreview(item)
+	
+	def loadValue(self, item):
+		de = dicomtree.element_at(self.dataset, item.data(0, QtCore.Qt.UserRole))
+		item.setText(4, str(de.VM))
+		item.setText(5, str(de.value))
+	
+	def hexPreview(self, item):
+		de = dicomtree.element_at(self.dataset, item.data(0, QtCore.Qt.UserRole))
+		if isinstance(de.value, bytes):
+			text = dicomtree.hex_dump(de.value)
+		else:
+			text = str(de.value)
+		self.textBox('Hex preview: ' + item.text(1), text)
+	
+	def textBox(self, title, text):
+		dialog = QtWidgets.QDialog(self)
+		dialog.setWindowTitle(title)
+		dialog.resize(800, 500)
+		layout = QtWidgets.QVBoxLayout()
+		textedit = QtWidgets.QPlainTextEdit()
+		textedit.setReadOnly(True)
+		textedit.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+		textedit.setPlainText(text)
+		layout.addWidget(textedit)
+		dialog.setLayout(layout)
+		dialog.exec_()
+	
 	def messageBox(self, type, title, text, inftext=None):
 		msgbox = QtWidgets.QMessageBox()
 		msgbox.setWindowTitle(title)
@@ -236,34 +324,98 @@ class DicomDumpApp(QtWidgets.QMainWindow):
 		msgbox.setIcon(icon)
 		msgbox.exec_()			
 	
-	def getDepth(self, item):
-		depth = 0
-		while item:
-			depth += 1
-			item = item.parent()
-		return depth
-
+	def compare(self):
+		if self.dataset is None:
+			return
+		fn = QtWidgets.QFileDialog.getOpenFileName(self, 'Compare with DICOM file', os.path.dirname(self.filename))[0]
+		if not fn:
+			return
+		defer = self.defervalues.isChecked()
+		try:
+			other = self.cache.get(fn, defer).dataset
+		except pydicom.filereader.InvalidDicomError:
+			self.messageBox('Error', 'Invalid DICOM file', fn + ' is not a valid DICOM file!')
+			return
+		rows = dicomtree.diff(self.dataset, other, defer)
+		diffwindow = DicomDiffWindow(self.filename, fn, rows)
+		diffwindow.finished.connect(lambda result: self.diffwindows.remove(diffwindow))
+		self.diffwindows.append(diffwindow)
+		diffwindow.show()
+	
 	def save(self):
-		fn = QtWidgets.QFileDialog.getSaveFileName(self, 'Save file as...', '.')[0]
+		if self.dataset is None:
+			return
+		fn = QtWidgets.QFileDialog.getSaveFileName(self, 'Save file as...', '.', 'Text (*.txt);;JSON (*.json);;CSV (*.csv)')[0]
 		if not fn:
 			return
-		fp = open(fn, 'w')
-		twis = QtWidgets.QTreeWidgetItemIterator(self.dicomtree)
-		while twis.value():
-			twi = twis.value()
-			tabstring = "\t"*(self.getDepth(twi)-1)
-			fp.write(tabstring)
-			for i in range(twi.columnCount()):
-				fp.write(twi.text(i))
-				if i != twi.columnCount()-1:
-					fp.write("\t")
-				else:
-					fp.write("\n")
-			twis += 1
-		fp.close()
+		fmt = 'text'
+		for f, ext in dicomtree.FORMATS.items():
+			if fn.lower().endswith(ext):
+				fmt = f
+		with dicomtree.open_output(fn) as fp:
+			dicomtree.dump(self.dataset, fp, fmt, self.defervalues.isChecked())
 		self.messageBox('information', 'Save successful', 'Data written to '+fn)
 		
 
+class DicomDiffWindow(QtWidgets.QDialog):
+	def __init__(self, filename_a, filename_b, rows):
+		super(DicomDiffWindow, self).__init__()
+		self.items = []
+		self.createInterface(filename_a, filename_b)
+		self.loadTree(rows)
+	
+	def createInterface(self, filename_a, filename_b):
+		self.resize(1280, 800)
+		self.setWindowTitle('DicomDump: ' + filename_a + ' vs ' + filename_b)
+		
+		mainlayout = QtWidgets.QVBoxLayout()
+		
+		slayout = QtWidgets.QHBoxLayout()
+		self.onlydifferences = QtWidgets.QCheckBox("show differences only")
+		self.onlydifferences.stateChanged.connect(self.toggleOnlyDifferences)
+		slayout.addWidget(self.onlydifferences)
+		slayout.addStretch(1)
+		for status in [dicomtree.ADDED, dicomtree.REMOVED, dicomtree.CHANGED, dicomtree.UNCOMPARED]:
+			label = QtWidgets.QLabel(status)
+			label.setStyleSheet("background-color: " + DIFF_COLORS[status].name() + "; padding: 2px 8px")
+			slayout.addWidget(label)
+		mainlayout.addLayout(slayout)
+		
+		self.dicomtree = QtWidgets.QTreeWidget()
+		self.dicomtree.setColumnCount(7)
+		self.dicomtree.header().setSectionResizeMode(QtWidgets.QHeaderView.ResizeToContents)
+		self.dicomtree.setHeaderLabels(["Tree structure", "Tag", "Description", "VR", "VM",
+			"Value: " + os.path.basename(filename_a), "Value: " + os.path.basename(filename_b)])
+		self.dicomtree.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+		mainlayout.addWidget(self.dicomtree)
+		
+		self.setLayout(mainlayout)
+	
+	def loadTree(self, rows):
+		toplevelitems = []
+		ancestors = []
+		for row in rows:
+			item = QtWidgets.QTreeWidgetItem([row.kind] + row.columns + list(row.values))
+			if row.status in DIFF_COLORS:
+				for i in range(item.columnCount()):
+					item.setBackground(i, DIFF_COLORS[row.status])
+			self.items.append((item, row.status))
+			del ancestors[row.depth:]
+			if row.depth == 0:
+				toplevelitems.append(item)
+			else:
+				ancestors[-1].addChild(item)
+			ancestors.append(item)
+		
+		self.dicomtree.addTopLevelItems(toplevelitems)
+		self.dicomtree.expandAll()
+	
+	def toggleOnlyDifferences(self, i):
+		hide = self.onlydifferences.isChecked()
+		for item, status in self.items:
+			item.setHidden(hide and status == dicomtree.SAME)
+		
+
 if __name__ == "__main__":
 	if len(sys.argv) == 2:
 		dcmfile = sys.argv[1]
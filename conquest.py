@@ -6,11 +6,101 @@ All item classes come in two variants:
 - the ConquestSimpleItem, which lacks the database reference and the connection
   to parent and child items, but which can be serialized.
 """
+import math
 import os
 from datetime import datetime
 
+import pydicom
+
 #from rtlibs.dicomrtz import dicom_open
 
+# Modalities for which slice orientation is checked
+OBLIQUE_MODALITIES = ['MR', 'CT', 'SC']
+# Slices whose normal deviates less than this from a coordinate axis (as cosine)
+# are not oblique
+OBLIQUE_TOLERANCE = 1e-3
+
+
+def read_image_orientation(filepath):
+    """Reads the ImageOrientationPatient of a DICOM file. Only the header is
+    parsed, up to the pixel data, and only this element is kept.
+    Args:
+        filepath (str): the path of the DICOM file
+    Returns:
+        tuple: the six direction cosines, or None if the file has no (valid)
+        ImageOrientationPatient
+    """
+    ds = pydicom.dcmread(filepath, force=True, stop_before_pixels=True,
+                         specific_tags=['ImageOrientationPatient'])
+    orientation = ds.get('ImageOrientationPatient')
+    if orientation is None or len(orientation) != 6:
+        return None
+    return tuple(float(v) for v in orientation)
+
+
+def slice_normal(orientation):
+    """Calculates the unit normal of slices with the given orientation.
+    Args:
+        orientation (tuple): the six direction cosines of ImageOrientationPatient
+    Returns:
+        tuple: the normal vector, or None if the direction cosines are zero or
+        parallel
+    """
+    r = orientation[:3]
+    c = orientation[3:]
+    n = (r[1] * c[2] - r[2] * c[1],
+         r[2] * c[0] - r[0] * c[2],
+         r[0] * c[1] - r[1] * c[0])
+    length = math.sqrt(n[0] ** 2 + n[1] ** 2 + n[2] ** 2)
+    if length == 0:
+        return None
+    return tuple(v / length for v in n)
+
+
+def orientation_angle(orientation):
+    """Calculates the angle between the slice normal and the positive Z-axis.
+    Args:
+        orientation (tuple): the six direction cosines of ImageOrientationPatient
+    Returns:
+        float: the angle in degrees, or None if the orientation has no normal
+    """
+    normal = slice_normal(orientation)
+    if normal is None:
+        return None
+    nz = max(-1.0, min(1.0, normal[2]))
+    return math.degrees(math.acos(nz))
+
+
+def orientation_is_oblique(orientation):
+    """Checks whether slices with the given orientation are oblique, that is,
+    not perpendicular to one of the coordinate axes.
+    Args:
+        orientation (tuple): the six direction cosines of ImageOrientationPatient
+    Returns:
+        bool: whether the slices are oblique, or None if the orientation has no
+        normal
+    """
+    normal = slice_normal(orientation)
+    if normal is None:
+        return None
+    return max(abs(v) for v in normal) < 1 - OBLIQUE_TOLERANCE
+
+
+def summary_details(item):
+    """Creates the GUI details for the summary values of a patient or study
+    (modalities and total file size), for those the connection provides.
+    Args:
+        item (rtlibs.conquest.items.ConquestSimpleItem): the patient or study
+    Returns:
+        list: the detail lines
+    """
+    details = []
+    if item.modalities:
+        details.append("Modalities: {0}".format(", ".join(item.modalities)))
+    if item.total_bytes:
+        details.append("Size: {0:.1f} MB".format(item.total_bytes / 1e6))
+    return details
+
 
 class ConquestSimpleItem(object):
     """General, serializable Conquest database record.
@@ -51,6 +141,7 @@ class ConquestItem(object):
     def __init__(self, conn, parent=None):
         self.conn = conn
         self._parent = parent
+        self._children = None
 
     @property
     def parent(self):
@@ -101,6 +192,18 @@ class ConquestItem(object):
             return ConquestSimpleStudy(self.data)
         return ConquestSimplePatient(self.data)
 
+    def simplify_tree(self):
+        """Creates serializable ConquestSimpleItem objects for the current item
+        and all its descendants.
+        Returns:
+            list: the simplified items, each item followed by its descendants
+        """
+        items = [self.simplify()]
+        if self.subitem_type_plural is not None:
+            for child in getattr(self, self.subitem_type_plural):
+                items.extend(child.simplify_tree())
+        return items
+
 
 class ConquestSimplePatient(ConquestSimpleItem):
     """A serializable Conquest patient object.
@@ -220,6 +323,27 @@ class ConquestSimplePatient(ConquestSimpleItem):
         """
         return self.data['ninstances']
 
+    @property
+    def modalities(self):
+        """Getter for the modalities of the series belonging to the patient, if
+        the connection provides them.
+        Returns:
+            list: the sorted modalities, or None if unknown
+        """
+        modalities = self.data.get('modalities')
+        if modalities is None:
+            return None
+        return modalities.split("\\") if modalities else []
+
+    @property
+    def total_bytes(self):
+        """Getter for the total size of the DICOM files of the patient, if the
+        connection provides it.
+        Returns:
+            int: the size in bytes, or None if unknown
+        """
+        return self.data.get('bytes')
+
     @property
     def number_of_subitems(self):
         """Getter for the number of subitems belonging to the patient
@@ -246,7 +370,7 @@ class ConquestSimplePatient(ConquestSimpleItem):
             "Patient ID: {0}".format(self.patient_id),
             "Date of birth: {0}".format(self.date_of_birth),
             "Sex: {0}".format(self.sex),
-        ]
+        ] + summary_details(self)
 
     def __repr__(self):
         return "{0} ({1})".format(self.name, self.patient_id)
@@ -267,13 +391,54 @@ class ConquestPatient(ConquestItem, ConquestSimplePatient):
 
     @property
     def studies(self):
-        """Getter for the studies belonging to the patient.
+        """Getter for the studies belonging to the patient. If the patient's
+        tree was loaded with load_tree, the loaded studies are returned.
         Returns:
             list: all rtlibs.conquest.items.ConquestStudy objects belonging to
             the patient
         """
+        children = self._children
+        if children is not None:
+            return children
         return self.conn.get_studies_for_patient(self)
 
+    def simplify_tree(self):
+        """Creates serializable ConquestSimpleItem objects for the patient and
+        all its descendants, loading the patient's tree in bulk.
+        Returns:
+            list: the simplified items, each item followed by its descendants
+        """
+        studies = self._tree(instances=True)
+        items = [self.simplify()]
+        for study in studies:
+            items.extend(study.simplify_tree())
+        return items
+
+    def _tree(self, instances=False):
+        # The studies of the patient with their series and, if instances is
+        # True, the instances of the series; the levels that are not loaded
+        # yet are loaded in bulk
+        studies = self._children
+        if studies is not None and instances:
+            for study in studies:
+                series_list = study._children
+                if series_list is None or any(
+                        series._children is None for series in series_list):
+                    studies = None
+                    break
+        if studies is None:
+            studies = load_patient_tree(self.conn, self, instances)
+        return studies
+
+    def load_tree(self):
+        """Loads all studies, series and instances of the patient with one
+        query per level, and links them to their parents and children.
+        Returns:
+            list: all rtlibs.conquest.items.ConquestStudy objects belonging to
+            the patient
+        """
+        return load_patient_tree(self.conn, self)
+
     def get_study(self, study_uid):
         """Returns the study with the given study UID, provided it belongs to the
         patient.
@@ -296,7 +461,7 @@ class ConquestPatient(ConquestItem, ConquestSimplePatient):
             the patient
         """
         series = []
-        for study in self.studies:
+        for study in self._tree():
             series.extend(study.series)
         return series
 
@@ -308,7 +473,7 @@ class ConquestPatient(ConquestItem, ConquestSimplePatient):
             to the patient
         """
         instances = []
-        for study in self.studies:
+        for study in self._tree(instances=True):
             instances.extend(study.instances)
         return instances
 
@@ -317,6 +482,20 @@ class ConquestPatient(ConquestItem, ConquestSimplePatient):
         """
         self.conn.delete_patient(self.patient_id)
 
+    def export(self, destination, link=False, workers=8):
+        """Copies all DICOM files of the patient to a folder, in subfolders per
+        study and series; see conquestexport.export_item.
+        Args:
+            destination (str): the destination folder
+            link (bool): whether to hard link the files instead of copying them
+            workers (int): the number of copy threads
+        Returns:
+            conquestexport.ExportReport: the numbers of files and bytes, the
+            time taken, and the skipped and failed files
+        """
+        from conquestexport import export_item
+        return export_item(self, destination, link, workers)
+
     @property
     def has_oblique_series(self):
         """Checks whether the patient has any series with oblique slices.
@@ -336,14 +515,20 @@ class ConquestPatient(ConquestItem, ConquestSimplePatient):
             dict: a nested dict with the UIDs of all all descendent items
         """
         study_dict = {}
-        for study in self.studies:
-            series_dict = {}
-            for series in study.series:
-                instance_list = []
-                for instance in series.instances:
-                    instance_list.append(instance.instance_uid)
-                series_dict[series.series_uid] = instance_list
-            study_dict[study.study_uid] = series_dict
+        for row in self.conn.get_study_rows_for_patient(self.patient_id):
+            study_dict[row['StudyInsta']] = {}
+        instance_lists = {}
+        for row in self.conn.get_series_rows_for_patient(self.patient_id):
+            if row['StudyInsta'] not in study_dict:
+                continue
+            instance_list = []
+            study_dict[row['StudyInsta']][row['SeriesInst']] = instance_list
+            instance_lists[row['SeriesInst']] = instance_list
+        rows = self.conn.get_instance_rows_for_patient(
+            self.patient_id, columns=['SeriesInst', 'SOPInstanc'])
+        for row in rows:
+            if row['SeriesInst'] in instance_lists:
+                instance_lists[row['SeriesInst']].append(row['SOPInstanc'])
         return study_dict
 
 
@@ -451,6 +636,27 @@ class ConquestSimpleStudy(ConquestSimpleItem):
         """
         return int(self.data['ninstances'])
 
+    @property
+    def modalities(self):
+        """Getter for the modalities of the series belonging to the study, if
+        the connection provides them.
+        Returns:
+            list: the sorted modalities, or None if unknown
+        """
+        modalities = self.data.get('modalities')
+        if modalities is None:
+            return None
+        return modalities.split("\\") if modalities else []
+
+    @property
+    def total_bytes(self):
+        """Getter for the total size of the DICOM files of the study, if the
+        connection provides it.
+        Returns:
+            int: the size in bytes, or None if unknown
+        """
+        return self.data.get('bytes')
+
     @property
     def number_of_subitems(self):
         """Getter for the number of subitems in the study.
@@ -477,7 +683,7 @@ class ConquestSimpleStudy(ConquestSimpleItem):
             "Date/time: {0}".format(self.study_datetime),
             "Study ID: {0}".format(self.study_id),
             "Study&nbsp;UID:&nbsp;{0}".format(self.study_uid)
-        ]
+        ] + summary_details(self)
 
     def __repr__(self):
         return "{0} ({1})".format(self.study_description, self.study_datetime)
@@ -504,11 +710,15 @@ class ConquestStudy(ConquestItem, ConquestSimpleStudy):
 
     @property
     def series(self):
-        """Getter for the series belonging to the study.
+        """Getter for the series belonging to the study. If the series were
+        loaded in bulk with the patient's tree, the loaded series are returned.
         Returns:
             list: all rtlibs.conquest.items.ConquestSeries objects belonging to
             the study
         """
+        children = self._children
+        if children is not None:
+            return children
         return self.conn.get_series_for_study(self)
 
     def get_series(self, series_uid):
@@ -551,6 +761,20 @@ class ConquestStudy(ConquestItem, ConquestSimpleStudy):
         """
         self.conn.delete_study(self.study_uid)
 
+    def export(self, destination, link=False, workers=8):
+        """Copies all DICOM files of the study to a folder, in subfolders per
+        series; see conquestexport.export_item.
+        Args:
+            destination (str): the destination folder
+            link (bool): whether to hard link the files instead of copying them
+            workers (int): the number of copy threads
+        Returns:
+            conquestexport.ExportReport: the numbers of files and bytes, the
+            time taken, and the skipped and failed files
+        """
+        from conquestexport import export_item
+        return export_item(self, destination, link, workers)
+
     @property
     def has_oblique_series(self):
         """Checks whether the study has any series with oblique slices.
@@ -714,6 +938,15 @@ class ConquestSimpleSeries(ConquestSimpleItem):
         """
         return int(self.data['ninstances'])
 
+    @property
+    def total_bytes(self):
+        """Getter for the total size of the DICOM files of the series, if the
+        connection provides it.
+        Returns:
+            int: the size in bytes, or None if unknown
+        """
+        return self.data.get('bytes')
+
     @property
     def number_of_subitems(self):
         """Getter for the number of subitems (instances) in the series
@@ -768,28 +1001,44 @@ class ConquestSeries(ConquestItem, ConquestSimpleSeries):
         self.parent = self.conn.get_study(self.study_uid)
 
     def __len__(self):
-        """Returns the number of instances in the series.
+        """Returns the number of instances in the series, without creating the
+        instance objects: it is taken from the loaded instances, the count in
+        the database row or a count query, in that order.
         Returns:
             int: the number of instances in the series
         """
-        return len(self.instances)
+        children = self._children
+        if children is not None:
+            return len(children)
+        if self.data.get('ninstances') is not None:
+            return self.number_of_instances
+        return self.conn.count_instances_for_series(self)
 
     @property
     def instances(self):
-        """Getter for all instances belonging to the series.
+        """Getter for all instances belonging to the series. If the instances
+        were loaded in bulk with the patient's tree, the loaded instances are
+        returned.
         Returns:
             list: all rtlibs.conquest.items.ConquestInstance objects belonging
             to the series
         """
+        children = self._children
+        if children is not None:
+            return children
         return self.conn.get_instances_for_series(self)
 
     @property
     def instance_uids(self):
-        """Getter for the UIDs of all instances belonging to the series
+        """Getter for the UIDs of all instances belonging to the series. Unless
+        the instances were loaded already, only the UIDs are queried.
         Returns:
             list: the UIDs of all instances belonging to the series
         """
-        return [i.instance_uid for i in self.instances]
+        children = self._children
+        if children is not None:
+            return [i.instance_uid for i in children]
+        return self.conn.get_instance_uids_for_series(self)
 
     @property
     def ordered_instance_uids(self):
@@ -833,6 +1082,29 @@ class ConquestSeries(ConquestItem, ConquestSimpleSeries):
         """
         return self.study.patient
 
+    @property
+    def image_orientation(self):
+        """Getter for the image orientation of the series, taken from the first
+        slice. The orientation is cached by the connection, so the file header
+        is read only the first time.
+        Returns:
+            tuple: the six direction cosines, or None if the series has no
+            orientation
+        """
+        if self.modality not in OBLIQUE_MODALITIES:
+            return None
+        orientation = self.conn.get_series_orientation(self.series_uid)
+        if orientation is None:
+            children = self._children
+            if children is not None:
+                instance = children[0] if children else None
+            else:
+                instance = self.conn.get_first_instance_for_series(self)
+            if instance is not None:
+                orientation = instance.image_orientation
+            self.conn.set_series_orientation(self.series_uid, orientation)
+        return orientation or None
+
     @property
     def oblique(self):
         """Checks whether the series contains oblique slices. This is checked only
@@ -840,7 +1112,10 @@ class ConquestSeries(ConquestItem, ConquestSimpleSeries):
         Returns:
             bool: whether the series contains oblique slices
         """
-        return self.instances[0].oblique
+        orientation = self.image_orientation
+        if orientation is None:
+            return False
+        return bool(orientation_is_oblique(orientation))
 
     @property
     def oblique_angle(self):
@@ -848,7 +1123,10 @@ class ConquestSeries(ConquestItem, ConquestSimpleSeries):
         Returns:
             float: the angle between the slice normal and the positive Z-axis
         """
-        return self.instances[0].oblique_angle
+        orientation = self.image_orientation
+        if orientation is None:
+            return None
+        return orientation_angle(orientation)
 
     def delete(self):
         """Deletes all DICOM files and database records related to this series.
@@ -974,18 +1252,28 @@ class ConquestSimpleInstance(ConquestSimpleItem):
         except KeyError:
             return None
 
+    @property
+    def image_orientation(self):
+        """Getter for the image orientation of the instance. Only the header of
+        the DICOM file is read.
+        Returns:
+            tuple: the six direction cosines, or None if the instance has no
+            orientation
+        """
+        if self.modality not in OBLIQUE_MODALITIES:
+            return None
+        return read_image_orientation(self.filepath)
+
     @property
     def oblique_angle(self):
         """Returns the angle between the slice normal and the positive Z-axis.
         Returns:
             float: the angle between the slice normal and the positive Z-axis
         """
-        if self.modality not in ['MR', 'CT', 'SC']:
-            return None
-        try:
-            return self.file.oblique_angle
-        except AttributeError:
+        orientation = self.image_orientation
+        if orientation is None:
             return None
+        return orientation_angle(orientation)
 
     @property
     def oblique(self):
@@ -993,12 +1281,10 @@ class ConquestSimpleInstance(ConquestSimpleItem):
         Returns:
             bool: whether the instance is oblique
         """
-        if self.modality not in ['MR', 'CT', 'SC']:
-            return False
-        try:
-            return self.file.oblique
-        except AttributeError:
+        orientation = self.image_orientation
+        if orientation is None:
             return False
+        return bool(orientation_is_oblique(orientation))
 
     @property
     def filename(self):
@@ -1024,7 +1310,9 @@ class ConquestSimpleInstance(ConquestSimpleItem):
         Returns:
             str: the full path to the DICOM file
         """
-        return os.path.join(self.data_path, self.filename)
+        # ObjectFile is a Windows path relative to the data path
+        return os.path.join(self.data_path,
+                            self.filename.replace("\\", os.sep))
 
     @property
     def file(self):
@@ -1122,4 +1410,74 @@ class ConquestInstance(ConquestItem, ConquestSimpleInstance):
     def delete(self):
         """Deletes the DICOM file and database record related to this instance.
         """
-        self.conn.delete_instance(self.instance_uid)
\ No newline at end of file
+        self.conn.delete_instance(self.instance_uid)
+
+
+def item_class(item):
+    """Determines which Conquest item class an item is, so subclasses of the
+    item classes are treated like their base class.
+    Args:
+        item (rtlibs.conquest.items.ConquestItem): the item
+    Returns:
+        type: ConquestPatient, ConquestStudy, ConquestSeries or
+        ConquestInstance
+    """
+    for cls in (ConquestPatient, ConquestStudy, ConquestSeries,
+                ConquestInstance):
+        if isinstance(item, cls):
+            return cls
+    raise TypeError("Not a Conquest item: {0!r}".format(item))
+
+
+def load_patient_tree(conn, patient, instances=True):
+    """Loads all studies, series and, optionally, instances of a patient with
+    one query per level, instead of one query per study and per series. The
+    items are linked to their parents, and each study and series keeps its
+    loaded children. The items are created with the connection's create_item,
+    so items it already holds are reused. The patient only keeps the loaded
+    studies if the connection caches child lists (in a session), so that the
+    patient otherwise sees studies that are added later.
+    Args:
+        conn (rtlibs.conquest.database.ConquestDatabaseConnection): the
+            connection to the Conquest database
+        patient (rtlibs.conquest.items.ConquestPatient): the patient
+        instances (bool): whether to load the instances as well; otherwise the
+            instances of each series are loaded when they are first used
+    Returns:
+        list: all rtlibs.conquest.items.ConquestStudy objects belonging to the
+        patient
+    """
+    # The child lists are completed before they are set on the items, so other
+    # threads using the same items never see a partly loaded list
+    studies = []
+    series_lists = {}
+    for row in conn.get_study_rows_for_patient(patient.patient_id):
+        study = conn.create_item(ConquestStudy, row, patient)
+        studies.append(study)
+        series_lists[study.study_uid] = (study, [])
+
+    instance_lists = {}
+    for row in conn.get_series_rows_for_patient(patient.patient_id):
+        study, series_list = series_lists.get(row['StudyInsta'], (None, None))
+        if study is None:
+            continue
+        series = conn.create_item(ConquestSeries, row, study)
+        series_list.append(series)
+        instance_lists[series.series_uid] = (series, [])
+
+    if instances:
+        for row in conn.get_instance_rows_for_patient(patient.patient_id):
+            series, instance_list = instance_lists.get(row['SeriesInst'],
+                                                       (None, None))
+            if series is None:
+                continue
+            instance_list.append(
+                conn.create_item(ConquestInstance, row, series))
+        for series, instance_list in instance_lists.values():
+            series._children = instance_list
+    for study, series_list in series_lists.values():
+        study._children = series_list
+
+    if getattr(conn, 'cache_children', True):
+        patient._children = studies
+    return studies
@@ -0,0 +1,433 @@
+"""asyncio variant of the Conquest item navigation.
+The item classes in conquest.py query the database when a property such as
+studies, series, instances or parent is read, which blocks the event loop of an
+asyncio application. The classes below wrap those items: fields of the database
+row are available as attributes, as on the simple items, and everything that
+may query the database is a coroutine that runs the query in a worker thread.
+
+The queries of an AsyncConquestConnection run on a pool of worker threads, one
+per pooled SQLite connection, so several queries run at the same time while
+the event loop keeps serving other requests. Properties that read DICOM files,
+such as the orientation of an instance, are coroutines as well; they read the
+file on a thread of the default executor. Inside a session,
+children(prefetch=True) also starts loading the children of every returned
+item in the background, so that browsing into any of the siblings finds them
+cached.
+
+    conn = AsyncConquestConnection("conquest.sqlite", "data")
+    async with conn.session():
+        for patient in await conn.get_patients():
+            studies = await patient.children(prefetch=True)
+"""
+import asyncio
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from conquest import ConquestSimplePatient, ConquestSimpleStudy, \
+    ConquestSimpleSeries, ConquestSimpleInstance, ConquestPatient, \
+    ConquestStudy, ConquestSeries, ConquestInstance, OBLIQUE_MODALITIES, \
+    orientation_angle, orientation_is_oblique, item_class
+from conquestdb import ConquestDatabaseConnection
+
+
+class AsyncConquestConnection(object):
+    """Connection to a Conquest database for asyncio applications. The
+    underlying conquestdb.ConquestDatabaseConnection is used by a pool of
+    worker threads, as many as it has pooled SQLite connections.
+    Args:
+        database (str): the path of the SQLite database file, or ":memory:"
+        data_path (str): the folder where the DICOM files are stored
+        cache (bool): whether to keep an identity map of the loaded items;
+            child lists are cached, and prefetched, only inside a session
+        pool_size (int): the number of queries that can run at the same time
+    """
+    def __init__(self, database=":memory:", data_path="", cache=True,
+                 pool_size=4):
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.conn = self._executor.submit(
+            ConquestDatabaseConnection, database, data_path, cache,
+            pool_size).result()
+        self._tasks = set()
+
+    async def run(self, function, *args, **kwargs):
+        """Runs a function on a database thread.
+        Args:
+            function (callable): the function, which may use self.conn
+            args: the positional arguments of the function
+            kwargs: the keyword arguments of the function
+        Returns:
+            object: the result of the function
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(function, *args, **kwargs))
+
+    async def read(self, function, *args):
+        """Runs a function that reads files on a thread of the default
+        executor, so the database threads are not blocked.
+        Args:
+            function (callable): the function
+            args: the positional arguments of the function
+        Returns:
+            object: the result of the function
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, function, *args)
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        """Asynchronous context manager that serves loaded items and child
+        lists from memory while it is active; see
+        conquestdb.ConquestDatabaseConnection.session.
+        """
+        session = self.conn.session()
+        await self.run(session.__enter__)
+        try:
+            yield self
+        finally:
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self.run(session.__exit__, None, None, None)
+
+    def wrap(self, item):
+        """Wraps an item of the synchronous connection.
+        Args:
+            item (rtlibs.conquest.items.ConquestItem): the item, or None
+        Returns:
+            conquestasync.AsyncConquestItem: the wrapped item, or None
+        """
+        if item is None:
+            return None
+        return ASYNC_CLASSES[item_class(item)](self, item)
+
+    def prefetch(self, items):
+        """Starts loading the children of items in the background. The loaded
+        children are only kept inside a session.
+        Args:
+            items (list): conquestasync.AsyncConquestItem objects
+        Returns:
+            asyncio.Future: a future that is done when all children are loaded
+        """
+        tasks = [asyncio.ensure_future(item.children()) for item in items
+                 if item.subitem_type is not None]
+        for task in tasks:
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return asyncio.gather(*tasks)
+
+    async def get_patients(self):
+        """Retrieves all patients.
+        Returns:
+            list: conquestasync.AsyncConquestPatient objects
+        """
+        patients = await self.run(self.conn.get_patients)
+        return [self.wrap(p) for p in patients]
+
+    async def get_patient(self, patient_id):
+        """Retrieves a patient.
+        Args:
+            patient_id (str): the patient ID
+        Returns:
+            conquestasync.AsyncConquestPatient: the patient, or None if it does
+            not exist
+        """
+        return self.wrap(await self.run(self.conn.get_patient, patient_id))
+
+    async def get_study(self, study_uid):
+        """Retrieves a study.
+        Args:
+            study_uid (str): the study UID
+        Returns:
+            conquestasync.AsyncConquestStudy: the study, or None if it does not
+            exist
+        """
+        return self.wrap(await self.run(self.conn.get_study, study_uid))
+
+    async def get_series(self, series_uid):
+        """Retrieves a series.
+        Args:
+            series_uid (str): the series UID
+        Returns:
+            conquestasync.AsyncConquestSeries: the series, or None if it does
+            not exist
+        """
+        return self.wrap(await self.run(self.conn.get_series, series_uid))
+
+    async def get_instance(self, instance_uid):
+        """Retrieves an instance.
+        Args:
+            instance_uid (str): the instance UID
+        Returns:
+            conquestasync.AsyncConquestInstance: the instance, or None if it
+            does not exist
+        """
+        return self.wrap(await self.run(self.conn.get_instance, instance_uid))
+
+    async def close(self):
+        """Waits for running prefetches and closes the database connection."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.run(self.conn.close)
+        self._executor.shutdown()
+
+
+class AsyncConquestItem(object):
+    """Asynchronous wrapper of a Conquest item. The row data and the
+    properties of the simple item class, which only read the database row, are
+    available as attributes; the properties that read files are coroutines.
+    Args:
+        conn (conquestasync.AsyncConquestConnection): the connection
+        item (rtlibs.conquest.items.ConquestItem): the wrapped item
+    """
+    simple_class = None
+    # Properties of the simple item class that read files, which are only
+    # available as coroutines
+    file_properties = ()
+
+    def __init__(self, conn, item):
+        self.conn = conn
+        self.item = item
+
+    def __getattr__(self, name):
+        if name == "item" or name.startswith("_"):
+            raise AttributeError(name)
+        if name in self.file_properties:
+            raise AttributeError(
+                "{0}.{1} reads a file; await the coroutine of the wrapper "
+                "class instead".format(type(self).__name__, name))
+        if hasattr(self.simple_class, name) or \
+                (name in self.item.__dict__ and name != "conn"):
+            return getattr(self.item, name)
+        raise AttributeError("{0} has no attribute {1}".format(
+            type(self).__name__, name))
+
+    async def _get(self, name):
+        return await self.conn.run(getattr, self.item, name)
+
+    async def parent(self):
+        """Retrieves the parent item, loading it if necessary.
+        Returns:
+            conquestasync.AsyncConquestItem: the parent item, or None for
+            patients
+        """
+        if self.item._parent is not None:
+            return self.conn.wrap(self.item._parent)
+        if not hasattr(self.item, "load_parent"):
+            return None
+        return self.conn.wrap(await self._get("parent"))
+
+    async def children(self, prefetch=False):
+        """Retrieves the child items: the studies of a patient, the series of a
+        study or the instances of a series.
+        Args:
+            prefetch (bool): whether to start loading the children of the
+                returned items in the background
+        Returns:
+            list: the conquestasync.AsyncConquestItem objects
+        """
+        if self.item.subitem_type_plural is None:
+            return []
+        items = self.item._children
+        if items is None:
+            items = await self._get(self.item.subitem_type_plural)
+        children = [self.conn.wrap(item) for item in items]
+        if prefetch:
+            self.conn.prefetch(children)
+        return children
+
+    def __repr__(self):
+        return repr(self.item)
+
+
+class AsyncConquestPatient(AsyncConquestItem):
+    """Asynchronous wrapper of a rtlibs.conquest.items.ConquestPatient."""
+    simple_class = ConquestSimplePatient
+
+    async def studies(self, prefetch=False):
+        """Retrieves the studies of the patient.
+        Args:
+            prefetch (bool): whether to start loading the series of the
+                studies in the background
+        Returns:
+            list: conquestasync.AsyncConquestStudy objects
+        """
+        return await self.children(prefetch)
+
+    async def load_tree(self):
+        """Loads all studies, series and instances of the patient at once."""
+        await self.conn.run(self.item.load_tree)
+
+
+class AsyncConquestStudy(AsyncConquestItem):
+    """Asynchronous wrapper of a rtlibs.conquest.items.ConquestStudy."""
+    simple_class = ConquestSimpleStudy
+
+    async def series(self, prefetch=False):
+        """Retrieves the series of the study.
+        Args:
+            prefetch (bool): whether to start loading the instances of the
+                series in the background
+        Returns:
+            list: conquestasync.AsyncConquestSeries objects
+        """
+        return await self.children(prefetch)
+
+
+class AsyncConquestSeries(AsyncConquestItem):
+    """Asynchronous wrapper of a rtlibs.conquest.items.ConquestSeries."""
+    simple_class = ConquestSimpleSeries
+
+    async def instances(self):
+        """Retrieves the instances of the series.
+        Returns:
+            list: conquestasync.AsyncConquestInstance objects
+        """
+        return await self.children()
+
+    async def instance_uids(self):
+        """Retrieves the instance UIDs of the series.
+        Returns:
+            list: the instance UIDs
+        """
+        return await self._get("instance_uids")
+
+    async def ordered_instance_uids(self):
+        """Retrieves the instance UIDs of the series in slice order.
+        Returns:
+            list: the instance UIDs
+        """
+        return await self._get("ordered_instance_uids")
+
+    async def count(self):
+        """Counts the instances of the series.
+        Returns:
+            int: the number of instances
+        """
+        return await self.conn.run(len, self.item)
+
+    def _first_instance(self):
+        # Runs on a database thread
+        children = self.item._children
+        if children is not None:
+            return children[0] if children else None
+        return self.conn.conn.get_first_instance_for_series(self.item)
+
+    async def image_orientation(self):
+        """Retrieves the image orientation of the series; see
+        rtlibs.conquest.items.ConquestSeries.image_orientation. If it is not
+        cached, the file header is read on a thread of the default executor,
+        so the database threads are not blocked.
+        Returns:
+            tuple: the six direction cosines, or None
+        """
+        if self.item.modality not in OBLIQUE_MODALITIES:
+            return None
+        conn = self.conn.conn
+        orientation = await self.conn.run(conn.get_series_orientation,
+                                          self.item.series_uid)
+        if orientation is None:
+            instance = await self.conn.run(self._first_instance)
+            if instance is not None:
+                orientation = await self.conn.read(
+                    getattr, instance, "image_orientation")
+            await self.conn.run(conn.set_series_orientation,
+                                self.item.series_uid, orientation)
+        return orientation or None
+
+    async def oblique(self):
+        """Checks whether the slices of the series are oblique; see
+        rtlibs.conquest.items.ConquestSeries.oblique.
+        Returns:
+            bool: whether the series is oblique
+        """
+        orientation = await self.image_orientation()
+        if orientation is None:
+            return False
+        return bool(orientation_is_oblique(orientation))
+
+    async def oblique_angle(self):
+        """Calculates the angle between the slice normal of the series and the
+        positive Z-axis; see rtlibs.conquest.items.ConquestSeries.oblique_angle.
+        Returns:
+            float: the angle in degrees, or None
+        """
+        orientation = await self.image_orientation()
+        if orientation is None:
+            return None
+        return orientation_angle(orientation)
+
+
+class AsyncConquestInstance(AsyncConquestItem):
+    """Asynchronous wrapper of a rtlibs.conquest.items.ConquestInstance."""
+    simple_class = ConquestSimpleInstance
+    file_properties = ("image_orientation", "oblique_angle", "oblique", "file")
+
+    async def image_orientation(self):
+        """Reads the image orientation from the header of the DICOM file, on a
+        thread of the default executor.
+        Returns:
+            tuple: the six direction cosines, or None
+        """
+        return await self.conn.read(getattr, self.item, "image_orientation")
+
+    async def oblique_angle(self):
+        """Calculates the angle between the slice normal of the instance and
+        the positive Z-axis, reading the DICOM file header.
+        Returns:
+            float: the angle in degrees, or None
+        """
+        return await self.conn.read(getattr, self.item, "oblique_angle")
+
+    async def oblique(self):
+        """Checks whether the instance is oblique, reading the DICOM file
+        header.
+        Returns:
+            bool: whether the instance is oblique
+        """
+        return await self.conn.read(getattr, self.item, "oblique")
+
+    async def file(self):
+        """Opens the DICOM file of the instance, on a thread of the default
+        executor.
+        Returns:
+            rtlibs.dicomrtz.DICOMFileObject: the opened DICOM file
+        """
+        return await self.conn.read(getattr, self.item, "file")
+
+
+ASYNC_CLASSES = {
+    ConquestPatient: AsyncConquestPatient,
+    ConquestStudy: AsyncConquestStudy,
+    ConquestSeries: AsyncConquestSeries,
+    ConquestInstance: AsyncConquestInstance,
+}
+
+
+if __name__ == "__main__":
+    import time
+
+    from conquestdb import create_synthetic_archive
+
+    async def main():
+        conn = AsyncConquestConnection()
+        await conn.run(create_synthetic_archive, conn.conn, patients=20,
+                       studies=3, series=8, instances=50)
+        start = time.perf_counter()
+        counts = []
+        async with conn.session():
+            patients = await conn.get_patients()
+            for patient in patients:
+                for study in await patient.studies(prefetch=True):
+                    for series in await study.series():
+                        counts.append(len(await series.instances()))
+        print("{0} series, {1} instances, {2:.1f} ms".format(
+            len(counts), sum(counts), (time.perf_counter() - start) * 1000))
+        series = await conn.get_series(
+            (await (await patients[0].studies())[0].series())[0].series_uid)
+        study = await series.parent()
+        print(series, await series.count(), "in", study,
+              "of", await study.parent())
+        await conn.close()
+
+    asyncio.run(main())
@@ -0,0 +1,2308 @@
+"""SQLite implementation of the Conquest database connection used by the item
+classes in conquest.py.
+The tables and column names follow the Conquest DICOM server's database
+(DICOMPatients, DICOMStudies, DICOMSeries and DICOMImages), so the item layer
+and its query patterns can be tested and benchmarked without a live Conquest
+server. The rows handed to the items are completed the way the item classes
+expect: counts of subitems, the study UID and modality of instances, and the
+data path. The SeriesGeometry table is not part of Conquest: it caches the
+image orientation of each series, so oblique checks read no files once a
+series has been seen.
+
+The connection keeps an identity map of the items it created, keyed by UID, so
+each item exists once; rows read again refresh the item. Inside a session, the
+connection also serves items and child lists that were already loaded from
+memory, so navigating between them does not query the database again. Outside a
+session every lookup queries the database, so a long-lived connection sees the
+items the Conquest server adds. Items are kept per patient, for at most
+cache_size patients: the items of the least recently used patient are dropped
+first. Deleting or adding an item drops all cached items of its patient;
+clear_cache and the end of a session drop everything.
+
+The connection can be shared between threads: every thread that queries the
+database gets its own SQLite connection from a pool, so items created on one
+thread can be used on any other.
+
+Every insert, update, replacement and deletion of a patient, study, series or
+instance row is logged in the ChangeLog table, so consumers can follow the
+archive with changes_since instead of rescanning it. Patient names and study
+and series descriptions are kept in a full-text index for search; search_uid
+finds items by UID prefix.
+"""
+import collections
+import contextlib
+import copy
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from conquest import ConquestPatient, ConquestStudy, ConquestSeries, \
+    ConquestInstance, item_class
+
+PATIENT_COLUMNS = ['PatientID', 'PatientNam', 'PatientBir', 'PatientSex']
+STUDY_COLUMNS = ['StudyInsta', 'StudyDate', 'StudyTime', 'StudyID',
+                 'StudyDescr', 'StudyModal', 'PatientID']
+SERIES_COLUMNS = ['SeriesInst', 'SeriesNumb', 'SeriesDate', 'SeriesTime',
+                  'SeriesDesc', 'Modality', 'PatientPos', 'Manufactur',
+                  'ModelName', 'ProtocolNa', 'StationNam', 'FrameOfRef',
+                  'SeriesPat', 'StudyInsta']
+INSTANCE_COLUMNS = ['SOPInstanc', 'SOPClassUI', 'ImageNumbe', 'ImageDate',
+                    'ImageTime', 'AcqDate', 'AcqTime', 'SliceLocat',
+                    'ImagePat', 'SeriesInst', 'ObjectFile']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS DICOMPatients (
+    PatientID TEXT PRIMARY KEY, PatientNam TEXT, PatientBir TEXT,
+    PatientSex TEXT);
+CREATE TABLE IF NOT EXISTS DICOMStudies (
+    StudyInsta TEXT PRIMARY KEY, StudyDate TEXT, StudyTime TEXT,
+    StudyID TEXT, StudyDescr TEXT, StudyModal TEXT, PatientID TEXT);
+CREATE TABLE IF NOT EXISTS DICOMSeries (
+    SeriesInst TEXT PRIMARY KEY, SeriesNumb TEXT, SeriesDate TEXT,
+    SeriesTime TEXT, SeriesDesc TEXT, Modality TEXT, PatientPos TEXT,
+    Manufactur TEXT, ModelName TEXT, ProtocolNa TEXT, StationNam TEXT,
+    FrameOfRef TEXT, SeriesPat TEXT, StudyInsta TEXT);
+CREATE TABLE IF NOT EXISTS DICOMImages (
+    SOPInstanc TEXT PRIMARY KEY, SOPClassUI TEXT, ImageNumbe TEXT,
+    ImageDate TEXT, ImageTime TEXT, AcqDate TEXT, AcqTime TEXT,
+    SliceLocat TEXT, ImagePat TEXT, SeriesInst TEXT, ObjectFile TEXT);
+CREATE TABLE IF NOT EXISTS SeriesGeometry (
+    SeriesInst TEXT PRIMARY KEY, Orientation TEXT);
+CREATE INDEX IF NOT EXISTS StudiesPatientID ON DICOMStudies (PatientID);
+CREATE INDEX IF NOT EXISTS StudiesStudyDate ON DICOMStudies (StudyDate);
+CREATE INDEX IF NOT EXISTS SeriesStudyInsta ON DICOMSeries (StudyInsta);
+CREATE INDEX IF NOT EXISTS SeriesSeriesPat ON DICOMSeries (SeriesPat);
+CREATE INDEX IF NOT EXISTS SeriesModality ON DICOMSeries (Modality);
+CREATE INDEX IF NOT EXISTS SeriesSeriesDate ON DICOMSeries (SeriesDate);
+CREATE INDEX IF NOT EXISTS ImagesSeriesInst ON DICOMImages (SeriesInst);
+CREATE INDEX IF NOT EXISTS ImagesImagePat ON DICOMImages (ImagePat);
+CREATE INDEX IF NOT EXISTS ImagesObjectPath
+    ON DICOMImages (replace(ObjectFile, '\\', '/'));
+"""
+
+# Summary tables, kept up to date by the triggers below, so listing items does
+# not aggregate their children. Image counts are incremented and decremented
+# per image; the other values are recomputed from indexed reads when a
+# patient, study or series is added or deleted. ImageSizes holds the file
+# sizes of the instances, which Conquest does not store. The triggers use no
+# conflict clauses, since those are overridden by the clause of the statement
+# that fires the trigger (e.g. the INSERT OR REPLACE of the add_* methods).
+SUMMARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ImageSizes (
+    SOPInstanc TEXT PRIMARY KEY, SeriesInst TEXT, Bytes INTEGER);
+CREATE TABLE IF NOT EXISTS SeriesSummary (
+    SeriesInst TEXT PRIMARY KEY, StudyInsta TEXT, PatientID TEXT,
+    ninstances INTEGER DEFAULT 0, bytes INTEGER DEFAULT 0);
+CREATE TABLE IF NOT EXISTS StudySummary (
+    StudyInsta TEXT PRIMARY KEY, PatientID TEXT, nseries INTEGER DEFAULT 0,
+    ninstances INTEGER DEFAULT 0, bytes INTEGER DEFAULT 0, modalities TEXT,
+    first_date TEXT, last_date TEXT);
+CREATE TABLE IF NOT EXISTS PatientSummary (
+    PatientID TEXT PRIMARY KEY, nstudies INTEGER DEFAULT 0,
+    nseries INTEGER DEFAULT 0, ninstances INTEGER DEFAULT 0,
+    bytes INTEGER DEFAULT 0, modalities TEXT, first_date TEXT,
+    last_date TEXT);
+CREATE INDEX IF NOT EXISTS ImageSizesSeriesInst ON ImageSizes (SeriesInst);
+CREATE INDEX IF NOT EXISTS SeriesSummaryStudyInsta
+    ON SeriesSummary (StudyInsta);
+CREATE INDEX IF NOT EXISTS SeriesSummaryPatientID ON SeriesSummary (PatientID);
+
+CREATE TRIGGER IF NOT EXISTS ImagesInsertSummary
+AFTER INSERT ON DICOMImages BEGIN
+    INSERT INTO SeriesSummary (SeriesInst) SELECT NEW.SeriesInst
+        WHERE NOT EXISTS (SELECT 1 FROM SeriesSummary
+                          WHERE SeriesInst = NEW.SeriesInst);
+    UPDATE SeriesSummary SET ninstances = ninstances + 1
+        WHERE SeriesInst = NEW.SeriesInst;
+    UPDATE StudySummary SET ninstances = ninstances + 1
+        WHERE StudyInsta = (SELECT StudyInsta FROM DICOMSeries
+                            WHERE SeriesInst = NEW.SeriesInst);
+    UPDATE PatientSummary SET ninstances = ninstances + 1
+        WHERE PatientID = NEW.ImagePat;
+END;
+CREATE TRIGGER IF NOT EXISTS ImagesDeleteSummary
+AFTER DELETE ON DICOMImages BEGIN
+    UPDATE SeriesSummary SET ninstances = ninstances - 1
+        WHERE SeriesInst = OLD.SeriesInst;
+    UPDATE StudySummary SET ninstances = ninstances - 1
+        WHERE StudyInsta = (SELECT StudyInsta FROM DICOMSeries
+                            WHERE SeriesInst = OLD.SeriesInst);
+    UPDATE PatientSummary SET ninstances = ninstances - 1
+        WHERE PatientID = OLD.ImagePat;
+    DELETE FROM ImageSizes WHERE SOPInstanc = OLD.SOPInstanc;
+END;
+CREATE TRIGGER IF NOT EXISTS ImageSizesInsertSummary
+AFTER INSERT ON ImageSizes BEGIN
+    UPDATE SeriesSummary SET bytes = bytes + NEW.Bytes
+        WHERE SeriesInst = NEW.SeriesInst;
+    UPDATE StudySummary SET bytes = bytes + NEW.Bytes
+        WHERE StudyInsta = (SELECT StudyInsta FROM SeriesSummary
+                            WHERE SeriesInst = NEW.SeriesInst);
+    UPDATE PatientSummary SET bytes = bytes + NEW.Bytes
+        WHERE PatientID = (SELECT PatientID FROM SeriesSummary
+                           WHERE SeriesInst = NEW.SeriesInst);
+END;
+CREATE TRIGGER IF NOT EXISTS ImageSizesDeleteSummary
+AFTER DELETE ON ImageSizes BEGIN
+    UPDATE SeriesSummary SET bytes = bytes - OLD.Bytes
+        WHERE SeriesInst = OLD.SeriesInst;
+    UPDATE StudySummary SET bytes = bytes - OLD.Bytes
+        WHERE StudyInsta = (SELECT StudyInsta FROM SeriesSummary
+                            WHERE SeriesInst = OLD.SeriesInst);
+    UPDATE PatientSummary SET bytes = bytes - OLD.Bytes
+        WHERE PatientID = (SELECT PatientID FROM SeriesSummary
+                           WHERE SeriesInst = OLD.SeriesInst);
+END;
+CREATE TRIGGER IF NOT EXISTS SeriesInsertSummary
+AFTER INSERT ON DICOMSeries BEGIN
+    DELETE FROM SeriesSummary WHERE SeriesInst = NEW.SeriesInst;
+    INSERT INTO SeriesSummary VALUES (
+        NEW.SeriesInst, NEW.StudyInsta, NEW.SeriesPat,
+        (SELECT COUNT(*) FROM DICOMImages WHERE SeriesInst = NEW.SeriesInst),
+        (SELECT COALESCE(SUM(Bytes), 0) FROM ImageSizes
+         WHERE SeriesInst = NEW.SeriesInst));
+    {study:NEW.StudyInsta}
+    {patient:NEW.SeriesPat}
+END;
+CREATE TRIGGER IF NOT EXISTS SeriesDeleteSummary
+AFTER DELETE ON DICOMSeries BEGIN
+    DELETE FROM SeriesSummary WHERE SeriesInst = OLD.SeriesInst;
+    {study:OLD.StudyInsta}
+    {patient:OLD.SeriesPat}
+END;
+CREATE TRIGGER IF NOT EXISTS StudiesInsertSummary
+AFTER INSERT ON DICOMStudies BEGIN
+    DELETE FROM StudySummary WHERE StudyInsta = NEW.StudyInsta;
+    INSERT INTO StudySummary (StudyInsta, PatientID)
+        VALUES (NEW.StudyInsta, NEW.PatientID);
+    {study:NEW.StudyInsta}
+    {patient:NEW.PatientID}
+END;
+CREATE TRIGGER IF NOT EXISTS StudiesDeleteSummary
+AFTER DELETE ON DICOMStudies BEGIN
+    DELETE FROM StudySummary WHERE StudyInsta = OLD.StudyInsta;
+    {patient:OLD.PatientID}
+END;
+CREATE TRIGGER IF NOT EXISTS PatientsInsertSummary
+AFTER INSERT ON DICOMPatients BEGIN
+    DELETE FROM PatientSummary WHERE PatientID = NEW.PatientID;
+    INSERT INTO PatientSummary (PatientID)
+        VALUES (NEW.PatientID);
+    {patient:NEW.PatientID}
+END;
+CREATE TRIGGER IF NOT EXISTS PatientsDeleteSummary
+AFTER DELETE ON DICOMPatients BEGIN
+    DELETE FROM PatientSummary WHERE PatientID = OLD.PatientID;
+END;
+"""
+
+# Recomputes the summary of a study; {0} is the study UID
+STUDY_SUMMARY_UPDATE = """UPDATE StudySummary SET
+        nseries = (SELECT COUNT(*) FROM DICOMSeries WHERE StudyInsta = {0}),
+        ninstances = (SELECT COALESCE(SUM(ninstances), 0) FROM SeriesSummary
+                      WHERE StudyInsta = {0}),
+        bytes = (SELECT COALESCE(SUM(bytes), 0) FROM SeriesSummary
+                 WHERE StudyInsta = {0}),
+        modalities = (SELECT group_concat(Modality, '\\') FROM (
+            SELECT DISTINCT Modality FROM DICOMSeries
+            WHERE StudyInsta = {0} ORDER BY Modality)),
+        first_date = (SELECT MIN(SeriesDate) FROM DICOMSeries
+                      WHERE StudyInsta = {0} AND SeriesDate != ''),
+        last_date = (SELECT MAX(SeriesDate) FROM DICOMSeries
+                     WHERE StudyInsta = {0})
+        WHERE StudyInsta = {0};"""
+
+# Recomputes the summary of a patient; {0} is the patient ID
+PATIENT_SUMMARY_UPDATE = """UPDATE PatientSummary SET
+        nstudies = (SELECT COUNT(*) FROM DICOMStudies WHERE PatientID = {0}),
+        nseries = (SELECT COUNT(*) FROM DICOMSeries WHERE SeriesPat = {0}),
+        ninstances = (SELECT COUNT(*) FROM DICOMImages WHERE ImagePat = {0}),
+        bytes = (SELECT COALESCE(SUM(bytes), 0) FROM SeriesSummary
+                 WHERE PatientID = {0}),
+        modalities = (SELECT group_concat(Modality, '\\') FROM (
+            SELECT DISTINCT Modality FROM DICOMSeries
+            WHERE SeriesPat = {0} ORDER BY Modality)),
+        first_date = (SELECT MIN(StudyDate) FROM DICOMStudies
+                      WHERE PatientID = {0} AND StudyDate != ''),
+        last_date = (SELECT MAX(StudyDate) FROM DICOMStudies
+                     WHERE PatientID = {0})
+        WHERE PatientID = {0};"""
+
+
+def _summary_schema():
+    schema = SUMMARY_SCHEMA
+    for name, template in [("study", STUDY_SUMMARY_UPDATE),
+                           ("patient", PATIENT_SUMMARY_UPDATE)]:
+        for column in ["NEW.StudyInsta", "OLD.StudyInsta", "NEW.SeriesPat",
+                       "OLD.SeriesPat", "NEW.PatientID", "OLD.PatientID"]:
+            schema = schema.replace("{{{0}:{1}}}".format(name, column),
+                                    template.format(column))
+    return schema
+
+
+# The change feed: every insert, update and delete of a patient, study, series
+# or instance row appends a row to ChangeLog, whose token increases with every
+# change and is never reused, so consumers can ask for the changes after the
+# last token they processed. Files found in the data path without a database
+# row are logged as well, with kind "file" and the path as UID. ChangeReplace
+# holds the row an INSERT statement is adding while it runs (see below).
+CHANGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ChangeLog (
+    Token INTEGER PRIMARY KEY AUTOINCREMENT, Time REAL, Action TEXT,
+    Kind TEXT, Uid TEXT, PatientID TEXT, StudyInsta TEXT, SeriesInst TEXT);
+CREATE INDEX IF NOT EXISTS ChangeLogFiles ON ChangeLog (Uid)
+    WHERE Kind = 'file';
+CREATE TABLE IF NOT EXISTS ChangeReplace (
+    Kind TEXT, Uid TEXT, Replaced INTEGER DEFAULT 0);
+"""
+
+# The triggers logging the changes of a table. Replacing a row fires the delete
+# trigger and then the insert trigger within the INSERT statement (see
+# recursive_triggers). The before insert trigger marks the row being inserted
+# in ChangeReplace; a delete of that row while the mark exists is the replace
+# of the same statement, which the insert trigger logs as a single "update"
+# before removing the mark. A delete and an insert in separate statements stay
+# a "delete" and an "insert". Marks left by a statement whose row was not
+# inserted (INSERT OR IGNORE) are removed by the next insert. In-place updates
+# are logged as "update", or as a delete and an insert if the UID changes.
+CHANGE_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS {table}BeforeInsertChange
+BEFORE INSERT ON {table} BEGIN
+    DELETE FROM ChangeReplace;
+    INSERT INTO ChangeReplace (Kind, Uid) VALUES ('{kind}', NEW.{uid});
+END;
+CREATE TRIGGER IF NOT EXISTS {table}InsertChange
+AFTER INSERT ON {table} BEGIN
+    INSERT INTO ChangeLog (Time, Action, Kind, Uid, PatientID, StudyInsta,
+                           SeriesInst)
+        SELECT {now}, CASE WHEN EXISTS (
+            SELECT 1 FROM ChangeReplace WHERE Kind = '{kind}' AND
+            Uid = NEW.{uid} AND Replaced) THEN 'update' ELSE 'insert' END,
+            '{kind}', NEW.{uid}, {new_columns};
+    DELETE FROM ChangeReplace;
+END;
+CREATE TRIGGER IF NOT EXISTS {table}UpdateChange
+AFTER UPDATE ON {table} BEGIN
+    INSERT INTO ChangeLog (Time, Action, Kind, Uid, PatientID, StudyInsta,
+                           SeriesInst)
+        SELECT {now}, 'delete', '{kind}', OLD.{uid}, {old_columns}
+        WHERE OLD.{uid} IS NOT NEW.{uid};
+    INSERT INTO ChangeLog (Time, Action, Kind, Uid, PatientID, StudyInsta,
+                           SeriesInst)
+        SELECT {now}, CASE WHEN OLD.{uid} IS NEW.{uid} THEN 'update'
+            ELSE 'insert' END, '{kind}', NEW.{uid}, {new_columns};
+END;
+CREATE TRIGGER IF NOT EXISTS {table}DeleteChange
+AFTER DELETE ON {table} BEGIN
+    UPDATE ChangeReplace SET Replaced = 1
+        WHERE Kind = '{kind}' AND Uid = OLD.{uid};
+    INSERT INTO ChangeLog (Time, Action, Kind, Uid, PatientID, StudyInsta,
+                           SeriesInst)
+        SELECT {now}, 'delete', '{kind}', OLD.{uid}, {old_columns}
+        WHERE changes() = 0;
+END;
+"""
+
+# The logged tables: the change kind, the UID column and the expressions for
+# the patient ID, study UID and series UID of a row ({0} is NEW or OLD)
+CHANGE_TABLES = [
+    ("DICOMPatients", "patient", "PatientID", "{0}.PatientID", "NULL", "NULL"),
+    ("DICOMStudies", "study", "StudyInsta", "{0}.PatientID", "{0}.StudyInsta",
+     "NULL"),
+    ("DICOMSeries", "series", "SeriesInst", "{0}.SeriesPat", "{0}.StudyInsta",
+     "{0}.SeriesInst"),
+    ("DICOMImages", "instance", "SOPInstanc", "{0}.ImagePat",
+     "(SELECT StudyInsta FROM DICOMSeries WHERE SeriesInst = {0}.SeriesInst)",
+     "{0}.SeriesInst"),
+]
+
+# The current time as a Unix timestamp in SQL
+SQL_NOW = "(julianday('now') - 2440587.5) * 86400.0"
+
+
+def _change_schema():
+    schema = CHANGE_SCHEMA
+    for table, kind, uid, patient, study, series in CHANGE_TABLES:
+        schema += CHANGE_TRIGGERS.format(
+            table=table, kind=kind, uid=uid, now=SQL_NOW,
+            new_columns=", ".join(c.format("NEW")
+                                  for c in [patient, study, series]),
+            old_columns=", ".join(c.format("OLD")
+                                  for c in [patient, study, series]))
+    return schema
+
+
+# The search index: the patient names and IDs and the study and series
+# descriptions in an FTS5 table, kept up to date by triggers as rows are added,
+# updated and deleted. SearchKeys maps the rowid of each indexed text to its
+# item, so the triggers find the text of an updated or deleted row by an
+# indexed lookup. UIDs are not in the text index: prefix searches on UIDs use
+# the primary keys of the tables.
+SEARCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS SearchKeys (
+    DocId INTEGER PRIMARY KEY, Kind TEXT, Uid TEXT, UNIQUE (Kind, Uid));
+CREATE VIRTUAL TABLE IF NOT EXISTS SearchIndex USING fts5(
+    Text, tokenize = 'unicode61 remove_diacritics 1', prefix = '2 3');
+"""
+
+SEARCH_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS {table}InsertSearch
+AFTER INSERT ON {table} BEGIN
+    DELETE FROM SearchIndex WHERE rowid IN (
+        SELECT DocId FROM SearchKeys WHERE Kind = '{kind}' AND Uid = NEW.{uid});
+    DELETE FROM SearchKeys WHERE Kind = '{kind}' AND Uid = NEW.{uid};
+    INSERT INTO SearchKeys (Kind, Uid) VALUES ('{kind}', NEW.{uid});
+    INSERT INTO SearchIndex (rowid, Text) VALUES (last_insert_rowid(), {text});
+END;
+CREATE TRIGGER IF NOT EXISTS {table}UpdateSearch
+AFTER UPDATE OF {columns} ON {table} BEGIN
+    DELETE FROM SearchIndex WHERE rowid IN (
+        SELECT DocId FROM SearchKeys WHERE Kind = '{kind}' AND Uid = OLD.{uid});
+    DELETE FROM SearchKeys WHERE Kind = '{kind}' AND Uid = OLD.{uid};
+    INSERT INTO SearchKeys (Kind, Uid) VALUES ('{kind}', NEW.{uid});
+    INSERT INTO SearchIndex (rowid, Text) VALUES (last_insert_rowid(), {text});
+END;
+CREATE TRIGGER IF NOT EXISTS {table}DeleteSearch
+AFTER DELETE ON {table} BEGIN
+    DELETE FROM SearchIndex WHERE rowid IN (
+        SELECT DocId FROM SearchKeys WHERE Kind = '{kind}' AND Uid = OLD.{uid});
+    DELETE FROM SearchKeys WHERE Kind = '{kind}' AND Uid = OLD.{uid};
+END;
+"""
+
+# The indexed tables: the item class, the search kind, the UID column and the
+# indexed text of a row ({0} is the row)
+SEARCH_TABLES = [
+    ("DICOMPatients", ConquestPatient, "patient", "PatientID",
+     "COALESCE({0}.PatientNam, '') || ' ' || COALESCE({0}.PatientID, '')"),
+    ("DICOMStudies", ConquestStudy, "study", "StudyInsta",
+     "COALESCE({0}.StudyDescr, '')"),
+    ("DICOMSeries", ConquestSeries, "series", "SeriesInst",
+     "COALESCE({0}.SeriesDesc, '')"),
+]
+
+# The tables searched by UID prefix, with their UID column
+UID_TABLES = [
+    (ConquestPatient, "DICOMPatients", "PatientID"),
+    (ConquestStudy, "DICOMStudies", "StudyInsta"),
+    (ConquestSeries, "DICOMSeries", "SeriesInst"),
+    (ConquestInstance, "DICOMImages", "SOPInstanc"),
+]
+
+
+def _search_schema():
+    schema = SEARCH_SCHEMA
+    for table, _, kind, uid, text in SEARCH_TABLES:
+        # The update trigger fires when the UID or a column of the text changes
+        columns = [uid] + [column for column in re.findall(
+            r"\{0\}\.(\w+)", text) if column != uid]
+        schema += SEARCH_TRIGGERS.format(table=table, kind=kind, uid=uid,
+                                         columns=", ".join(columns),
+                                         text=text.format("NEW"))
+    return schema
+
+
+def _match_expression(text):
+    # Turns the words of a search text into an FTS5 query matching items that
+    # contain words starting with all of them
+    words = text.replace("^", " ").split()
+    return " ".join('"{0}"*'.format(w.replace('"', '""')) for w in words)
+
+
+PATIENT_QUERY = """
+SELECT p.*, ps.nstudies, ps.nseries, ps.ninstances, ps.modalities,
+    ps.first_date, ps.last_date, ps.bytes
+FROM DICOMPatients p LEFT JOIN PatientSummary ps ON ps.PatientID = p.PatientID
+"""
+
+STUDY_QUERY = """
+SELECT st.*, sts.nseries, sts.ninstances, sts.modalities, sts.first_date,
+    sts.last_date, sts.bytes
+FROM DICOMStudies st LEFT JOIN StudySummary sts
+    ON sts.StudyInsta = st.StudyInsta
+"""
+
+SERIES_QUERY = """
+SELECT se.*, ses.ninstances, ses.bytes
+FROM DICOMSeries se LEFT JOIN SeriesSummary ses
+    ON ses.SeriesInst = se.SeriesInst
+"""
+
+INSTANCE_QUERY = """
+SELECT i.*, se.StudyInsta AS StudyInsta, se.Modality AS Modality
+FROM DICOMImages i JOIN DICOMSeries se ON se.SeriesInst = i.SeriesInst
+"""
+
+STUDY_ORDER = " ORDER BY st.StudyDate, st.StudyTime, st.StudyInsta"
+SERIES_ORDER = " ORDER BY se.StudyInsta, CAST(se.SeriesNumb AS INTEGER), " \
+               "se.SeriesInst"
+INSTANCE_ORDER = " ORDER BY i.SeriesInst, CAST(i.ImageNumbe AS INTEGER), " \
+                 "i.SOPInstanc"
+
+# The row column holding the UID for each item class
+UID_COLUMNS = {
+    ConquestPatient: 'PatientID',
+    ConquestStudy: 'StudyInsta',
+    ConquestSeries: 'SeriesInst',
+    ConquestInstance: 'SOPInstanc',
+}
+
+
+# The tables, query and fields of each item class for ConquestQuery; the fields
+# map names used in filters and ordering to SQL expressions
+QueryTable = collections.namedtuple(
+    "QueryTable", ["query", "source", "fields", "order"])
+
+QUERY_TABLES = {
+    ConquestPatient: QueryTable(
+        PATIENT_QUERY, "FROM DICOMPatients p", {
+            'uid': "p.PatientID",
+            'patient_id': "p.PatientID",
+            'name': "p.PatientNam",
+            'description': "p.PatientNam",
+            'date': "p.PatientBir",
+        }, ['patient_id']),
+    ConquestStudy: QueryTable(
+        STUDY_QUERY, "FROM DICOMStudies st", {
+            'uid': "st.StudyInsta",
+            'patient_id': "st.PatientID",
+            'study_uid': "st.StudyInsta",
+            'description': "st.StudyDescr",
+            'date': "st.StudyDate",
+            'time': "st.StudyTime",
+        }, ['date', 'time', 'uid']),
+    ConquestSeries: QueryTable(
+        SERIES_QUERY, "FROM DICOMSeries se", {
+            'uid': "se.SeriesInst",
+            'patient_id': "se.SeriesPat",
+            'study_uid': "se.StudyInsta",
+            'series_uid': "se.SeriesInst",
+            'description': "se.SeriesDesc",
+            'date': "se.SeriesDate",
+            'time': "se.SeriesTime",
+            'modality': "se.Modality",
+            'number': "CAST(se.SeriesNumb AS INTEGER)",
+        }, ['study_uid', 'number', 'uid']),
+    ConquestInstance: QueryTable(
+        INSTANCE_QUERY,
+        "FROM DICOMImages i JOIN DICOMSeries se "
+        "ON se.SeriesInst = i.SeriesInst", {
+            'uid': "i.SOPInstanc",
+            'patient_id': "i.ImagePat",
+            'study_uid': "se.StudyInsta",
+            'series_uid': "i.SeriesInst",
+            'date': "i.ImageDate",
+            'time': "i.ImageTime",
+            'modality': "se.Modality",
+            'number': "CAST(i.ImageNumbe AS INTEGER)",
+        }, ['series_uid', 'number', 'uid']),
+}
+
+# Filters for the modality of patients and studies, which have no modality
+# column of their own: they match if any of their series matches
+MODALITY_FILTERS = {
+    ConquestPatient: "EXISTS (SELECT 1 FROM DICOMSeries ms WHERE "
+                     "ms.SeriesPat = p.PatientID AND ms.Modality IN ({0}))",
+    ConquestStudy: "EXISTS (SELECT 1 FROM DICOMSeries ms WHERE "
+                   "ms.StudyInsta = st.StudyInsta AND ms.Modality IN ({0}))",
+}
+
+# The result of ConquestDatabaseConnection.delete_items; files is the number of
+# files that existed and bytes their total size
+DeleteReport = collections.namedtuple(
+    "DeleteReport",
+    ["patients", "studies", "series", "instances", "files", "bytes"])
+
+# An entry of the change feed: action is "insert", "update" or "delete", kind
+# is "patient", "study", "series", "instance" or "file" and uid the UID of the
+# item or the path of the file; time is a Unix timestamp. The patient ID, study
+# UID and series UID are those of the item, where they apply.
+Change = collections.namedtuple(
+    "Change", ["token", "time", "action", "kind", "uid", "patient_id",
+               "study_uid", "series_uid"])
+
+# The usage statistics of a ConnectionPool: connections is the number of open
+# connections and in_use the number held by threads; wait_time and
+# max_wait_time are the total and longest time in seconds that threads waited
+# for a connection, queries is the number of queries executed
+PoolStats = collections.namedtuple(
+    "PoolStats", ["size", "connections", "in_use", "acquisitions",
+                  "wait_time", "max_wait_time", "queries"])
+
+# Value sets up to this size are passed as one parameter per value; larger
+# sets are passed as a single JSON array, to stay below SQLite's limit on the
+# number of parameters
+MAX_INLINE_VALUES = 200
+
+
+def _encode_orientation(orientation):
+    # Orientations are stored like DICOM multi-values; "" means no orientation
+    if not orientation:
+        return ""
+    return "\\".join(repr(v) for v in orientation)
+
+
+def _decode_orientation(value):
+    if value is None:
+        return None
+    if not value:
+        return ()
+    return tuple(float(v) for v in value.split("\\"))
+
+
+def _file_size(filepath):
+    try:
+        return os.path.getsize(filepath)
+    except OSError:
+        return None
+
+
+def _remove_file(filepath):
+    # Removes a file and returns its size, or None if it did not exist
+    size = _file_size(filepath)
+    try:
+        os.remove(filepath)
+    except OSError:
+        return None
+    return size
+
+
+class _ThreadToken(object):
+    pass
+
+
+class ConnectionPool(object):
+    """Pool of SQLite connections to one database. A thread takes a connection
+    from the pool for a single query, or holds one for longer with connected;
+    a thread with an open transaction keeps its connection until the
+    transaction is committed or rolled back. When all connections are in use,
+    further threads wait for one to be returned.
+    An in-memory database is shared between the connections of the pool, in
+    SQLite's shared cache mode. There, readers see uncommitted changes of other
+    connections (read_uncommitted), and a query that finds a table locked by
+    the write transaction of another connection is retried until that
+    transaction ends or the timeout expires.
+    Args:
+        database (str): the path of the SQLite database file, or ":memory:"
+        size (int): the maximum number of connections
+        timeout (float): the maximum time in seconds to wait for a connection,
+            or None to wait indefinitely
+    """
+    _memory_databases = itertools.count()
+
+    def __init__(self, database=":memory:", size=4, timeout=60.0):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self._uri = None
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self._idle = []
+        self._connections = []
+        self._acquisitions = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._queries = 0
+        self._anchor = None
+        if database == ":memory:":
+            # Keeps the shared in-memory database alive while the pool exists
+            self._uri = "file:conquest{0}?mode=memory&cache=shared".format(
+                next(self._memory_databases))
+            self._anchor = self._connect()
+
+    def _connect(self):
+        if self._uri is not None:
+            db = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+        else:
+            db = sqlite3.connect(self.database, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        # Makes replacing a row fire the delete triggers of the old row, which
+        # keep the summary tables up to date
+        db.execute("PRAGMA recursive_triggers = ON")
+        if self._uri is not None:
+            # Shared cache connections lock tables; this lets readers ignore
+            # the locks of writers
+            db.execute("PRAGMA read_uncommitted = ON")
+        return db
+
+    def call(self, function, *args):
+        """Calls a function that uses a connection. In a shared in-memory
+        database, the call is repeated while it fails because another
+        connection has locked a table; the busy timeout does not apply there.
+        Args:
+            function (callable): the function
+            args: the arguments of the function
+        Returns:
+            object: the result of the function
+        """
+        start = time.perf_counter()
+        delay = 0.001
+        while True:
+            try:
+                return function(*args)
+            except sqlite3.OperationalError as e:
+                if self._uri is None or "locked" not in str(e) or (
+                        self.timeout is not None and
+                        time.perf_counter() - start > self.timeout):
+                    raise
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def connection(self):
+        """Returns the connection of the current thread, acquiring one from the
+        pool if the thread has none. The thread keeps it until release is
+        called or the thread ends.
+        Returns:
+            sqlite3.Connection: the connection
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = self._acquire()
+        self._keep()
+        return db
+
+    def _keep(self):
+        # Returns the connection of the thread to the pool when the thread
+        # ends and its thread-local data, including the token, is deleted
+        if getattr(self._local, 'release', None) is None:
+            self._local.token = token = _ThreadToken()
+            self._local.release = weakref.finalize(
+                token, self._release, self._local.db)
+
+    def _acquire(self):
+        start = time.perf_counter()
+        with self._condition:
+            while not self._idle and len(self._connections) >= self.size:
+                remaining = None
+                if self.timeout is not None:
+                    remaining = self.timeout - (time.perf_counter() - start)
+                    if remaining <= 0:
+                        raise sqlite3.OperationalError(
+                            "No free connection in the pool after {0} s".format(
+                                self.timeout))
+                self._condition.wait(remaining)
+            if self._idle:
+                db = self._idle.pop()
+            else:
+                db = None
+                self._connections.append(db)
+            wait_time = time.perf_counter() - start
+            self._acquisitions += 1
+            self._wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+        if db is None:
+            # Connects outside the lock and replaces the placeholder
+            db = self._connect()
+            with self._condition:
+                self._connections[self._connections.index(None)] = db
+        return db
+
+    def _release(self, db):
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            pass
+        with self._condition:
+            self._idle.append(db)
+            self._condition.notify()
+
+    def in_transaction(self):
+        """Checks whether the current thread has a transaction open.
+        Returns:
+            bool: whether the thread holds a connection with an open
+            transaction
+        """
+        db = getattr(self._local, 'db', None)
+        return db is not None and db.in_transaction
+
+    def release(self):
+        """Returns the connection of the current thread to the pool. Any open
+        transaction of the thread is rolled back.
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            return
+        release = getattr(self._local, 'release', None)
+        self._local.db = None
+        self._local.token = None
+        self._local.release = None
+        if release is not None:
+            release()
+        else:
+            self._release(db)
+
+    def release_idle(self):
+        """Returns the connection of the current thread to the pool, unless a
+        transaction is open on it or a connected block holds it.
+        """
+        db = getattr(self._local, 'db', None)
+        if db is not None and not db.in_transaction and \
+                not getattr(self._local, 'holds', 0):
+            self.release()
+
+    @contextlib.contextmanager
+    def connected(self):
+        """Context manager that holds a connection for the current thread while
+        it is active. Afterwards the connection is returned to the pool, unless
+        an enclosing block holds it or a transaction is still open on it.
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = self._acquire()
+        self._local.holds = getattr(self._local, 'holds', 0) + 1
+        try:
+            yield db
+        finally:
+            self._local.holds -= 1
+            self.release_idle()
+            if getattr(self._local, 'db', None) is not None:
+                # Kept for an open transaction or an enclosing block
+                self._keep()
+
+    def count_query(self):
+        """Counts a query for the statistics."""
+        with self._condition:
+            self._queries += 1
+
+    def stats(self):
+        """Returns the usage statistics of the pool.
+        Returns:
+            conquestdb.PoolStats: the statistics
+        """
+        with self._condition:
+            return PoolStats(self.size, len(self._connections),
+                             len(self._connections) - len(self._idle),
+                             self._acquisitions, self._wait_time,
+                             self._max_wait_time, self._queries)
+
+    def close(self):
+        """Closes all connections. Connections still held by other threads are
+        closed as well, so the pool must not be used afterwards.
+        """
+        with self._condition:
+            for db in self._connections:
+                if db is not None:
+                    db.close()
+            self._connections = []
+            self._idle = []
+            if self._anchor is not None:
+                self._anchor.close()
+                self._anchor = None
+        self._local = threading.local()
+
+
+class QueryResult(object):
+    """The result rows of a query, fetched before its connection was returned
+    to the pool, with the fetch methods of a sqlite3.Cursor.
+    Args:
+        rows (list): the sqlite3.Row objects
+        rowcount (int): the number of modified rows, as given by the cursor
+    """
+    def __init__(self, rows, rowcount=-1):
+        self.rows = rows
+        self.rowcount = rowcount
+        self._position = 0
+
+    def __iter__(self):
+        while self._position < len(self.rows):
+            self._position += 1
+            yield self.rows[self._position - 1]
+
+    def fetchone(self):
+        """Returns the next row, or None if there are no more rows."""
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=1):
+        """Returns up to size of the next rows."""
+        rows = self.rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    def fetchall(self):
+        """Returns all remaining rows."""
+        return self.fetchmany(len(self.rows))
+
+
+class PooledConnection(object):
+    """The SQLite connection of the current thread, from a
+    conquestdb.ConnectionPool. Used as a context manager, it runs a
+    transaction: the thread holds a connection while the block runs, the block
+    is committed (or rolled back on an exception) and the connection is
+    returned to the pool, unless an enclosing block holds it.
+    Args:
+        pool (conquestdb.ConnectionPool): the pool
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self._blocks = []
+
+    def __enter__(self):
+        block = self.pool.connected()
+        db = block.__enter__()
+        self._blocks.append((block, db))
+        return db.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        block, db = self._blocks.pop()
+        try:
+            return db.__exit__(exc_type, exc_value, traceback)
+        finally:
+            block.__exit__(None, None, None)
+
+    def __getattr__(self, name):
+        return getattr(self.pool.connection(), name)
+
+
+class ConquestDatabaseConnection(object):
+    """Connection to a Conquest database stored in SQLite.
+    Args:
+        database (str): the path of the SQLite database file, or ":memory:"
+        data_path (str): the folder where the DICOM files are stored; the
+            ObjectFile column of the instances is relative to this folder
+        cache (bool): whether to keep an identity map of the loaded items;
+            child lists are only cached inside a session
+        pool_size (int): the maximum number of threads that can query the
+            database at the same time; each gets its own SQLite connection
+            from a conquestdb.ConnectionPool
+        cache_size (int): the maximum number of patients whose items are
+            cached, or None for no limit
+    """
+    def __init__(self, database=":memory:", data_path="", cache=True,
+                 pool_size=4, cache_size=64):
+        self.database = database
+        self.data_path = data_path
+        self.cache = cache
+        # Whether loaded items and child lists are served from memory, which
+        # is only the case inside a session
+        self.cache_children = False
+        self.cache_size = cache_size
+        self._items = {}
+        # The keys of the cached items by patient ID, least recently used
+        # patient first
+        self._patient_items = collections.OrderedDict()
+        self._lock = threading.RLock()
+        # The conquesttrace.Tracer recording the queries, if any
+        self.tracer = None
+        self.pool = ConnectionPool(database, pool_size)
+        with self.pool.connected() as db:
+            db.executescript(SCHEMA)
+            created = db.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND "
+                "name = 'PatientSummary'").fetchone()[0] == 0
+            db.executescript(_summary_schema())
+            db.executescript(_change_schema())
+            indexed = db.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND "
+                "name = 'SearchKeys'").fetchone()[0] == 1
+            db.executescript(_search_schema())
+        if created:
+            self.rebuild_summaries()
+        if not indexed:
+            self.rebuild_search_index()
+
+    @property
+    def db(self):
+        """Getter for the SQLite connection of the current thread. Used as a
+        context manager, it holds a connection for the thread while the block
+        runs, commits the block (or rolls it back on an exception) and returns
+        the connection to the pool; other attributes are those of the
+        connection, which the thread then keeps until it commits.
+        Returns:
+            conquestdb.PooledConnection: the connection
+        """
+        return PooledConnection(self.pool)
+
+    def close(self):
+        """Closes the database connections."""
+        self.pool.close()
+
+    def _run(self, function, query, *args):
+        # Runs a query function with counting, tracing and retries
+        self.pool.count_query()
+        if self.tracer is None:
+            return self.pool.call(function, query, *args)
+        start = time.perf_counter()
+        try:
+            return self.pool.call(function, query, *args)
+        finally:
+            self.tracer.record_query(query, start)
+
+    def execute(self, query, parameters=()):
+        """Executes a query. The connection is taken from the pool for the
+        query and returned afterwards, unless the query opened a transaction
+        (any write does), which the thread keeps until commit.
+        Args:
+            query (str): the SQL query
+            parameters (sequence): the query parameters
+        Returns:
+            conquestdb.QueryResult: the result rows
+        """
+        with self.pool.connected() as db:
+            def run(query):
+                cursor = db.execute(query, parameters)
+                return QueryResult(cursor.fetchall(), cursor.rowcount)
+            return self._run(run, query)
+
+    def executemany(self, query, parameters):
+        """Executes a query for every set of parameters.
+        Args:
+            query (str): the SQL query
+            parameters (iterable): the sequences of query parameters
+        Returns:
+            int: the number of modified rows
+        """
+        parameters = list(parameters)
+        with self.pool.connected() as db:
+            return self._run(
+                lambda query: db.executemany(query, parameters).rowcount,
+                query)
+
+    def iterate(self, query, parameters=(), page_size=1000):
+        """Executes a query and yields its rows, fetching page_size rows at a
+        time, so results of any size take bounded memory. The thread holds a
+        connection until the iteration ends.
+        Args:
+            query (str): the SQL query
+            parameters (sequence): the query parameters
+            page_size (int): the number of rows fetched at a time
+        Yields:
+            sqlite3.Row: the result rows
+        """
+        with self.pool.connected() as db:
+            cursor = self._run(db.execute, query, parameters)
+            while True:
+                rows = self.pool.call(cursor.fetchmany, page_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+
+    @contextlib.contextmanager
+    def _write(self):
+        # Commits the writes of the block, unless the thread has a transaction
+        # open already: then they become part of it, and the caller commits
+        if self.pool.in_transaction():
+            yield
+            return
+        with self.db:
+            yield
+
+    def fetch_rows(self, query, parameters=()):
+        """Executes a query and returns the result rows as dicts, with the data
+        path added.
+        Args:
+            query (str): the SQL query
+            parameters (sequence): the query parameters
+        Returns:
+            list: the rows as dicts
+        """
+        rows = []
+        for row in self.execute(query, parameters):
+            row = dict(row)
+            row['data_path'] = self.data_path
+            rows.append(row)
+        return rows
+
+    def fetch_row(self, query, parameters=()):
+        """Executes a query and returns the first result row.
+        Args:
+            query (str): the SQL query
+            parameters (sequence): the query parameters
+        Returns:
+            dict: the first row, or None if there are no results
+        """
+        rows = self.fetch_rows(query + " LIMIT 1", parameters)
+        if not rows:
+            return None
+        return rows[0]
+
+    # Identity map
+
+    def create_item(self, cls, row, parent=None):
+        """Creates an item from a database row. If the item was created before,
+        the existing object is returned, with its row updated.
+        Args:
+            cls (type): the item class, e.g. rtlibs.conquest.items.ConquestStudy
+            row (dict): the database row
+            parent (rtlibs.conquest.items.ConquestItem): the parent item
+        Returns:
+            rtlibs.conquest.items.ConquestItem: the item
+        """
+        if not self.cache:
+            return cls(self, row, parent)
+        key = (cls, row[UID_COLUMNS[cls]])
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                item = cls(self, row, parent)
+                self._items[key] = item
+                self._patient_items.setdefault(item.patient_id, set()).add(key)
+                self._touch(item.patient_id)
+                self._evict()
+            else:
+                item.data = row
+                if parent is not None:
+                    item.parent = parent
+                if not self.cache_children:
+                    # The children loaded with the old row may be outdated
+                    item._children = None
+                self._touch(item.patient_id)
+        return item
+
+    def _touch(self, patient_id):
+        # Marks a patient as the most recently used
+        if patient_id in self._patient_items:
+            self._patient_items.move_to_end(patient_id)
+
+    def _evict(self):
+        # Drops the items of the least recently used patients beyond
+        # cache_size; the patient of the item just added is the most recent
+        if self.cache_size is None:
+            return
+        while len(self._patient_items) > max(self.cache_size, 1):
+            _, keys = self._patient_items.popitem(last=False)
+            for key in keys:
+                item = self._items.pop(key, None)
+                if item is not None:
+                    item._children = None
+
+    def cached_item(self, cls, uid):
+        """Returns an item from the identity map, inside a session.
+        Args:
+            cls (type): the item class
+            uid (str): the UID of the item
+        Returns:
+            rtlibs.conquest.items.ConquestItem: the item, or None if it is not
+            in the identity map or no session is active
+        """
+        if not self.cache_children:
+            return None
+        with self._lock:
+            item = self._items.get((cls, uid))
+            if item is not None:
+                self._touch(item.patient_id)
+        return item
+
+    def _set_children(self, item, children):
+        if self.cache and self.cache_children:
+            item._children = children
+        return children
+
+    def invalidate_patient(self, patient_id):
+        """Drops all cached items and child lists of a patient.
+        Args:
+            patient_id (str): the patient ID
+        """
+        with self._lock:
+            for key in self._patient_items.pop(patient_id, ()):
+                item = self._items.pop(key, None)
+                if item is not None:
+                    item._children = None
+
+    def clear_cache(self):
+        """Drops all cached items and child lists."""
+        with self._lock:
+            for item in self._items.values():
+                item._children = None
+            self._items = {}
+            self._patient_items = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def session(self):
+        """Context manager that serves loaded items and child lists from
+        memory while it is active, for all threads using the connection, and
+        drops them afterwards. Changes made by others during the session are
+        only seen for items that were not loaded yet.
+        """
+        cache, cache_children = self.cache, self.cache_children
+        self.clear_cache()
+        self.cache = self.cache_children = True
+        try:
+            yield self
+        finally:
+            self.cache, self.cache_children = cache, cache_children
+            self.clear_cache()
+
+    def query(self, cls, page_size=500):
+        """Starts a query for items of a class.
+        Args:
+            cls (type): the item class, e.g. rtlibs.conquest.items.ConquestSeries
+            page_size (int): the number of rows fetched at a time
+        Returns:
+            conquestdb.ConquestQuery: the query, without filters
+        """
+        return ConquestQuery(self, cls, page_size)
+
+    # Retrieving single items
+
+    def get_patients(self):
+        """Retrieves all patients.
+        Returns:
+            list: all rtlibs.conquest.items.ConquestPatient objects
+        """
+        rows = self.fetch_rows(PATIENT_QUERY + " ORDER BY p.PatientID")
+        return [self.create_item(ConquestPatient, row) for row in rows]
+
+    def get_patient(self, patient_id):
+        """Retrieves a patient.
+        Args:
+            patient_id (str): the patient ID
+        Returns:
+            rtlibs.conquest.items.ConquestPatient: the patient, or None if it
+            does not exist
+        """
+        item = self.cached_item(ConquestPatient, patient_id)
+        if item is not None:
+            return item
+        row = self.fetch_row(PATIENT_QUERY + " WHERE p.PatientID = ?",
+                             (patient_id,))
+        if row is None:
+            return None
+        return self.create_item(ConquestPatient, row)
+
+    def get_study(self, study_uid):
+        """Retrieves a study.
+        Args:
+            study_uid (str): the study UID
+        Returns:
+            rtlibs.conquest.items.ConquestStudy: the study, or None if it does
+            not exist
+        """
+        item = self.cached_item(ConquestStudy, study_uid)
+        if item is not None:
+            return item
+        row = self.fetch_row(STUDY_QUERY + " WHERE st.StudyInsta = ?",
+                             (study_uid,))
+        if row is None:
+            return None
+        return self.create_item(ConquestStudy, row)
+
+    def get_series(self, series_uid):
+        """Retrieves a series.
+        Args:
+            series_uid (str): the series UID
+        Returns:
+            rtlibs.conquest.items.ConquestSeries: the series, or None if it
+            does not exist
+        """
+        item = self.cached_item(ConquestSeries, series_uid)
+        if item is not None:
+            return item
+        row = self.fetch_row(SERIES_QUERY + " WHERE se.SeriesInst = ?",
+                             (series_uid,))
+        if row is None:
+            return None
+        return self.create_item(ConquestSeries, row)
+
+    def get_instance(self, instance_uid):
+        """Retrieves an instance.
+        Args:
+            instance_uid (str): the instance UID
+        Returns:
+            rtlibs.conquest.items.ConquestInstance: the instance, or None if it
+            does not exist
+        """
+        item = self.cached_item(ConquestInstance, instance_uid)
+        if item is not None:
+            return item
+        row = self.fetch_row(INSTANCE_QUERY + " WHERE i.SOPInstanc = ?",
+                             (instance_uid,))
+        if row is None:
+            return None
+        return self.create_item(ConquestInstance, row)
+
+    # Retrieving child items
+
+    def get_studies_for_patient(self, patient):
+        """Retrieves the studies of a patient.
+        Args:
+            patient (rtlibs.conquest.items.ConquestPatient): the patient
+        Returns:
+            list: the rtlibs.conquest.items.ConquestStudy objects
+        """
+        children = patient._children
+        if self.cache_children and children is not None:
+            return children
+        rows = self.get_study_rows_for_patient(patient.patient_id)
+        return self._set_children(
+            patient, [self.create_item(ConquestStudy, row, patient)
+                      for row in rows])
+
+    def get_series_for_study(self, study):
+        """Retrieves the series of a study.
+        Args:
+            study (rtlibs.conquest.items.ConquestStudy): the study
+        Returns:
+            list: the rtlibs.conquest.items.ConquestSeries objects
+        """
+        children = study._children
+        if self.cache_children and children is not None:
+            return children
+        rows = self.fetch_rows(
+            SERIES_QUERY + " WHERE se.StudyInsta = ?" + SERIES_ORDER,
+            (study.study_uid,))
+        return self._set_children(
+            study, [self.create_item(ConquestSeries, row, study)
+                    for row in rows])
+
+    def get_instances_for_series(self, series):
+        """Retrieves the instances of a series.
+        Args:
+            series (rtlibs.conquest.items.ConquestSeries): the series
+        Returns:
+            list: the rtlibs.conquest.items.ConquestInstance objects
+        """
+        children = series._children
+        if self.cache_children and children is not None:
+            return children
+        rows = self.fetch_rows(
+            INSTANCE_QUERY + " WHERE i.SeriesInst = ?" + INSTANCE_ORDER,
+            (series.series_uid,))
+        return self._set_children(
+            series, [self.create_item(ConquestInstance, row, series)
+                     for row in rows])
+
+    def get_instance_uids_for_series(self, series):
+        """Retrieves the instance UIDs of a series, in the same order as
+        get_instances_for_series, without creating the instances.
+        Args:
+            series (rtlibs.conquest.items.ConquestSeries): the series
+        Returns:
+            list: the instance UIDs
+        """
+        cursor = self.execute(
+            "SELECT i.SOPInstanc FROM DICOMImages i WHERE i.SeriesInst = ?" +
+            INSTANCE_ORDER, (series.series_uid,))
+        return [row[0] for row in cursor]
+
+    def count_instances_for_series(self, series):
+        """Counts the instances of a series.
+        Args:
+            series (rtlibs.conquest.items.ConquestSeries): the series
+        Returns:
+            int: the number of instances
+        """
+        cursor = self.execute(
+            "SELECT COUNT(*) FROM DICOMImages WHERE SeriesInst = ?",
+            (series.series_uid,))
+        return cursor.fetchone()[0]
+
+    def get_first_instance_for_series(self, series):
+        """Retrieves the first instance of a series.
+        Args:
+            series (rtlibs.conquest.items.ConquestSeries): the series
+        Returns:
+            rtlibs.conquest.items.ConquestInstance: the first instance, or None
+            if the series has no instances
+        """
+        row = self.fetch_row(
+            INSTANCE_QUERY + " WHERE i.SeriesInst = ?" + INSTANCE_ORDER,
+            (series.series_uid,))
+        if row is None:
+            return None
+        return self.create_item(ConquestInstance, row, series)
+
+    def get_ordered_instance_uids_for_series(self, series):
+        """Retrieves the instance UIDs of a series, sorted by slice location
+        when present, otherwise by image number.
+        Args:
+            series (rtlibs.conquest.items.ConquestSeries): the series
+        Returns:
+            list: the instance UIDs
+        """
+        cursor = self.execute(
+            "SELECT SOPInstanc FROM DICOMImages WHERE SeriesInst = ? ORDER BY "
+            "CASE WHEN SliceLocat IS NULL OR SliceLocat = '' THEN 1 ELSE 0 END, "
+            "CAST(SliceLocat AS REAL), CAST(ImageNumbe AS INTEGER)",
+            (series.series_uid,))
+        return [row[0] for row in cursor]
+
+    # Series geometry cache
+
+    def get_series_orientation(self, series_uid):
+        """Retrieves the cached image orientation of a series.
+        Args:
+            series_uid (str): the series UID
+        Returns:
+            tuple: the six direction cosines, an empty tuple if the series is
+            known to have no orientation, or None if it is not cached
+        """
+        row = self.execute(
+            "SELECT Orientation FROM SeriesGeometry WHERE SeriesInst = ?",
+            (series_uid,)).fetchone()
+        if row is None:
+            return None
+        return _decode_orientation(row[0])
+
+    def set_series_orientation(self, series_uid, orientation):
+        """Caches the image orientation of a series.
+        Args:
+            series_uid (str): the series UID
+            orientation (tuple): the six direction cosines, or None if the
+                series has no orientation
+        """
+        with self._write():
+            self.execute(
+                "INSERT OR REPLACE INTO SeriesGeometry (SeriesInst, Orientation) "
+                "VALUES (?, ?)", (series_uid, _encode_orientation(orientation)))
+
+    def set_series_orientations(self, orientations):
+        """Caches the image orientations of many series in one transaction.
+        Args:
+            orientations (dict): the six direction cosines (or None) by series
+                UID
+        """
+        values = [(uid, _encode_orientation(o))
+                  for uid, o in orientations.items()]
+        with self._write():
+            self.executemany(
+                "INSERT OR REPLACE INTO SeriesGeometry (SeriesInst, Orientation) "
+                "VALUES (?, ?)", values)
+
+    def get_series_geometry_rows(self, modalities):
+        """Retrieves, for all series of the given modalities, the patient ID,
+        the cached orientation and the file of the first instance.
+        Args:
+            modalities (list): the modalities
+        Returns:
+            list: (series UID, patient ID, modality, orientation, object file)
+            tuples; the orientation is as returned by get_series_orientation
+        """
+        cursor = self.execute(
+            "SELECT se.SeriesInst, se.SeriesPat, se.Modality, g.Orientation, "
+            "(SELECT i.ObjectFile FROM DICOMImages i "
+            "WHERE i.SeriesInst = se.SeriesInst" + INSTANCE_ORDER + " LIMIT 1) "
+            "FROM DICOMSeries se LEFT JOIN SeriesGeometry g "
+            "ON g.SeriesInst = se.SeriesInst WHERE se.Modality IN ({0}) "
+            "ORDER BY se.SeriesPat, se.SeriesInst".format(
+                ", ".join("?" * len(modalities))), modalities)
+        return [(series_uid, patient_id, modality,
+                 _decode_orientation(orientation), object_file)
+                for series_uid, patient_id, modality, orientation, object_file
+                in cursor]
+
+    # Summary tables
+
+    def rebuild_summaries(self):
+        """Recomputes the summary tables from scratch, e.g. for a database
+        that was filled without the summary triggers.
+        """
+        with self.db:
+            self.execute("DELETE FROM SeriesSummary")
+            self.execute("DELETE FROM StudySummary")
+            self.execute("DELETE FROM PatientSummary")
+            self.execute(
+                "INSERT INTO SeriesSummary SELECT se.SeriesInst, se.StudyInsta, "
+                "se.SeriesPat, (SELECT COUNT(*) FROM DICOMImages i "
+                "WHERE i.SeriesInst = se.SeriesInst), "
+                "(SELECT COALESCE(SUM(Bytes), 0) FROM ImageSizes z "
+                "WHERE z.SeriesInst = se.SeriesInst) FROM DICOMSeries se")
+            self.execute(
+                "INSERT INTO StudySummary (StudyInsta, PatientID) "
+                "SELECT StudyInsta, PatientID FROM DICOMStudies")
+            self.execute(STUDY_SUMMARY_UPDATE.format("StudySummary.StudyInsta"))
+            self.execute(
+                "INSERT INTO PatientSummary (PatientID) "
+                "SELECT PatientID FROM DICOMPatients")
+            self.execute(
+                PATIENT_SUMMARY_UPDATE.format("PatientSummary.PatientID"))
+
+    def set_file_sizes(self, sizes):
+        """Stores the file sizes of instances, which are added to the total
+        bytes of their series, study and patient.
+        Args:
+            sizes (dict): the size in bytes by instance UID
+        """
+        with self._write():
+            self.executemany(
+                "INSERT OR REPLACE INTO ImageSizes (SOPInstanc, SeriesInst, "
+                "Bytes) SELECT SOPInstanc, SeriesInst, ? FROM DICOMImages "
+                "WHERE SOPInstanc = ?",
+                [(size, uid) for uid, size in sizes.items()])
+
+    def update_file_sizes(self, workers=16):
+        """Determines the file sizes of all instances whose size is not known
+        yet, reading the file system with a pool of worker threads.
+        Returns:
+            int: the number of files whose size was stored
+        """
+        rows = self.execute(
+            "SELECT i.SOPInstanc, i.ObjectFile FROM DICOMImages i "
+            "LEFT JOIN ImageSizes z ON z.SOPInstanc = i.SOPInstanc "
+            "WHERE z.SOPInstanc IS NULL").fetchall()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            sizes = executor.map(
+                _file_size,
+                [os.path.join(self.data_path, row[1] or "") for row in rows])
+            sizes = dict((row[0], size) for row, size in zip(rows, sizes)
+                         if size is not None)
+        self.set_file_sizes(sizes)
+        return len(sizes)
+
+    # Change feed
+
+    def change_token(self):
+        """Returns the token of the latest change, from which a consumer that
+        starts now can follow the changes.
+        Returns:
+            int: the token, 0 if nothing has changed yet
+        """
+        row = self.execute("SELECT seq FROM sqlite_sequence "
+                           "WHERE name = 'ChangeLog'").fetchone()
+        return 0 if row is None else row[0]
+
+    def changes_since(self, token=0, kinds=None, limit=None):
+        """Retrieves the changes after a token, oldest first. A consumer passes
+        the token of the last change it processed to get only the new ones.
+        Args:
+            token (int): the token of the last processed change
+            kinds (list): if given, only changes of these kinds are returned
+            limit (int): the maximum number of changes
+        Returns:
+            list: the conquestdb.Change tuples
+        """
+        query = ("SELECT Token, Time, Action, Kind, Uid, PatientID, StudyInsta, "
+                 "SeriesInst FROM ChangeLog WHERE Token > ?")
+        parameters = [token]
+        if kinds:
+            query += " AND Kind IN ({0})".format(", ".join("?" * len(kinds)))
+            parameters += list(kinds)
+        query += " ORDER BY Token"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+        return [Change(*row) for row in self.execute(query, parameters)]
+
+    def prune_changes(self, token):
+        """Deletes the changes up to a token, once all consumers have processed
+        them. Tokens are not reused.
+        Args:
+            token (int): the token of the last change to delete
+        """
+        with self.db:
+            self.execute("DELETE FROM ChangeLog WHERE Token <= ?", (token,))
+
+    def record_new_files(self, paths):
+        """Logs files without database row as changes of kind "file", unless
+        they were logged before (and not pruned since).
+        Args:
+            paths (iterable): the paths, relative to the data path with forward
+                slashes
+        Returns:
+            list: the paths that were logged
+        """
+        recorded = []
+        with self.db:
+            for path in paths:
+                if self.execute(
+                        "SELECT 1 FROM ChangeLog WHERE Kind = 'file' AND "
+                        "Uid = ?", (path,)).fetchone() is None:
+                    self.execute(
+                        "INSERT INTO ChangeLog (Time, Action, Kind, Uid) "
+                        "VALUES ({0}, 'insert', 'file', ?)".format(SQL_NOW),
+                        (path,))
+                    recorded.append(path)
+        return recorded
+
+    # Search
+
+    def rebuild_search_index(self):
+        """Rebuilds the search index from scratch, e.g. for a database that
+        was filled without the search triggers.
+        """
+        with self.db:
+            self.execute("DELETE FROM SearchIndex")
+            self.execute("DELETE FROM SearchKeys")
+            for table, _, kind, uid, text in SEARCH_TABLES:
+                self.execute(
+                    "INSERT INTO SearchKeys (Kind, Uid) SELECT ?, {0} "
+                    "FROM {1}".format(uid, table), (kind,))
+                self.execute(
+                    "INSERT INTO SearchIndex (rowid, Text) SELECT k.DocId, "
+                    "{0} FROM SearchKeys k JOIN {1} t ON t.{2} = k.Uid "
+                    "WHERE k.Kind = ?".format(text.format("t"), table, uid),
+                    (kind,))
+            self.execute("INSERT INTO SearchIndex (SearchIndex) "
+                         "VALUES ('optimize')")
+
+    def _items_by_uid(self, uids):
+        # Loads the items for (class, UID) pairs, in the same order
+        by_class = collections.defaultdict(list)
+        for cls, uid in uids:
+            by_class[cls].append(uid)
+        items = {}
+        for cls, class_uids in by_class.items():
+            for item in self.query(cls).uids(class_uids):
+                items[(cls, item.item_uid)] = item
+        return [items[key] for key in uids if key in items]
+
+    def search(self, text, cls=None, limit=50):
+        """Searches patients by name or ID, and studies and series by
+        description. Every word of the text must match the start of a word of
+        the item, ignoring case and accents.
+        Args:
+            text (str): the search text, e.g. "smi jo" or "thorax"
+            cls (type): if given, only items of this class
+                (rtlibs.conquest.items.ConquestPatient, ConquestStudy or
+                ConquestSeries) are returned
+            limit (int): the maximum number of items
+        Returns:
+            list: the rtlibs.conquest.items.ConquestItem objects, best matches
+            first
+        """
+        expression = _match_expression(text)
+        if not expression:
+            return []
+        kinds = dict((kind, table_class)
+                     for _, table_class, kind, _, _ in SEARCH_TABLES
+                     if cls is None or table_class is cls)
+        cursor = self.execute(
+            "SELECT k.Kind, k.Uid FROM SearchIndex "
+            "JOIN SearchKeys k ON k.DocId = SearchIndex.rowid "
+            "WHERE SearchIndex MATCH ? AND k.Kind IN ({0}) "
+            "ORDER BY rank LIMIT ?".format(", ".join("?" * len(kinds))),
+            [expression] + list(kinds) + [limit])
+        return self._items_by_uid([(kinds[kind], uid) for kind, uid in cursor])
+
+    def search_uid(self, prefix, cls=None, limit=50):
+        """Finds the items whose UID (patient ID for patients) starts with a
+        prefix, using the primary key of each table.
+        Args:
+            prefix (str): the start of the UID
+            cls (type): if given, only items of this class are returned
+            limit (int): the maximum number of items
+        Returns:
+            list: the rtlibs.conquest.items.ConquestItem objects, patients
+            first and sorted by UID within each class
+        """
+        if not prefix:
+            return []
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        uids = []
+        for table_class, table, column in UID_TABLES:
+            if (cls is not None and table_class is not cls) or \
+                    len(uids) >= limit:
+                continue
+            cursor = self.execute(
+                "SELECT {0} FROM {1} WHERE {0} >= ? AND {0} < ? "
+                "ORDER BY {0} LIMIT ?".format(column, table),
+                (prefix, end, limit - len(uids)))
+            uids += [(table_class, row[0]) for row in cursor]
+        return self._items_by_uid(uids)
+
+    # Bulk retrieval of rows
+
+    def iter_instance_files(self):
+        """Iterates over the files of all instances, sorted by their path with
+        forward slashes as separators. The rows are read from an index and not
+        collected, so archives of any size can be iterated in bounded memory.
+        Yields:
+            tuple: (path with forward slashes, instance UID, series UID, study
+            UID, patient ID); the study UID is None if the series is missing
+        """
+        rows = self.iterate(
+            "SELECT replace(i.ObjectFile, '\\', '/') AS path, i.SOPInstanc, "
+            "i.SeriesInst, se.StudyInsta, i.ImagePat FROM DICOMImages i "
+            "LEFT JOIN DICOMSeries se ON se.SeriesInst = i.SeriesInst "
+            "WHERE i.ObjectFile IS NOT NULL AND i.ObjectFile != '' "
+            "ORDER BY replace(i.ObjectFile, '\\', '/')")
+        for row in rows:
+            yield tuple(row)
+
+    def get_study_rows_for_patient(self, patient_id):
+        """Retrieves the rows of all studies of a patient.
+        Args:
+            patient_id (str): the patient ID
+        Returns:
+            list: the study rows
+        """
+        return self.fetch_rows(
+            STUDY_QUERY + " WHERE st.PatientID = ?" + STUDY_ORDER,
+            (patient_id,))
+
+    def get_series_rows_for_patient(self, patient_id):
+        """Retrieves the rows of all series of a patient.
+        Args:
+            patient_id (str): the patient ID
+        Returns:
+            list: the series rows
+        """
+        return self.fetch_rows(
+            SERIES_QUERY + " WHERE se.SeriesPat = ?" + SERIES_ORDER,
+            (patient_id,))
+
+    def get_instance_rows_for_patient(self, patient_id, columns=None):
+        """Retrieves the rows of all instances of a patient.
+        Args:
+            patient_id (str): the patient ID
+            columns (list): if given, only these columns are retrieved
+        Returns:
+            list: the instance rows
+        """
+        if columns is None:
+            return self.fetch_rows(
+                INSTANCE_QUERY + " WHERE i.ImagePat = ?" + INSTANCE_ORDER,
+                (patient_id,))
+        cursor = self.execute(
+            "SELECT {0} FROM DICOMImages i WHERE i.ImagePat = ?{1}".format(
+                ", ".join("i." + c for c in columns), INSTANCE_ORDER),
+            (patient_id,))
+        return [dict(zip(columns, row)) for row in cursor]
+
+    # Adding items
+
+    def _insert(self, table, columns, data):
+        values = [data.get(c) for c in columns]
+        self.execute(
+            "INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})".format(
+                table, ", ".join(columns), ", ".join("?" * len(columns))),
+            values)
+
+    def add_patient(self, data):
+        """Adds or replaces a patient row.
+        Args:
+            data (dict): the patient row
+        """
+        self._insert("DICOMPatients", PATIENT_COLUMNS, data)
+        self.invalidate_patient(data['PatientID'])
+
+    def add_study(self, data):
+        """Adds or replaces a study row.
+        Args:
+            data (dict): the study row
+        """
+        self._insert("DICOMStudies", STUDY_COLUMNS, data)
+        self.invalidate_patient(data['PatientID'])
+
+    def add_series(self, data):
+        """Adds or replaces a series row.
+        Args:
+            data (dict): the series row
+        """
+        self._insert("DICOMSeries", SERIES_COLUMNS, data)
+        self.invalidate_patient(data['SeriesPat'])
+
+    def add_instance(self, data):
+        """Adds or replaces an instance row. The size of its file is taken from
+        the FileSize value of the row, or from the file if it exists.
+        Args:
+            data (dict): the instance row
+        """
+        self._insert("DICOMImages", INSTANCE_COLUMNS, data)
+        size = data.get('FileSize')
+        if size is None and data.get('ObjectFile'):
+            size = _file_size(os.path.join(self.data_path, data['ObjectFile']))
+        if size is not None:
+            self.execute(
+                "INSERT OR REPLACE INTO ImageSizes (SOPInstanc, SeriesInst, "
+                "Bytes) VALUES (?, ?, ?)",
+                (data['SOPInstanc'], data['SeriesInst'], size))
+        self.invalidate_patient(data['ImagePat'])
+
+    def commit(self):
+        """Commits the current transaction of the thread, and returns its
+        connection to the pool.
+        """
+        if self.pool.in_transaction():
+            self.pool.connection().commit()
+        self.pool.release_idle()
+
+    def rollback(self):
+        """Rolls back the current transaction of the thread, and returns its
+        connection to the pool.
+        """
+        if self.pool.in_transaction():
+            self.pool.connection().rollback()
+        self.pool.release_idle()
+
+    # Deleting items
+
+    def _invalidate_owner(self, query, uid):
+        # Drops the cache of the patient that owns the item with the given UID
+        row = self.execute(query, (uid,)).fetchone()
+        if row is not None:
+            self.invalidate_patient(row[0])
+
+    def _delete_files(self, where, parameters):
+        cursor = self.execute(
+            "SELECT i.ObjectFile FROM DICOMImages i WHERE " + where, parameters)
+        for row in cursor.fetchall():
+            try:
+                os.remove(os.path.join(self.data_path, row[0]))
+            except OSError:
+                pass
+
+    def delete_patient(self, patient_id):
+        """Deletes all DICOM files and database records of a patient.
+        Args:
+            patient_id (str): the patient ID
+        """
+        self.invalidate_patient(patient_id)
+        self._delete_files("i.ImagePat = ?", (patient_id,))
+        with self.db:
+            self.execute("DELETE FROM DICOMImages WHERE ImagePat = ?",
+                         (patient_id,))
+            self.execute("DELETE FROM SeriesGeometry WHERE SeriesInst IN "
+                         "(SELECT SeriesInst FROM DICOMSeries "
+                         "WHERE SeriesPat = ?)", (patient_id,))
+            self.execute("DELETE FROM DICOMSeries WHERE SeriesPat = ?",
+                         (patient_id,))
+            self.execute("DELETE FROM DICOMStudies WHERE PatientID = ?",
+                         (patient_id,))
+            self.execute("DELETE FROM DICOMPatients WHERE PatientID = ?",
+                         (patient_id,))
+
+    def delete_study(self, study_uid):
+        """Deletes all DICOM files and database records of a study.
+        Args:
+            study_uid (str): the study UID
+        """
+        self._invalidate_owner(
+            "SELECT PatientID FROM DICOMStudies WHERE StudyInsta = ?",
+            study_uid)
+        series_query = "SELECT SeriesInst FROM DICOMSeries WHERE StudyInsta = ?"
+        self._delete_files("i.SeriesInst IN (" + series_query + ")",
+                           (study_uid,))
+        with self.db:
+            self.execute("DELETE FROM DICOMImages WHERE SeriesInst IN (" +
+                         series_query + ")", (study_uid,))
+            self.execute("DELETE FROM SeriesGeometry WHERE SeriesInst IN (" +
+                         series_query + ")", (study_uid,))
+            self.execute("DELETE FROM DICOMSeries WHERE StudyInsta = ?",
+                         (study_uid,))
+            self.execute("DELETE FROM DICOMStudies WHERE StudyInsta = ?",
+                         (study_uid,))
+
+    def delete_series(self, series_uid):
+        """Deletes all DICOM files and database records of a series.
+        Args:
+            series_uid (str): the series UID
+        """
+        self._invalidate_owner(
+            "SELECT SeriesPat FROM DICOMSeries WHERE SeriesInst = ?",
+            series_uid)
+        self._delete_files("i.SeriesInst = ?", (series_uid,))
+        with self.db:
+            self.execute("DELETE FROM DICOMImages WHERE SeriesInst = ?",
+                         (series_uid,))
+            self.execute("DELETE FROM SeriesGeometry WHERE SeriesInst = ?",
+                         (series_uid,))
+            self.execute("DELETE FROM DICOMSeries WHERE SeriesInst = ?",
+                         (series_uid,))
+
+    def delete_instance(self, instance_uid):
+        """Deletes the DICOM file and database record of an instance.
+        Args:
+            instance_uid (str): the instance UID
+        """
+        self._invalidate_owner(
+            "SELECT ImagePat FROM DICOMImages WHERE SOPInstanc = ?",
+            instance_uid)
+        self._delete_files("i.SOPInstanc = ?", (instance_uid,))
+        with self.db:
+            self.execute("DELETE FROM DICOMImages WHERE SOPInstanc = ?",
+                         (instance_uid,))
+
+    def _select_uids(self, query, *clauses):
+        # Runs a query for UIDs with the OR of IN clauses; returns the rows
+        where = []
+        parameters = []
+        for expression, values in clauses:
+            if values:
+                clause, values = _in_clause(expression, values)
+                where.append(clause)
+                parameters += values
+        if not where:
+            return []
+        return self.execute(query + " WHERE " + " OR ".join(where),
+                            parameters).fetchall()
+
+    def delete_items(self, items, dry_run=False, workers=8):
+        """Deletes many patients, studies, series and instances with all their
+        subitems. The database records are deleted in a single transaction;
+        after it has been committed, the DICOM files are removed by a pool of
+        worker threads.
+        Args:
+            items (list): the rtlibs.conquest.items.ConquestItem objects to
+                delete
+            dry_run (bool): if True, nothing is deleted; the report tells what
+                would be deleted
+            workers (int): the number of worker threads removing files
+        Returns:
+            conquestdb.DeleteReport: the numbers of deleted records and files,
+            and the number of bytes freed
+        """
+        uids = dict((cls, set()) for cls in UID_COLUMNS)
+        for item in items:
+            uids[item_class(item)].add(item.item_uid)
+
+        patient_ids = [row[0] for row in self._select_uids(
+            "SELECT PatientID FROM DICOMPatients",
+            ("PatientID", uids[ConquestPatient]))]
+        study_rows = self._select_uids(
+            "SELECT StudyInsta, PatientID FROM DICOMStudies",
+            ("StudyInsta", uids[ConquestStudy]), ("PatientID", patient_ids))
+        study_uids = [row[0] for row in study_rows]
+        series_rows = self._select_uids(
+            "SELECT SeriesInst, SeriesPat FROM DICOMSeries",
+            ("SeriesInst", uids[ConquestSeries]), ("StudyInsta", study_uids),
+            ("SeriesPat", patient_ids))
+        series_uids = [row[0] for row in series_rows]
+        instance_rows = self._select_uids(
+            "SELECT SOPInstanc, ImagePat, ObjectFile FROM DICOMImages",
+            ("SOPInstanc", uids[ConquestInstance]),
+            ("SeriesInst", series_uids), ("ImagePat", patient_ids))
+        instance_uids = [row[0] for row in instance_rows]
+        filepaths = [os.path.join(self.data_path, row[2])
+                     for row in instance_rows if row[2]]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            if dry_run:
+                sizes = list(executor.map(_file_size, filepaths))
+            else:
+                owners = set(patient_ids)
+                owners.update(row[1] for row in study_rows)
+                owners.update(row[1] for row in series_rows)
+                owners.update(row[1] for row in instance_rows)
+                for patient_id in owners:
+                    self.invalidate_patient(patient_id)
+                with self.db:
+                    for table, column, values in [
+                            ("DICOMImages", "SOPInstanc", instance_uids),
+                            ("SeriesGeometry", "SeriesInst", series_uids),
+                            ("DICOMSeries", "SeriesInst", series_uids),
+                            ("DICOMStudies", "StudyInsta", study_uids),
+                            ("DICOMPatients", "PatientID", patient_ids)]:
+                        if values:
+                            clause, parameters = _in_clause(column, values)
+                            self.execute("DELETE FROM {0} WHERE {1}".format(
+                                table, clause), parameters)
+                sizes = list(executor.map(_remove_file, filepaths))
+
+        return DeleteReport(
+            len(patient_ids), len(study_uids), len(series_uids),
+            len(instance_uids), sum(1 for size in sizes if size is not None),
+            sum(size for size in sizes if size is not None))
+
+
+def _date_value(value):
+    # Accepts DICOM date strings as well as datetime.date objects
+    if hasattr(value, 'strftime'):
+        return value.strftime("%Y%m%d")
+    return value
+
+
+def _in_clause(expression, values):
+    # Returns an IN clause and its parameters for a set of values
+    values = list(values)
+    if len(values) <= MAX_INLINE_VALUES:
+        return "{0} IN ({1})".format(
+            expression, ", ".join("?" * len(values))), values
+    return "{0} IN (SELECT value FROM json_each(?))".format(expression), \
+        [json.dumps(values)]
+
+
+def _like_pattern(pattern):
+    # Translates a pattern with * and ? wildcards into a LIKE pattern
+    pattern = pattern.replace("\\", "\\\\").replace("%", "\\%") \
+        .replace("_", "\\_")
+    return pattern.replace("*", "%").replace("?", "_")
+
+
+class ConquestQuery(object):
+    """Query for Conquest patients, studies, series or instances, translated
+    into a single SQL query. The filter methods return a new query, so queries
+    can be built step by step and reused:
+
+        doses = conn.query(ConquestSeries).modality('RTDOSE') \\
+            .date_range('20200101', '20201231')
+        for series in doses.patients(patient_ids):
+            ...
+
+    Iterating over a query fetches the rows page by page from a single
+    cursor, so only one page of rows is held in memory at a time.
+    Args:
+        conn (conquestdb.ConquestDatabaseConnection): the connection to query
+        cls (type): the item class, e.g. rtlibs.conquest.items.ConquestSeries
+        page_size (int): the number of rows fetched at a time
+    """
+    def __init__(self, conn, cls, page_size=500):
+        if cls not in QUERY_TABLES:
+            raise ValueError("Cannot query {0} items".format(cls.__name__))
+        self.conn = conn
+        self.cls = cls
+        self.page_size = page_size
+        self.table = QUERY_TABLES[cls]
+        self._clauses = []
+        self._parameters = []
+        self._order = list(self.table.order)
+        self._limit = None
+        self._offset = 0
+
+    def _field(self, name):
+        try:
+            return self.table.fields[name]
+        except KeyError:
+            raise ValueError("{0} items have no field {1}".format(
+                self.cls.__name__, name))
+
+    def _where(self, clause, parameters):
+        query = copy.copy(self)
+        query._clauses = self._clauses + [clause]
+        query._parameters = self._parameters + list(parameters)
+        return query
+
+    def filter(self, field, values):
+        """Restricts the query to items with one of the given values of a
+        field.
+        Args:
+            field (str): the field name, e.g. 'uid', 'patient_id' or
+                'study_uid'
+            values (iterable): the values
+        Returns:
+            conquestdb.ConquestQuery: the new query
+        """
+        return self._where(*_in_clause(self._field(field), values))
+
+    def uids(self, uids):
+        """Restricts the query to the items with the given UIDs (patient IDs
+        for patients).
+        Args:
+            uids (iterable): the UIDs
+        Returns:
+            conquestdb.ConquestQuery: the new query
+        """
+        return self.filter('uid', uids)
+
+    def patients(self, patient_ids):
+        """Restricts the query to the items of the given patients.
+        Args:
+            patient_ids (iterable): the patient IDs
+        Returns:
+            conquestdb.ConquestQuery: the new query
+        """
+        return self.filter('patient_id', patient_ids)
+
+    def studies(self, study_uids):
+        """Restricts the query to the items of the given studies.
+        Args:
+            study_uids (iterable): the study UIDs
+        Returns:
+            conquestdb.ConquestQuery: the new query
+        """
+        return self.filter('study_uid', study_uids)
+
+    def series(self, series_uids):
+        """Restricts the query to the items of the given series.
+        Args:
+            series_uids (iterable): the series UIDs
+        Returns:
+            conquestdb.ConquestQuery: the new query
+        """
+        return self.filter('series_uid', series_uids)
+
+    def modality(self, *modalities):
+        """Restricts the query to the given modalities. Patients and studies
+        match if any of their series has one of the modalities.
+        Args:
+            modalities (str): the modalities, e.g. 'CT', 'RTDOSE'
+        Returns:
+            conquestdb.ConquestQuery: the new query
+        """
+        if self.cls in MODALITY_FILTERS:
+            return self._where(
+                MODALITY_FILTERS[self.cls].format(
+                    ", ".join("?" * len(modalities))), modalities)
+        return self.filter('modality', modalities)
+
+    def date_range(self, start=None, end=None):
+        """Restricts the query to items dated within a range, including both
+        ends. The date is the study, series or image date, or the date of birth
+        for patients.
+        Args:
+            start (str or datetime.date): the first date (YYYYMMDD), or None
+                for no lower bound
+            end (str or datetime.date): the last date (YYYYMMDD), or None for
+                no upper bound
+        Returns:
+            conquestdb.ConquestQuery: the new query
+        """
+        query = self
+        field = self._field('date')
+        if start is not None:
+            query = query._where(field + " >= ?", [_date_value(start)])
+        if end is not None:
+            query = query._where(field + " <= ?", [_date_value(end)])
+        return query
+
+    def description(self, pattern):
+        """Restricts the query to items with a matching description (the name
+        for patients). The match is case insensitive for ASCII letters.
+        Args:
+            pattern (str): the pattern, with * matching any text and ? any
+                single character
+        Returns:
+            conquestdb.ConquestQuery: the new query
+        """
+        return self._where(self._field('description') + " LIKE ? ESCAPE '\\'",
+                           [_like_pattern(pattern)])
+
+    def order_by(self, *fields):
+        """Sets the order of the results. The UID is always added as the last
+        field, so the order is stable between pages.
+        Args:
+            fields (str): the field names; a leading '-' sorts in descending
+                order, e.g. '-date'
+        Returns:
+            conquestdb.ConquestQuery: the new query
+        """
+        for field in fields:
+            self._field(field.lstrip('-'))
+        query = copy.copy(self)
+        query._order = list(fields)
+        return query
+
+    def limit(self, count, offset=0):
+        """Limits the number of results.
+        Args:
+            count (int): the maximum number of results, or None for no limit
+            offset (int): the number of results to skip
+        Returns:
+            conquestdb.ConquestQuery: the new query
+        """
+        query = copy.copy(self)
+        query._limit = count
+        query._offset = offset
+        return query
+
+    def page(self, number, page_size=None):
+        """Retrieves one page of results.
+        Args:
+            number (int): the page number, starting at 0
+            page_size (int): the number of results per page; defaults to the
+                page size of the query
+        Returns:
+            list: the items on the page
+        """
+        page_size = page_size or self.page_size
+        return list(self.limit(page_size, number * page_size))
+
+    def first(self):
+        """Retrieves the first result.
+        Returns:
+            rtlibs.conquest.items.ConquestItem: the first item, or None if
+            there are no results
+        """
+        for item in self.limit(1, self._offset):
+            return item
+        return None
+
+    def count(self):
+        """Counts the results, ignoring the limit.
+        Returns:
+            int: the number of matching items
+        """
+        query = "SELECT COUNT(*) " + self.table.source + self._where_sql()
+        return self.conn.execute(query, self._parameters).fetchone()[0]
+
+    def _where_sql(self):
+        if not self._clauses:
+            return ""
+        return " WHERE " + " AND ".join(self._clauses)
+
+    def _order_sql(self):
+        terms = []
+        for field in self._order + ['uid']:
+            name = field.lstrip('-')
+            term = self.table.fields[name]
+            if field.startswith('-'):
+                term += " DESC"
+            if term not in terms:
+                terms.append(term)
+        return " ORDER BY " + ", ".join(terms)
+
+    def sql(self):
+        """Returns the SQL query and its parameters.
+        Returns:
+            tuple: the query string and the list of parameters
+        """
+        query = self.table.query + self._where_sql() + self._order_sql()
+        parameters = list(self._parameters)
+        if self._limit is not None or self._offset:
+            query += " LIMIT ? OFFSET ?"
+            parameters += [-1 if self._limit is None else self._limit,
+                           self._offset]
+        return query, parameters
+
+    def __iter__(self):
+        query, parameters = self.sql()
+        data_path = self.conn.data_path
+        for row in self.conn.iterate(query, parameters, self.page_size):
+            row = dict(row)
+            row['data_path'] = data_path
+            yield self.conn.create_item(self.cls, row)
+
+
+def create_synthetic_archive(conn, patients=10, studies=2, series=4,
+                             instances=50, write_files=False, seed=0):
+    """Fills a database with a synthetic archive. Series are CT, MR, RTSTRUCT
+    and RTDOSE in turn; every third CT or MR series is oblique.
+    Args:
+        conn (conquestdb.ConquestDatabaseConnection): the connection to fill
+        patients (int): the number of patients
+        studies (int): the number of studies per patient
+        series (int): the number of series per study
+        instances (int): the number of instances per CT or MR series; other
+            series have a single instance
+        write_files (bool): whether to write small DICOM files to the data
+            path as well (requires pydicom and numpy)
+        seed (int): the seed for the random dates and names
+    """
+    rng = random.Random(seed)
+    modalities = ['CT', 'MR', 'RTSTRUCT', 'RTDOSE']
+    uid_root = "1.2.826.0.1.3680043.8.1200.9."
+    counter = [0]
+
+    def uid():
+        counter[0] += 1
+        return "{0}{1}".format(uid_root, counter[0])
+
+    for p in range(patients):
+        patient_id = "P{0:06d}".format(p)
+        conn.add_patient({
+            'PatientID': patient_id,
+            'PatientNam': "Patient{0}^Test{1}".format(p, rng.randint(0, 99)),
+            'PatientBir': "19{0:02d}{1:02d}{2:02d}".format(
+                rng.randint(20, 99), rng.randint(1, 12), rng.randint(1, 28)),
+            'PatientSex': rng.choice(['M', 'F']),
+        })
+        for s in range(studies):
+            study_uid = uid()
+            study_date = "20{0:02d}{1:02d}{2:02d}".format(
+                rng.randint(10, 23), rng.randint(1, 12), rng.randint(1, 28))
+            study_time = "{0:02d}{1:02d}{2:02d}.000".format(
+                rng.randint(7, 18), rng.randint(0, 59), rng.randint(0, 59))
+            conn.add_study({
+                'StudyInsta': study_uid, 'StudyDate': study_date,
+                'StudyTime': study_time, 'StudyID': str(s + 1),
+                'StudyDescr': "Study {0} of {1}".format(s + 1, patient_id),
+                'PatientID': patient_id,
+            })
+            frame_of_reference = uid()
+            for n in range(series):
+                series_uid = uid()
+                modality = modalities[n % len(modalities)]
+                oblique = modality in ['CT', 'MR'] and n % 3 == 1
+                conn.add_series({
+                    'SeriesInst': series_uid, 'SeriesNumb': str(n + 1),
+                    'SeriesDate': study_date, 'SeriesTime': study_time,
+                    'SeriesDesc': "{0} series {1}{2}".format(
+                        modality, n + 1, " oblique" if oblique else ""),
+                    'Modality': modality, 'PatientPos': 'HFS',
+                    'Manufactur': 'Synthetic', 'ModelName': 'Generator',
+                    'ProtocolNa': 'Protocol {0}'.format(n + 1),
+                    'StationNam': 'STATION1', 'FrameOfRef': frame_of_reference,
+                    'SeriesPat': patient_id, 'StudyInsta': study_uid,
+                })
+                count = instances if modality in ['CT', 'MR'] else 1
+                for k in range(count):
+                    instance_uid = uid()
+                    object_file = os.path.join(
+                        patient_id, "{0}_{1}.dcm".format(series_uid, k + 1))
+                    data = {
+                        'SOPInstanc': instance_uid,
+                        'SOPClassUI': '1.2.840.10008.5.1.4.1.1.2',
+                        'ImageNumbe': str(k + 1), 'ImageDate': study_date,
+                        'ImageTime': study_time, 'AcqDate': study_date,
+                        'AcqTime': study_time,
+                        'SliceLocat': "{0:.1f}".format(-100.0 + 2.5 * k)
+                        if modality in ['CT', 'MR'] else '',
+                        'ImagePat': patient_id, 'SeriesInst': series_uid,
+                        'ObjectFile': object_file,
+                    }
+                    if write_files:
+                        _write_synthetic_file(
+                            os.path.join(conn.data_path, object_file), data,
+                            study_uid, modality, frame_of_reference, oblique)
+                    conn.add_instance(data)
+        conn.commit()
+
+
+def _write_synthetic_file(filepath, data, study_uid, modality,
+                          frame_of_reference, oblique):
+    # Imported here, so the connection itself does not depend on pydicom
+    import numpy
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian
+
+    folder = os.path.dirname(filepath)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = data['SOPClassUI']
+    file_meta.MediaStorageSOPInstanceUID = data['SOPInstanc']
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = data['SOPClassUI']
+    ds.SOPInstanceUID = data['SOPInstanc']
+    ds.Modality = modality
+    ds.PatientID = data['ImagePat']
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = data['SeriesInst']
+    ds.FrameOfReferenceUID = frame_of_reference
+    ds.InstanceNumber = data['ImageNumbe']
+    if modality in ['CT', 'MR']:
+        z = float(data['SliceLocat'])
+        if oblique:
+            ds.ImageOrientationPatient = [1, 0, 0, 0, 0.8660254, -0.5]
+        else:
+            ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.ImagePositionPatient = [-8.0, -8.0, z]
+        ds.SliceLocation = data['SliceLocat']
+        ds.PixelSpacing = [1.0, 1.0]
+        ds.Rows = 16
+        ds.Columns = 16
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = -1024
+        pixels = numpy.full((16, 16), int(data['ImageNumbe']), dtype=numpy.uint16)
+        ds.PixelData = pixels.tobytes()
+    pydicom.dcmwrite(filepath, ds, enforce_file_format=True)
+
+
+if __name__ == "__main__":
+    conn = ConquestDatabaseConnection()
+    start = time.time()
+    create_synthetic_archive(conn, patients=100, studies=3, series=8,
+                             instances=100)
+    print("Created archive in {0:.2f} s".format(time.time() - start))
+    start = time.time()
+    for patient in conn.get_patients():
+        patient.uid_tree
+    print("uid_tree for all patients in {0:.2f} s".format(time.time() - start))
+    instance_uid = conn.get_patients()[0].instances[0].instance_uid
+    for name, search, text in [("search", conn.search, "patient1 test"),
+                               ("search", conn.search, "CT series"),
+                               ("search_uid", conn.search_uid,
+                                instance_uid[:-1])]:
+        start = time.perf_counter()
+        items = search(text)
+        print("{0} {1!r}: {2} items in {3:.2f} ms".format(
+            name, text, len(items), (time.perf_counter() - start) * 1000))
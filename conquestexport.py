@@ -0,0 +1,220 @@
+"""Export of the DICOM files of Conquest patients and studies to a folder.
+The files are laid out by series:
+
+    <destination>/<patient ID>/<study UID>/<series number>_<modality>_<series UID>/
+
+Copies are made by the kernel where possible, without passing the data through
+Python: a reflink (copy on write clone) when the destination is on the same
+file system and supports it, otherwise os.copy_file_range or os.sendfile,
+falling back to a buffered copy. With link=True, files are hard linked instead;
+the exported files are then the archive files themselves, so they must not be
+modified. Several files are copied at the same time by worker threads.
+"""
+import collections
+import ntpath
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from conquest import ConquestPatient, ConquestStudy, ConquestSeries, \
+    ConquestInstance, item_class
+
+# The query filter for the items of each item class
+ITEM_FILTERS = {
+    ConquestPatient: 'patient_id',
+    ConquestStudy: 'study_uid',
+    ConquestSeries: 'series_uid',
+}
+# The ioctl request cloning a file on Linux (FICLONE)
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 1 << 30
+
+# The result of an export: methods counts the files by the way they were
+# copied ("reflink", "copy_file_range", "sendfile", "copy" or "link"), skipped
+# is the number of files that existed already and failed lists the source
+# paths that could not be copied
+ExportReport = collections.namedtuple(
+    "ExportReport", ["files", "bytes", "seconds", "methods", "skipped",
+                     "failed"])
+
+
+def megabytes_per_second(report):
+    """Calculates the export speed.
+    Args:
+        report (conquestexport.ExportReport): the export report
+    Returns:
+        float: the speed in MB/s
+    """
+    if report.seconds <= 0:
+        return 0.0
+    return report.bytes / 1e6 / report.seconds
+
+
+def _kernel_copy(source, target, size):
+    # Copies with the fastest method the platform supports; returns its name
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            return "reflink"
+        except OSError:
+            pass
+    if hasattr(os, "copy_file_range"):
+        try:
+            copied = 0
+            while copied < size:
+                n = os.copy_file_range(source.fileno(), target.fileno(),
+                                       min(size - copied, COPY_CHUNK_SIZE))
+                if n == 0:
+                    break
+                copied += n
+            if copied == size:
+                return "copy_file_range"
+        except OSError:
+            pass
+        source.seek(0)
+        target.seek(0)
+        target.truncate()
+    if hasattr(os, "sendfile"):
+        try:
+            offset = 0
+            while offset < size:
+                n = os.sendfile(target.fileno(), source.fileno(), offset,
+                                min(size - offset, COPY_CHUNK_SIZE))
+                if n == 0:
+                    break
+                offset += n
+            if offset == size:
+                return "sendfile"
+        except OSError:
+            pass
+        source.seek(0)
+        target.seek(0)
+        target.truncate()
+    shutil.copyfileobj(source, target, 1 << 20)
+    return "copy"
+
+
+def copy_file(source_path, target_path, link=False):
+    """Copies or links a file.
+    Args:
+        source_path (str): the path of the file
+        target_path (str): the path of the copy
+        link (bool): whether to create a hard link, when possible
+    Returns:
+        tuple: the size of the file and the method used
+    """
+    if link:
+        try:
+            os.link(source_path, target_path)
+            return os.path.getsize(target_path), "link"
+        except OSError:
+            pass
+    with open(source_path, "rb") as source, open(target_path, "wb") as target:
+        size = os.fstat(source.fileno()).st_size
+        method = _kernel_copy(source, target, size)
+    shutil.copystat(source_path, target_path)
+    return size, method
+
+
+def _export_file(job, link):
+    # Copies a file of an export; returns its size and copy method, or None if
+    # the file could not be copied, removing a partly written copy
+    source_path, target_path = job
+    try:
+        return copy_file(source_path, target_path, link)
+    except OSError:
+        if os.path.lexists(target_path):
+            try:
+                os.remove(target_path)
+            except OSError:
+                pass
+        return None
+
+
+def series_folder(series_row):
+    """Returns the name of the export folder of a series.
+    Args:
+        series_row (dict): the database row of the series
+    Returns:
+        str: the folder name
+    """
+    number = series_row.get('SeriesNumb') or "0"
+    return "{0}_{1}_{2}".format(number, series_row.get('Modality') or "OT",
+                                series_row['SeriesInst'])
+
+
+def export_item(item, destination, link=False, workers=8, overwrite=False):
+    """Exports the DICOM files of a patient, study or series.
+    Args:
+        item (rtlibs.conquest.items.ConquestItem): the patient, study or series
+        destination (str): the destination folder
+        link (bool): whether to hard link the files instead of copying them
+        workers (int): the number of copy threads
+        overwrite (bool): whether to replace existing files; otherwise they
+            are skipped
+    Returns:
+        conquestexport.ExportReport: the numbers of files and bytes, the time
+        taken, the copy methods used, the number of skipped files and the
+        files that could not be copied, e.g. because they are missing
+    """
+    start = time.perf_counter()
+    conn = item.conn
+    field = ITEM_FILTERS[item_class(item)]
+    folders = {}
+    for series in conn.query(ConquestSeries).filter(field, [item.item_uid]):
+        folder = os.path.join(destination, series.patient_id,
+                              series.study_uid, series_folder(series.data))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        folders[series.series_uid] = folder
+
+    jobs = []
+    skipped = 0
+    for instance in conn.query(ConquestInstance).filter(
+            field, [item.item_uid]):
+        # ObjectFile is a Windows path; ntpath splits at both separators
+        target = os.path.join(folders[instance.series_uid],
+                              ntpath.basename(instance.filename))
+        if overwrite and os.path.lexists(target):
+            os.remove(target)
+        elif os.path.lexists(target):
+            skipped += 1
+            continue
+        jobs.append((instance.filepath, target))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda job: _export_file(job, link), jobs))
+    copied = [result for result in results if result is not None]
+    failed = [job[0] for job, result in zip(jobs, results) if result is None]
+    methods = collections.Counter(method for _, method in copied)
+    return ExportReport(len(copied), sum(size for size, _ in copied),
+                        time.perf_counter() - start, dict(methods), skipped,
+                        failed)
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    from conquestdb import ConquestDatabaseConnection, create_synthetic_archive
+
+    folder = tempfile.mkdtemp() if len(sys.argv) < 2 else sys.argv[1]
+    conn = ConquestDatabaseConnection(os.path.join(folder, "conquest.sqlite"),
+                                      os.path.join(folder, "data"))
+    create_synthetic_archive(conn, patients=1, studies=2, series=8,
+                             instances=100, write_files=True)
+    patient = conn.get_patients()[0]
+    for name, link in [("copy", False), ("link", True)]:
+        report = patient.export(os.path.join(folder, "export_" + name),
+                                link=link)
+        print("{0}: {1} files, {2} bytes, {3:.1f} ms, {4:.1f} MB/s, {5}, "
+              "{6} skipped, {7} failed".format(
+                  name, report.files, report.bytes, report.seconds * 1000,
+                  megabytes_per_second(report), report.methods,
+                  report.skipped, len(report.failed)))
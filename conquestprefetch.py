@@ -0,0 +1,133 @@
+"""Pipelined iteration over the instances of a Conquest item and their DICOM
+files.
+Iterating over ConquestPatient.instances and opening every file in turn
+alternates between waiting for the database and waiting for the disk. The
+iterator below overlaps the two: a background thread pages the instance rows
+from the database and hands each file to a pool of reader threads, while the
+caller processes earlier files. At most read_ahead files are read ahead, so
+memory use does not grow with the size of the patient.
+
+    for instance, ds in prefetch_instances(conn, patient, read_ahead=16):
+        ds.save_as(...)
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+
+from conquest import ConquestPatient, ConquestStudy, ConquestSeries, \
+    ConquestInstance, item_class
+
+# The query filter for the instances of each item class
+ITEM_FILTERS = {
+    ConquestPatient: 'patient_id',
+    ConquestStudy: 'study_uid',
+    ConquestSeries: 'series_uid',
+}
+# Marks the end of the instances in the queue
+_DONE = object()
+
+
+def read_dataset(filepath):
+    """Reads a DICOM file, including its pixel data.
+    Args:
+        filepath (str): the path of the file
+    Returns:
+        pydicom.dataset.FileDataset: the dataset
+    """
+    return pydicom.dcmread(filepath, force=True)
+
+
+def _produce(query, executor, read, results, stop):
+    # Pages the instances from the database and starts reading their files;
+    # blocks while the queue holds read_ahead files
+    try:
+        for instance in query:
+            future = executor.submit(read, instance.filepath)
+            while not stop.is_set():
+                try:
+                    results.put((instance, future), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set():
+                future.cancel()
+                return
+        results.put((_DONE, None))
+    except Exception as e:
+        results.put((_DONE, e))
+
+
+def prefetch_instances(conn, item, read_ahead=8, workers=4,
+                       read=read_dataset, page_size=500):
+    """Iterates over the instances of a patient, study or series together with
+    their datasets, reading the files in the background. The instances are in
+    the order of their series and image number.
+    Args:
+        conn (conquestdb.ConquestDatabaseConnection): the connection
+        item (rtlibs.conquest.items.ConquestItem): the patient, study or series
+        read_ahead (int): the maximum number of files read ahead of the caller
+        workers (int): the number of reader threads
+        read (callable): the function reading a file, given its path
+        page_size (int): the number of instance rows fetched at a time
+    Yields:
+        tuple: the rtlibs.conquest.items.ConquestInstance and the result of
+        read for its file; errors of read are raised when the instance is
+        reached
+    """
+    query = conn.query(ConquestInstance, page_size).filter(
+        ITEM_FILTERS[item_class(item)], [item.item_uid])
+    results = queue.Queue(maxsize=read_ahead)
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    producer = threading.Thread(
+        target=_produce, args=(query, executor, read, results, stop),
+        daemon=True)
+    producer.start()
+    try:
+        while True:
+            instance, future = results.get()
+            if instance is _DONE:
+                if future is not None:
+                    raise future
+                break
+            yield instance, future.result()
+    finally:
+        stop.set()
+        while producer.is_alive():
+            try:
+                _, future = results.get(timeout=0.1)
+                if future is not None and hasattr(future, 'cancel'):
+                    future.cancel()
+            except queue.Empty:
+                pass
+        executor.shutdown()
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import time
+
+    from conquestdb import ConquestDatabaseConnection, create_synthetic_archive
+
+    folder = tempfile.mkdtemp()
+    conn = ConquestDatabaseConnection(os.path.join(folder, "conquest.sqlite"),
+                                      os.path.join(folder, "data"))
+    create_synthetic_archive(conn, patients=1, studies=2, series=8,
+                             instances=100, write_files=True)
+    patient = conn.get_patients()[0]
+
+    start = time.perf_counter()
+    count = 0
+    for instance in patient.instances:
+        read_dataset(instance.filepath)
+        count += 1
+    print("sequential {0} files {1:8.1f} ms".format(
+        count, (time.perf_counter() - start) * 1000))
+
+    start = time.perf_counter()
+    count = sum(1 for _ in prefetch_instances(conn, patient, read_ahead=16))
+    print("prefetch   {0} files {1:8.1f} ms".format(
+        count, (time.perf_counter() - start) * 1000))
@@ -0,0 +1,336 @@
+"""Archive-wide scans of a Conquest database and its DICOM files.
+
+Finding all oblique series:
+
+    python conquestscan.py oblique C:\\Conquest\\data\\conquest.sqlite C:\\Conquest\\data
+
+Comparing the database with the files in the data folder:
+
+    python conquestscan.py reconcile C:\\Conquest\\data\\conquest.sqlite C:\\Conquest\\data
+
+Logging the files that are not in the database yet in the change feed:
+
+    python conquestscan.py new-files C:\\Conquest\\data\\conquest.sqlite C:\\Conquest\\data
+"""
+import argparse
+import collections
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+
+from conquest import OBLIQUE_MODALITIES, read_image_orientation, \
+    orientation_angle, orientation_is_oblique
+from conquestdb import ConquestDatabaseConnection
+
+# The orientation of a series; angle and oblique are None when the series has
+# no orientation or its file could not be read
+SeriesOrientation = collections.namedtuple(
+    "SeriesOrientation",
+    ["patient_id", "series_uid", "modality", "angle", "oblique"])
+
+# A difference between the database and the data path: kind is one of the
+# constants below, path is relative to the data path with forward slashes
+Discrepancy = collections.namedtuple(
+    "Discrepancy", ["kind", "path", "instance_uid", "detail"])
+# A database row whose file does not exist
+MISSING = "missing"
+# A file without database row
+ORPHAN = "orphan"
+# A file whose UIDs or patient ID differ from the database
+MISMATCH = "mismatch"
+# A file whose header could not be read while checking UIDs
+UNREADABLE = "unreadable"
+# A folder that could not be listed; its path ends with a slash, and the
+# database rows below it are not checked
+INACCESSIBLE = "inaccessible"
+# The header elements compared by reconcile, in the order of the rows of
+# ConquestDatabaseConnection.iter_instance_files
+UID_TAGS = ['SOPInstanceUID', 'SeriesInstanceUID', 'StudyInstanceUID',
+            'PatientID']
+
+
+def _read_orientation(filepath):
+    # Any error of a corrupt file (pydicom reads with force=True) marks the
+    # file as unreadable instead of stopping the scan
+    try:
+        return read_image_orientation(filepath), True
+    except Exception:
+        return None, False
+
+
+def scan_oblique_series(conn, workers=16, modalities=OBLIQUE_MODALITIES):
+    """Determines the slice orientation of every series of the given
+    modalities in the archive. The header of the first file of each series is
+    read by a pool of worker threads; orientations cached by the connection are
+    used without reading, and new ones are added to the cache, so a repeated
+    scan reads only files of new series.
+    Args:
+        conn (conquestdb.ConquestDatabaseConnection): the connection to the
+            Conquest database
+        workers (int): the number of worker threads
+        modalities (list): the modalities to check
+    Returns:
+        list: the conquestscan.SeriesOrientation of every series
+    """
+    rows = conn.get_series_geometry_rows(modalities)
+    to_read = [r for r in rows if r[3] is None and r[4] is not None]
+    filepaths = [os.path.join(conn.data_path, r[4]) for r in to_read]
+    orientations = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_read_orientation, filepaths)
+        for row, (orientation, ok) in zip(to_read, results):
+            if ok:
+                orientations[row[0]] = orientation
+    conn.set_series_orientations(orientations)
+
+    result = []
+    for series_uid, patient_id, modality, orientation, _ in rows:
+        if orientation is None:
+            orientation = orientations.get(series_uid)
+        if orientation:
+            result.append(SeriesOrientation(
+                patient_id, series_uid, modality,
+                orientation_angle(orientation),
+                orientation_is_oblique(orientation)))
+        else:
+            result.append(SeriesOrientation(
+                patient_id, series_uid, modality, None, None))
+    return result
+
+
+def oblique_patients(orientations):
+    """Collects the patients with oblique series.
+    Args:
+        orientations (list): conquestscan.SeriesOrientation objects
+    Returns:
+        list: the sorted IDs of patients with at least one oblique series
+    """
+    return sorted(set(o.patient_id for o in orientations if o.oblique))
+
+
+def read_uids(filepath):
+    """Reads the UIDs and patient ID of a DICOM file from its header.
+    Args:
+        filepath (str): the path of the DICOM file
+    Returns:
+        tuple: (instance UID, series UID, study UID, patient ID); missing values
+        are None
+    """
+    ds = pydicom.dcmread(filepath, force=True, stop_before_pixels=True,
+                         specific_tags=UID_TAGS)
+    return tuple(ds.get(tag) for tag in UID_TAGS)
+
+
+def _walk_files(folder, prefix, errors):
+    # Yields the paths, relative to the data path and with forward slashes, of
+    # all files below a folder; subfolders are scanned with os.scandir. Folders
+    # that cannot be listed are added to errors as (path, error) tuples.
+    folders = [(folder, prefix)]
+    while folders:
+        folder, prefix = folders.pop()
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append((entry.path, prefix + entry.name + "/"))
+                    else:
+                        yield prefix + entry.name
+        except OSError as e:
+            errors.append((prefix, e))
+
+
+def _reconcile_entry(data_path, name, is_dir, rows, check_uids):
+    # Compares the database rows of one top-level entry of the data path with
+    # the files on disk
+    problems = []
+    errors = []
+    if is_dir is None:
+        files = set()
+    elif is_dir:
+        files = set(_walk_files(os.path.join(data_path, name), name + "/",
+                                errors))
+    else:
+        files = {name}
+    for folder, error in errors:
+        problems.append(Discrepancy(INACCESSIBLE, folder, None, str(error)))
+    inaccessible = tuple(folder for folder, _ in errors)
+    for row in rows:
+        path = row[0]
+        if inaccessible and path.startswith(inaccessible):
+            continue
+        if path not in files:
+            problems.append(Discrepancy(MISSING, path, row[1], None))
+            continue
+        files.discard(path)
+        if check_uids:
+            try:
+                uids = read_uids(os.path.join(data_path, path))
+            except Exception as e:
+                problems.append(Discrepancy(UNREADABLE, path, row[1], str(e)))
+                continue
+            mismatches = ["{0} {1} != {2}".format(tag, value, expected)
+                          for tag, value, expected
+                          in zip(UID_TAGS, uids, row[1:])
+                          if expected is not None and value != expected]
+            if mismatches:
+                problems.append(Discrepancy(
+                    MISMATCH, path, row[1], "; ".join(mismatches)))
+    for path in sorted(files):
+        problems.append(Discrepancy(ORPHAN, path, None, None))
+    return problems
+
+
+def _top_level_entries(conn):
+    # Lists the entries of the data path, sorted in the order of the database
+    # paths: a folder sorts as its name followed by a slash. The database
+    # file and its journals are skipped.
+    database = os.path.abspath(conn.database)
+    skip = set(database + suffix for suffix in ["", "-journal", "-wal", "-shm"])
+    entries = []
+    with os.scandir(conn.data_path or ".") as scan:
+        for entry in scan:
+            if os.path.abspath(entry.path) in skip:
+                continue
+            is_dir = entry.is_dir(follow_symlinks=False)
+            entries.append((entry.name + "/" if is_dir else entry.name,
+                            entry.name, is_dir))
+    entries.sort()
+    return entries
+
+
+def _top_level_groups(conn):
+    # Groups the database rows by the first component of their path
+    def key(row):
+        parts = row[0].split("/", 1)
+        return parts[0] + "/" if len(parts) > 1 else parts[0]
+    for sort_key, rows in itertools.groupby(conn.iter_instance_files(), key):
+        yield sort_key, sort_key.rstrip("/"), list(rows)
+
+
+def reconcile(conn, workers=16, check_uids=False):
+    """Compares the instances in the database with the files in the data path.
+    The database rows are streamed in path order and merged with the entries of
+    the data path; the folder of each entry is scanned by a pool of worker
+    threads, with a bounded number of folders in progress. Memory use therefore
+    depends on the size of the largest folder (normally a patient), not on the
+    size of the archive.
+    Args:
+        conn (conquestdb.ConquestDatabaseConnection): the connection to the
+            Conquest database
+        workers (int): the number of worker threads
+        check_uids (bool): whether to read the header of every file and compare
+            its UIDs and patient ID with the database
+    Yields:
+        conquestscan.Discrepancy: the differences found, grouped by top-level
+        folder in path order
+    """
+    entries = iter(_top_level_entries(conn))
+    groups = _top_level_groups(conn)
+    entry = next(entries, None)
+    group = next(groups, None)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while entry is not None or group is not None:
+            if group is None or (entry is not None and entry[0] < group[0]):
+                task = (entry[1], entry[2], [])
+                entry = next(entries, None)
+            elif entry is None or group[0] < entry[0]:
+                task = (group[1], None, group[2])
+                group = next(groups, None)
+            else:
+                task = (entry[1], entry[2], group[2])
+                entry = next(entries, None)
+                group = next(groups, None)
+            pending.append(executor.submit(
+                _reconcile_entry, conn.data_path, task[0], task[1], task[2],
+                check_uids))
+            while len(pending) >= workers * 2:
+                for problem in pending.popleft().result():
+                    yield problem
+        while pending:
+            for problem in pending.popleft().result():
+                yield problem
+
+
+def detect_new_files(conn, workers=16):
+    """Finds the files in the data path that have no database row and logs
+    those not seen before in the change feed of the connection, with kind
+    "file".
+    Args:
+        conn (conquestdb.ConquestDatabaseConnection): the connection to the
+            Conquest database
+        workers (int): the number of worker threads
+    Returns:
+        list: the paths of the new files, relative to the data path with
+        forward slashes
+    """
+    return conn.record_new_files(d.path for d in reconcile(conn, workers)
+                                 if d.kind == ORPHAN)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scan a Conquest archive.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser(
+        "oblique", help="report the slice orientation of all MR/CT/SC series")
+    check = subparsers.add_parser(
+        "reconcile", help="compare the database with the files in the data "
+                          "path")
+    check.add_argument("--check-uids", action="store_true",
+                       help="read every file and compare its UIDs with the "
+                            "database")
+    subparsers.add_parser(
+        "new-files", help="log the files without database record in the "
+                          "change feed")
+    for subparser in subparsers.choices.values():
+        subparser.add_argument("database", help="the Conquest SQLite database")
+        subparser.add_argument("data_path", help="the Conquest data folder")
+        subparser.add_argument("-j", "--workers", type=int, default=16,
+                               help="number of worker threads")
+    args = parser.parse_args(argv)
+
+    if args.command not in ["oblique", "reconcile", "new-files"]:
+        parser.print_help()
+        return 1
+
+    conn = ConquestDatabaseConnection(args.database, args.data_path)
+    start = time.time()
+    if args.command == "oblique":
+        orientations = scan_oblique_series(conn, args.workers)
+        sys.stdout.write("PatientID\tSeriesUID\tModality\tAngle\tOblique\n")
+        for o in orientations:
+            sys.stdout.write("{0}\t{1}\t{2}\t{3}\t{4}\n".format(
+                o.patient_id, o.series_uid, o.modality,
+                "" if o.angle is None else "{0:.2f}".format(o.angle),
+                "" if o.oblique is None else o.oblique))
+        sys.stderr.write(
+            "{0} series, {1} patients with oblique series, {2:.1f} s\n".format(
+                len(orientations), len(oblique_patients(orientations)),
+                time.time() - start))
+    elif args.command == "new-files":
+        paths = detect_new_files(conn, args.workers)
+        for path in paths:
+            sys.stdout.write(path + "\n")
+        sys.stderr.write("{0} new files, {1:.1f} s\n".format(
+            len(paths), time.time() - start))
+    else:
+        counts = collections.Counter()
+        sys.stdout.write("Kind\tPath\tInstanceUID\tDetail\n")
+        for d in reconcile(conn, args.workers, args.check_uids):
+            counts[d.kind] += 1
+            sys.stdout.write("{0}\t{1}\t{2}\t{3}\n".format(
+                d.kind, d.path, d.instance_uid or "", d.detail or ""))
+        sys.stderr.write("{0}, {1:.1f} s\n".format(
+            ", ".join("{0} {1}".format(counts[k], k) for k in
+                      [MISSING, ORPHAN, MISMATCH, UNREADABLE, INACCESSIBLE]),
+            time.time() - start))
+    conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
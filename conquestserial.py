@@ -0,0 +1,169 @@
+"""Compact serialization of ConquestSimpleItem objects, e.g. whole simplified
+subtrees created with ConquestItem.simplify_tree.
+
+The rows of all items of the same type are stored column by column. Column
+names are stored once per item type and interned when loading, so all loaded
+rows share the same key objects. Every column is dictionary encoded: the
+distinct values are stored once, followed by an array with the index of the
+value of each row. Repeated values such as the data path, modality, patient ID
+and study and series UIDs then take up four bytes per row. The result is
+encoded with marshal, so values must be str, int, float, bytes or None, which
+holds for database rows; the format is meant for exchange between processes
+running the same Python version, not for long-term storage.
+
+Running this module compares the format with pickle and JSON.
+"""
+import json
+import marshal
+import pickle
+import sys
+import time
+from array import array
+
+from conquest import ConquestSimplePatient, ConquestSimpleStudy, \
+    ConquestSimpleSeries, ConquestSimpleInstance
+
+FORMAT_VERSION = 1
+ITEM_TYPES = ['patient', 'study', 'series', 'instance']
+SIMPLE_CLASSES = {
+    'patient': ConquestSimplePatient,
+    'study': ConquestSimpleStudy,
+    'series': ConquestSimpleSeries,
+    'instance': ConquestSimpleInstance,
+}
+# Index of a value that is missing from a row
+MISSING = -1
+INDEX_TYPECODE = 'i'
+
+
+def _encode_column(rows, column):
+    values = []
+    positions = {}
+    indices = array(INDEX_TYPECODE)
+    for row in rows:
+        try:
+            value = row[column]
+        except KeyError:
+            indices.append(MISSING)
+            continue
+        position = positions.get(value)
+        if position is None:
+            position = positions[value] = len(values)
+            values.append(value)
+        indices.append(position)
+    return values, indices.tobytes()
+
+
+def dumps(items):
+    """Serializes simplified Conquest items.
+    Args:
+        items (list): rtlibs.conquest.items.ConquestSimpleItem objects
+    Returns:
+        bytes: the serialized items
+    """
+    rows_by_type = dict((t, []) for t in ITEM_TYPES)
+    order = bytearray()
+    for item in items:
+        order.append(ITEM_TYPES.index(item.item_type))
+        rows_by_type[item.item_type].append(item.data)
+
+    tables = []
+    for item_type in ITEM_TYPES:
+        rows = rows_by_type[item_type]
+        columns = []
+        seen = set()
+        for row in rows:
+            for column in row:
+                if column not in seen:
+                    seen.add(column)
+                    columns.append(column)
+        tables.append((len(rows), columns,
+                       [_encode_column(rows, c) for c in columns]))
+    return marshal.dumps((FORMAT_VERSION, INDEX_TYPECODE, bytes(order), tables))
+
+
+def _decode_table(count, columns, encoded):
+    columns = [sys.intern(c) for c in columns]
+    decoded = []
+    complete = True
+    for values, data in encoded:
+        indices = array(INDEX_TYPECODE)
+        indices.frombytes(data)
+        if MISSING in indices:
+            complete = False
+        decoded.append((values, indices))
+
+    if complete:
+        value_lists = [[values[i] for i in indices]
+                       for values, indices in decoded]
+        return [dict(zip(columns, row)) for row in zip(*value_lists)]
+
+    rows = [{} for _ in range(count)]
+    for column, (values, indices) in zip(columns, decoded):
+        for row, i in zip(rows, indices):
+            if i != MISSING:
+                row[column] = values[i]
+    return rows
+
+
+def loads(data):
+    """Deserializes simplified Conquest items.
+    Args:
+        data (bytes): the serialized items, created with dumps
+    Returns:
+        list: the rtlibs.conquest.items.ConquestSimpleItem objects, in their
+        original order
+    """
+    version, typecode, order, tables = marshal.loads(data)
+    if version != FORMAT_VERSION or typecode != INDEX_TYPECODE:
+        raise ValueError("Unsupported serialization format")
+    row_lists = [iter(_decode_table(*table)) for table in tables]
+    classes = [SIMPLE_CLASSES[t] for t in ITEM_TYPES]
+    return [classes[t](next(row_lists[t])) for t in order]
+
+
+def benchmark(items, repeat=5):
+    """Compares the size and round trip time of dumps/loads with pickle and
+    JSON.
+    Args:
+        items (list): rtlibs.conquest.items.ConquestSimpleItem objects
+        repeat (int): the number of round trips to time
+    Returns:
+        list: (name, size in bytes, dump time, load time) tuples, with the best
+        time in seconds
+    """
+    methods = [
+        ("columnar", dumps, loads),
+        ("pickle",
+         lambda i: pickle.dumps(i, pickle.HIGHEST_PROTOCOL), pickle.loads),
+        ("json",
+         lambda i: json.dumps([(x.item_type, x.data) for x in i]).encode(),
+         lambda d: [SIMPLE_CLASSES[t](r) for t, r in json.loads(d)]),
+    ]
+    results = []
+    for name, dump, load in methods:
+        dump_times = []
+        load_times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            data = dump(items)
+            dump_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            loaded = load(data)
+            load_times.append(time.perf_counter() - start)
+        assert [x.data for x in loaded] == [x.data for x in items]
+        results.append((name, len(data), min(dump_times), min(load_times)))
+    return results
+
+
+if __name__ == "__main__":
+    from conquestdb import ConquestDatabaseConnection, create_synthetic_archive
+
+    conn = ConquestDatabaseConnection(data_path="C:\\Conquest\\data")
+    create_synthetic_archive(conn, patients=1, studies=5, series=8,
+                             instances=1000)
+    items = conn.get_patients()[0].simplify_tree()
+    print("{0} items".format(len(items)))
+    for name, size, dump_time, load_time in benchmark(items):
+        print("{0:10} {1:10d} bytes  dump {2:7.1f} ms  load {3:7.1f} ms".format(
+            name, size, dump_time * 1000, load_time * 1000))
@@ -0,0 +1,295 @@
+"""Instrumentation of the Conquest connection and item layer.
+The database round trips of the items are hidden behind properties, so it is
+hard to see why e.g. ConquestPatient.uid_tree is slow. While a Tracer is active
+it records:
+- every query, with its duration and the call site outside conquestdb.py that
+  caused it
+- every call of the get_* and count_* methods of the connection, the DICOM file
+  reads (pydicom.dcmread) and the item properties in TRACED_PROPERTIES, as
+  nested operations with their duration and number of queries
+
+Query shapes (the SQL text, with lists of parameters collapsed) that are
+executed many times from the same call site are reported as possible N+1
+patterns: a query per item where one query for all items would do.
+
+    tracer = Tracer()
+    with tracer.trace(conn):
+        patient.uid_tree
+    print(tracer.report())
+    tracer.export_chrome_trace("trace.json")
+
+The trace file can be opened in chrome://tracing or https://ui.perfetto.dev.
+"""
+import collections
+import contextlib
+import functools
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import pydicom
+
+from conquest import ConquestPatient, ConquestStudy, ConquestSeries, \
+    ConquestInstance
+
+# The item properties timed while tracing
+TRACED_PROPERTIES = [
+    (ConquestPatient, ['studies', 'series', 'instances', 'uid_tree',
+                       'has_oblique_series']),
+    (ConquestStudy, ['series', 'instances', 'patient', 'has_oblique_series']),
+    (ConquestSeries, ['instances', 'instance_uids', 'ordered_instance_uids',
+                      'study', 'image_orientation', 'oblique']),
+    (ConquestInstance, ['image_orientation']),
+]
+# The prefixes of the connection methods timed while tracing
+TRACED_METHOD_PREFIXES = ("get_", "count_")
+# Modules skipped when looking for the call site of a query, besides the
+# wrappers of traced functions
+INTERNAL_MODULES = ["conquestdb", "contextlib", "functools"]
+
+# An operation or query: kind is "operation" or "query", start and duration
+# are in seconds, thread is the thread ID
+TraceEvent = collections.namedtuple(
+    "TraceEvent", ["kind", "name", "start", "duration", "thread", "site"])
+
+
+def query_shape(query):
+    """Normalizes a query, so queries that differ only in the number of
+    parameters or in whitespace have the same shape.
+    Args:
+        query (str): the SQL query
+    Returns:
+        str: the query shape
+    """
+    query = re.sub(r"\?(\s*,\s*\?)+", "?, ...", query)
+    return " ".join(query.split())
+
+
+def _call_site():
+    frame = sys._getframe(2)
+    while frame is not None:
+        code = frame.f_code
+        name = os.path.splitext(os.path.basename(code.co_filename))[0]
+        if name not in INTERNAL_MODULES and not (
+                code.co_name == "traced" and code.co_filename == __file__):
+            return "{0}:{1} {2}".format(name, frame.f_lineno, code.co_name)
+        frame = frame.f_back
+    return "unknown"
+
+
+class _Operation(object):
+    __slots__ = ['name', 'start', 'queries']
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.queries = 0
+
+
+class Tracer(object):
+    """Records the queries and operations of Conquest connections.
+    Args:
+        n_plus_one_threshold (int): the number of executions of the same
+            query shape from the same call site from which it is reported as a
+            possible N+1 pattern
+    """
+    def __init__(self, n_plus_one_threshold=10):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.events = []
+        # Number of queries and total duration by (call site, query shape)
+        self.queries = collections.defaultdict(lambda: [0, 0.0])
+        # Number of calls, total duration and queries by operation name
+        self.operations = collections.defaultdict(lambda: [0, 0.0, 0])
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def clear(self):
+        """Drops all recorded events."""
+        with self._lock:
+            self.events = []
+            self.queries.clear()
+            self.operations.clear()
+
+    def record_query(self, query, start):
+        """Records a query; called by the connection.
+        Args:
+            query (str): the SQL query
+            start (float): the time.perf_counter() when the query started
+        """
+        duration = time.perf_counter() - start
+        site = _call_site()
+        for operation in self._stack():
+            operation.queries += 1
+        with self._lock:
+            stats = self.queries[(site, query_shape(query))]
+            stats[0] += 1
+            stats[1] += duration
+            self.events.append(TraceEvent(
+                "query", query_shape(query), start, duration,
+                threading.get_ident(), site))
+
+    @contextlib.contextmanager
+    def operation(self, name):
+        """Context manager that records an operation.
+        Args:
+            name (str): the name of the operation
+        """
+        stack = self._stack()
+        operation = _Operation(name, time.perf_counter())
+        stack.append(operation)
+        try:
+            yield operation
+        finally:
+            stack.pop()
+            duration = time.perf_counter() - operation.start
+            with self._lock:
+                stats = self.operations[name]
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] += operation.queries
+                self.events.append(TraceEvent(
+                    "operation", name, operation.start, duration,
+                    threading.get_ident(), None))
+
+    def wrap(self, name, function):
+        """Wraps a function so its calls are recorded as operations.
+        Args:
+            name (str): the name of the operation
+            function (callable): the function
+        Returns:
+            callable: the wrapped function
+        """
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            with self.operation(name):
+                return function(*args, **kwargs)
+        return traced
+
+    @contextlib.contextmanager
+    def trace(self, conn):
+        """Context manager that records the queries and operations of a
+        connection, of the items and of DICOM file reads while it is active.
+        The item properties and pydicom.dcmread are patched for all
+        connections and threads during this time.
+        Args:
+            conn (conquestdb.ConquestDatabaseConnection): the connection
+        """
+        methods = [name for name in dir(conn)
+                   if name.startswith(TRACED_METHOD_PREFIXES) and
+                   callable(getattr(conn, name))]
+        properties = [(cls, name, cls.__dict__[name])
+                      for cls, names in TRACED_PROPERTIES for name in names
+                      if isinstance(cls.__dict__.get(name), property)]
+        dcmread = pydicom.dcmread
+        conn.tracer = self
+        for name in methods:
+            setattr(conn, name, self.wrap(name, getattr(conn, name)))
+        for cls, name, prop in properties:
+            setattr(cls, name, property(
+                self.wrap("{0}.{1}".format(cls.__name__, name), prop.fget),
+                prop.fset, prop.fdel, prop.__doc__))
+        pydicom.dcmread = self.wrap("dcmread", dcmread)
+        try:
+            yield self
+        finally:
+            pydicom.dcmread = dcmread
+            for cls, name, prop in properties:
+                setattr(cls, name, prop)
+            for name in methods:
+                delattr(conn, name)
+            conn.tracer = None
+
+    def n_plus_one(self):
+        """Finds the query shapes executed at least n_plus_one_threshold times
+        from the same call site.
+        Returns:
+            list: (call site, query shape, count) tuples, most frequent first
+        """
+        with self._lock:
+            found = [(site, shape, count)
+                     for (site, shape), (count, _) in self.queries.items()
+                     if count >= self.n_plus_one_threshold]
+        return sorted(found, key=lambda f: -f[2])
+
+    def report(self):
+        """Creates a text report of the operations, the queries per call site
+        and the possible N+1 patterns.
+        Returns:
+            str: the report
+        """
+        lines = ["Operations", "{0:>8} {1:>10} {2:>10} {3:>8}  {4}".format(
+            "calls", "total ms", "mean ms", "queries", "operation")]
+        with self._lock:
+            operations = sorted(self.operations.items(),
+                                key=lambda o: -o[1][1])
+            queries = sorted(self.queries.items(), key=lambda q: -q[1][1])
+        for name, (calls, total, count) in operations:
+            lines.append("{0:8d} {1:10.1f} {2:10.3f} {3:8d}  {4}".format(
+                calls, total * 1000, total * 1000 / calls, count, name))
+        lines += ["", "Queries", "{0:>8} {1:>10}  {2}".format(
+            "count", "total ms", "call site: query")]
+        for (site, shape), (count, total) in queries:
+            lines.append("{0:8d} {1:10.1f}  {2}: {3}".format(
+                count, total * 1000, site, shape[:100]))
+        n_plus_one = self.n_plus_one()
+        if n_plus_one:
+            lines += ["", "Possible N+1 query patterns"]
+            for site, shape, count in n_plus_one:
+                lines.append("{0:8d}x {1}: {2}".format(count, site, shape[:100]))
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        """Converts the recorded events to the Chrome trace event format.
+        Returns:
+            dict: the trace, with the events in "traceEvents"
+        """
+        with self._lock:
+            events = list(self.events)
+        trace_events = []
+        for event in events:
+            args = {"site": event.site} if event.site else {}
+            trace_events.append({
+                "name": event.name if event.kind == "operation"
+                else event.name[:80],
+                "cat": event.kind, "ph": "X", "pid": os.getpid(),
+                "tid": event.thread,
+                "ts": (event.start - self._origin) * 1e6,
+                "dur": event.duration * 1e6, "args": args,
+            })
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, filename):
+        """Writes the recorded events to a Chrome trace JSON file.
+        Args:
+            filename (str): the path of the file
+        """
+        with open(filename, "w") as fp:
+            json.dump(self.chrome_trace(), fp)
+
+
+if __name__ == "__main__":
+    from conquestdb import ConquestDatabaseConnection, create_synthetic_archive
+
+    conn = ConquestDatabaseConnection()
+    create_synthetic_archive(conn, patients=3, studies=2, series=4,
+                             instances=20)
+    tracer = Tracer()
+    with tracer.trace(conn):
+        for patient in conn.get_patients():
+            patient.uid_tree
+            for study in patient.studies:
+                for series in study.series:
+                    len(series.instances)
+    print(tracer.report())
+    if len(sys.argv) > 1:
+        tracer.export_chrome_trace(sys.argv[1])
@@ -0,0 +1,145 @@
+"""Loading a Conquest series as a 3D NumPy array.
+The slices are read in the order of ConquestSeries.ordered_instance_uids by a
+pool of worker threads, each decoding its slice straight into a preallocated
+array, so waiting for files on a network share or slow disk overlaps. Rescale
+slope and intercept are applied afterwards to the whole volume at once.
+
+With a cache folder, the volume of each series is stored there as
+<series UID>_<hash>.npy and opened memory-mapped on the next load, so loading
+it again costs no more than opening a file. The hash is taken over the ordered
+instance UIDs, so a series whose instances changed is read again. The volume
+is written to the cache file directly while the slices are read.
+"""
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pydicom
+
+
+def _read_slice(volume, index, filepath):
+    # Reads the pixel data of a slice into the volume; returns the rescale
+    # slope and intercept
+    ds = pydicom.dcmread(filepath, force=True)
+    volume[index] = ds.pixel_array
+    return (float(ds.get('RescaleSlope', 1) or 1),
+            float(ds.get('RescaleIntercept', 0) or 0))
+
+
+def _slice_shape(filepath):
+    ds = pydicom.dcmread(filepath, force=True, stop_before_pixels=True,
+                         specific_tags=['Rows', 'Columns'])
+    return int(ds.Rows), int(ds.Columns)
+
+
+def cache_path(cache_dir, series_uid, instance_uids):
+    """Returns the path of the cached volume of a series.
+    Args:
+        cache_dir (str): the cache folder
+        series_uid (str): the series UID
+        instance_uids (list): the instance UIDs of the series, in slice order
+    Returns:
+        str: the path of the .npy file
+    """
+    digest = hashlib.sha1("\\".join(instance_uids).encode()).hexdigest()
+    return os.path.join(cache_dir, "{0}_{1}.npy".format(series_uid,
+                                                        digest[:16]))
+
+
+def _remove_outdated(cache_dir, series_uid, path):
+    # Removes the cached volumes of a series other than the current one
+    prefix = series_uid + "_"
+    for name in os.listdir(cache_dir):
+        filepath = os.path.join(cache_dir, name)
+        if name.startswith(prefix) and name.endswith(".npy") and \
+                filepath != path:
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+
+
+def load_volume(series, workers=8, cache_dir=None, dtype=numpy.float32):
+    """Loads the pixel data of all slices of a series into a 3D array, with
+    the rescale slope and intercept applied.
+    Args:
+        series (rtlibs.conquest.items.ConquestSeries): the series
+        workers (int): the number of worker threads reading slices
+        cache_dir (str): if given, the folder where volumes are cached; a cached
+            volume is used if it was made from the same instances, in the same
+            order
+        dtype (numpy.dtype): the data type of the volume
+    Returns:
+        numpy.ndarray: the volume, with shape (slices, rows, columns); a
+        read-only memory map if it was loaded from the cache
+    """
+    uids = series.ordered_instance_uids
+    if cache_dir is not None:
+        path = cache_path(cache_dir, series.series_uid, uids)
+        if os.path.exists(path):
+            volume = numpy.load(path, mmap_mode='r')
+            if volume.dtype == dtype:
+                return volume
+            del volume
+
+    instances = dict((i.instance_uid, i) for i in series.instances)
+    filepaths = [instances[uid].filepath for uid in uids]
+    if not filepaths:
+        return numpy.empty((0, 0, 0), dtype=dtype)
+    shape = (len(filepaths),) + _slice_shape(filepaths[0])
+
+    if cache_dir is None:
+        volume = numpy.empty(shape, dtype=dtype)
+    else:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        temp_path = path + ".tmp"
+        volume = numpy.lib.format.open_memmap(temp_path, mode='w+',
+                                              dtype=dtype, shape=shape)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rescale = list(executor.map(_read_slice, [volume] * len(filepaths),
+                                        range(len(filepaths)), filepaths))
+        slopes, intercepts = numpy.array(rescale, dtype=numpy.float64).T
+        if (slopes != 1).any():
+            volume *= slopes[:, None, None].astype(dtype)
+        if (intercepts != 0).any():
+            volume += intercepts[:, None, None].astype(dtype)
+        if cache_dir is None:
+            return volume
+        volume.flush()
+        volume = None
+        os.replace(temp_path, path)
+    finally:
+        if cache_dir is not None and os.path.exists(temp_path):
+            # Closes the memory map before removing the unfinished file
+            volume = None
+            os.remove(temp_path)
+    _remove_outdated(cache_dir, series.series_uid, path)
+    return numpy.load(path, mmap_mode='r')
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    import time
+
+    from conquestdb import ConquestDatabaseConnection, create_synthetic_archive
+
+    folder = tempfile.mkdtemp()
+    conn = ConquestDatabaseConnection(data_path=os.path.join(folder, "data"))
+    create_synthetic_archive(conn, patients=1, studies=1, series=1,
+                             instances=int(sys.argv[1]) if len(sys.argv) > 1
+                             else 200, write_files=True)
+    series = conn.get_patients()[0].series[0]
+    cache_dir = os.path.join(folder, "cache")
+    for label, kwargs in [("sequential", dict(workers=1)),
+                          ("threads", dict(workers=8)),
+                          ("write cache", dict(cache_dir=cache_dir)),
+                          ("cached", dict(cache_dir=cache_dir))]:
+        start = time.perf_counter()
+        volume = load_volume(series, **kwargs)
+        print("{0:12} {1} {2:8.1f} ms".format(
+            label, volume.shape, (time.perf_counter() - start) * 1000))
@@ -0,0 +1,756 @@
+"""Reading, formatting and exporting DICOM datasets, without any GUI code.
+
+Large values (pixel data, big OB/OW/FL arrays) can be left on disk when a file
+is opened: they are shown as a size summary and only read when asked for.
+
+Can be run from the command line to dump DICOM files, or all files in a
+folder, as text, JSON or CSV:
+
+    python dicomtree.py -f json -o dumps -t PatientID -t 0020,000D file1.dcm folder
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import pydicom
+from pydicom.datadict import dictionary_description, dictionary_VR, tag_for_keyword
+from pydicom.dataelem import RawDataElement
+from pydicom.tag import Tag
+
+# Values longer than this (in bytes) are deferred and summarized
+LARGE_VALUE_SIZE = 1024
+# Size in bytes of a single value for fixed size binary value representations
+VR_SIZES = {"AT": 4, "FD": 8, "FL": 4, "SL": 4, "SS": 2, "SV": 8, "UL": 4, "US": 2, "UV": 8}
+HEX_PREVIEW_SIZE = 4096
+COLUMNS = ["Tree structure", "Tag", "Description", "VR", "VM", "Value"]
+FORMATS = {"text": ".txt", "json": ".json", "csv": ".csv"}
+OUTPUT_BUFFER_SIZE = 1 << 20
+# Size of the blocks in which deferred values are read from disk to compare them
+COMPARE_CHUNK_SIZE = 1 << 20
+
+# A row in the dump of a dataset. The kind is "Metadata" or "Dataset" for the
+# two top level rows, otherwise "element", "sequence" or "item". The path of
+# elements and sequences can be passed to element_at.
+Row = namedtuple("Row", ["depth", "kind", "columns", "path"])
+EMPTY_COLUMNS = [""] * 5
+# A parsed file in the DatasetCache: the dataset and the list of its rows
+CacheEntry = namedtuple("CacheEntry", ["dataset", "rows"])
+# A row in the difference between two datasets. The columns are the tag,
+# description, VR and VM; values holds the value texts of both datasets.
+DiffRow = namedtuple("DiffRow", ["depth", "kind", "columns", "values", "status", "path"])
+SAME = "same"
+CHANGED = "changed"
+ADDED = "added"
+REMOVED = "removed"
+# Large values of the same size that could not be read from disk to compare
+UNCOMPARED = "not compared"
+
+
+def read_dataset(filename, defer=True):
+    """Reads a DICOM file.
+    Args:
+        filename (str): the path of the file to read
+        defer (bool): whether to leave large values on disk until they are
+            accessed
+    Returns:
+        pydicom.dataset.FileDataset: the dataset
+    """
+    if defer:
+        return pydicom.dcmread(filename, force=True, defer_size=LARGE_VALUE_SIZE)
+    dataset = pydicom.dcmread(filename, force=True)
+    dataset.decode()
+    return dataset
+
+
+def raw_element(ds, tag):
+    """Retrieves an element from a dataset without converting its value, so a
+    deferred value is not read from disk.
+    Args:
+        ds (pydicom.dataset.Dataset): the dataset
+        tag (pydicom.tag.BaseTag): the tag of the element
+    Returns:
+        pydicom.dataelem.RawDataElement or pydicom.dataelem.DataElement: the
+        element
+    """
+    try:
+        return ds.get_item(tag, keep_deferred=True)
+    except TypeError:
+        # Older pydicom versions never read deferred values in get_item
+        return ds.get_item(tag)
+
+
+def element_vr(elem):
+    """Returns the VR of a (possibly raw) element.
+    Args:
+        elem (pydicom.dataelem.RawDataElement or DataElement): the element
+    Returns:
+        str: the VR
+    """
+    if elem.VR:
+        return str(elem.VR)
+    try:
+        return dictionary_VR(elem.tag)
+    except KeyError:
+        return "UN"
+
+
+def element_length(elem):
+    """Returns the length in bytes of the value of an element, if it is known
+    without converting the value.
+    Args:
+        elem (pydicom.dataelem.RawDataElement or DataElement): the element
+    Returns:
+        int: the length of the value, or None if unknown
+    """
+    if isinstance(elem, RawDataElement):
+        if elem.length == 0xFFFFFFFF:
+            return len(elem.value) if elem.value is not None else None
+        return elem.length
+    if isinstance(elem.value, bytes):
+        return len(elem.value)
+    return None
+
+
+def is_large(elem):
+    """Checks whether the value of an element is too large to display.
+    Args:
+        elem (pydicom.dataelem.RawDataElement or DataElement): the element
+    Returns:
+        bool: whether the value should be summarized
+    """
+    vr = element_vr(elem)
+    if vr == "SQ":
+        return False
+    if isinstance(elem, RawDataElement) and elem.value is None and elem.length:
+        # Deferred value
+        return True
+    length = element_length(elem)
+    return length is not None and length > LARGE_VALUE_SIZE
+
+
+def summarize(elem):
+    """Creates a size summary for the value of an element.
+    Args:
+        elem (pydicom.dataelem.RawDataElement or DataElement): the element
+    Returns:
+        str: the summary, e.g. "OW, 524288 bytes"
+    """
+    length = element_length(elem)
+    if length is None:
+        return "{0}, unknown size".format(element_vr(elem))
+    return "{0}, {1} bytes".format(element_vr(elem), length)
+
+
+def element_columns(ds, tag, defer=True):
+    """Creates the text columns for an element: tag, description, VR, VM and
+    value.
+    Args:
+        ds (pydicom.dataset.Dataset): the dataset containing the element
+        tag (pydicom.tag.BaseTag): the tag of the element
+        defer (bool): whether to summarize large values instead of converting
+            them
+    Returns:
+        list: the column texts
+    """
+    elem = raw_element(ds, tag)
+    if defer and is_large(elem):
+        vr = element_vr(elem)
+        try:
+            description = dictionary_description(tag)
+        except KeyError:
+            description = "Private tag data" if tag.is_private else ""
+        length = element_length(elem)
+        if vr in VR_SIZES and length is not None:
+            vm = length // VR_SIZES[vr]
+        else:
+            vm = 1
+        return [str(tag).replace(" ", ""), description, vr, str(vm), summarize(elem)]
+
+    de = ds[tag]
+    if de.VR == "SQ":
+        value = "Sequence of length " + str(len(de.value))
+    else:
+        value = str(de.value)
+    return [str(de.tag).replace(" ", ""), str(de.name), str(de.VR), str(de.VM), value]
+
+
+def element_at(ds, path):
+    """Retrieves the element at the given path, reading its value from disk if
+    it was deferred.
+    Args:
+        ds (pydicom.dataset.FileDataset): the dataset
+        path (tuple): alternating tags and sequence item indices leading to the
+            element
+    Returns:
+        pydicom.dataelem.DataElement: the element
+    """
+    if Tag(path[0]).group == 0x0002:
+        ds = ds.file_meta
+    de = ds[path[0]]
+    for i in range(1, len(path), 2):
+        de = de.value[path[i]][path[i + 1]]
+    return de
+
+
+def hex_dump(value, size=HEX_PREVIEW_SIZE):
+    """Formats the start of a binary value as a hex dump.
+    Args:
+        value (bytes): the value
+        size (int): the maximum number of bytes to show
+    Returns:
+        str: the hex dump
+    """
+    lines = []
+    for offset in range(0, min(len(value), size), 16):
+        chunk = value[offset:offset + 16]
+        hexpart = " ".join("{0:02x}".format(b) for b in chunk)
+        asciipart = "".join(chr(b) if 32 <= b < 127 else "." for b in chunk)
+        lines.append("{0:08x}  {1:<47}  |{2}|".format(offset, hexpart, asciipart))
+    if len(value) > size:
+        lines.append("... ({0} more bytes)".format(len(value) - size))
+    return "\n".join(lines)
+
+
+def walk(dataset, defer=True):
+    """Traverses a dataset in display order: the file meta information first,
+    then the dataset itself, with sequence items directly below their sequence.
+    Args:
+        dataset (pydicom.dataset.Dataset): the dataset
+        defer (bool): whether to summarize large values instead of converting
+            them
+    Returns:
+        generator: the dicomtree.Row objects
+    """
+    yield Row(0, "Metadata", EMPTY_COLUMNS, None)
+    file_meta = getattr(dataset, "file_meta", None)
+    if file_meta is not None:
+        yield from _walk_dataset(file_meta, 1, (), defer)
+    yield Row(0, "Dataset", EMPTY_COLUMNS, None)
+    yield from _walk_dataset(dataset, 1, (), defer)
+
+
+def _walk_dataset(ds, depth, path, defer):
+    for tag in sorted(ds.keys()):
+        columns = element_columns(ds, tag, defer)
+        if columns[2] != "SQ":
+            yield Row(depth, "element", columns, path + (tag,))
+            continue
+        yield Row(depth, "sequence", columns, path + (tag,))
+        for i, item in enumerate(ds[tag].value):
+            yield Row(depth + 1, "item", EMPTY_COLUMNS, path + (tag, i))
+            yield from _walk_dataset(item, depth + 2, path + (tag, i), defer)
+
+
+def diff(dataset_a, dataset_b, defer=True):
+    """Aligns two datasets by tag path and compares them. Elements are matched
+    by tag and sequence items by index, merging the sorted tags of both
+    datasets, so the time taken is linear in the number of elements. Sequences,
+    items and the top level rows are marked as changed when anything below
+    them differs. Deferred large values of the same size are compared by
+    reading both from disk in blocks, without keeping them in the datasets;
+    if a file cannot be read they are marked as not compared.
+    Args:
+        dataset_a (pydicom.dataset.Dataset): the first (old) dataset
+        dataset_b (pydicom.dataset.Dataset): the second (new) dataset
+        defer (bool): whether to summarize large values instead of converting
+            them
+    Returns:
+        list: the dicomtree.DiffRow objects, in display order
+    """
+    rows = []
+    parts = [
+        ("Metadata", getattr(dataset_a, "file_meta", None), getattr(dataset_b, "file_meta", None)),
+        ("Dataset", dataset_a, dataset_b),
+    ]
+    files = (getattr(dataset_a, "filename", None), getattr(dataset_b, "filename", None))
+    for kind, a, b in parts:
+        index = len(rows)
+        rows.append(None)
+        changed = _diff_datasets(a, b, 1, (), defer, files, rows)
+        rows[index] = DiffRow(0, kind, EMPTY_COLUMNS[:4], ("", ""), CHANGED if changed else SAME, None)
+    return rows
+
+
+def _diff_datasets(a, b, depth, path, defer, files, rows):
+    tags_a = sorted(a.keys()) if a is not None else []
+    tags_b = sorted(b.keys()) if b is not None else []
+    changed = False
+    i = 0
+    j = 0
+    while i < len(tags_a) or j < len(tags_b):
+        if j == len(tags_b) or (i < len(tags_a) and tags_a[i] < tags_b[j]):
+            changed = _diff_element(a, None, tags_a[i], depth, path, defer, files, rows) or changed
+            i += 1
+        elif i == len(tags_a) or tags_b[j] < tags_a[i]:
+            changed = _diff_element(None, b, tags_b[j], depth, path, defer, files, rows) or changed
+            j += 1
+        else:
+            changed = _diff_element(a, b, tags_a[i], depth, path, defer, files, rows) or changed
+            i += 1
+            j += 1
+    return changed
+
+
+def _value_chunks(elem, filename):
+    # Yields the value of a large element in blocks, reading a deferred value
+    # from the file without storing it in the dataset
+    if elem.value is not None:
+        yield bytes(elem.value)
+        return
+    if not isinstance(filename, str):
+        raise OSError("Deferred value without file name")
+    remaining = elem.length
+    with open(filename, "rb") as fp:
+        fp.seek(elem.value_tell)
+        while remaining > 0:
+            chunk = fp.read(min(remaining, COMPARE_CHUNK_SIZE))
+            if not chunk:
+                raise OSError("Unexpected end of file in deferred value")
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _compare_large(elem_a, elem_b, files):
+    # Compares the values of two large elements whose summaries are equal;
+    # returns SAME, CHANGED or UNCOMPARED
+    try:
+        chunks_a = _value_chunks(elem_a, files[0])
+        chunks_b = _value_chunks(elem_b, files[1])
+        buffer_a = memoryview(b"")
+        buffer_b = memoryview(b"")
+        while True:
+            if not buffer_a:
+                buffer_a = memoryview(next(chunks_a, b""))
+            if not buffer_b:
+                buffer_b = memoryview(next(chunks_b, b""))
+            if not buffer_a or not buffer_b:
+                return SAME if buffer_a == buffer_b else CHANGED
+            n = min(len(buffer_a), len(buffer_b))
+            if buffer_a[:n] != buffer_b[:n]:
+                return CHANGED
+            buffer_a = buffer_a[n:]
+            buffer_b = buffer_b[n:]
+    except (OSError, TypeError):
+        return UNCOMPARED
+
+
+def _diff_element(a, b, tag, depth, path, defer, files, rows):
+    columns_a = element_columns(a, tag, defer) if a is not None else None
+    columns_b = element_columns(b, tag, defer) if b is not None else None
+    columns = columns_a or columns_b
+    path = path + (tag,)
+    values = (columns_a[4] if columns_a else "", columns_b[4] if columns_b else "")
+    if columns_a is None:
+        status = ADDED
+    elif columns_b is None:
+        status = REMOVED
+    elif columns_a[2:] != columns_b[2:]:
+        status = CHANGED
+    else:
+        status = SAME
+        elem_a = raw_element(a, tag)
+        elem_b = raw_element(b, tag)
+        if defer and is_large(elem_a) and is_large(elem_b):
+            status = _compare_large(elem_a, elem_b, files)
+
+    vrs = set(c[2] for c in (columns_a, columns_b) if c is not None)
+    if vrs != set(["SQ"]):
+        rows.append(DiffRow(depth, "element", columns[:4], values, status, path))
+        return status != SAME
+
+    index = len(rows)
+    rows.append(None)
+    sequence_a = a[tag].value if a is not None else []
+    sequence_b = b[tag].value if b is not None else []
+    for k in range(max(len(sequence_a), len(sequence_b))):
+        item_a = sequence_a[k] if k < len(sequence_a) else None
+        item_b = sequence_b[k] if k < len(sequence_b) else None
+        item_index = len(rows)
+        rows.append(None)
+        item_changed = _diff_datasets(item_a, item_b, depth + 2, path + (k,), defer, files, rows)
+        if item_a is None:
+            item_status = ADDED
+        elif item_b is None:
+            item_status = REMOVED
+        else:
+            item_status = CHANGED if item_changed else SAME
+        if status == SAME and item_status != SAME:
+            status = CHANGED
+        rows[item_index] = DiffRow(depth + 1, "item", EMPTY_COLUMNS[:4], ("", ""), item_status, path + (k,))
+    rows[index] = DiffRow(depth, "sequence", columns[:4], values, status, path)
+    return status != SAME
+
+
+def write_text(rows, fp):
+    """Writes rows as tab separated text, indented by depth.
+    Args:
+        rows (iterable): the dicomtree.Row objects to write
+        fp (file): the text file to write to
+    """
+    for row in rows:
+        fp.write("\t" * row.depth + row.kind + "\t" + "\t".join(row.columns) + "\n")
+
+
+def write_csv(rows, fp):
+    """Writes rows as CSV, with a header line.
+    Args:
+        rows (iterable): the dicomtree.Row objects to write
+        fp (file): the text file to write to, opened with newline=""
+    """
+    writer = csv.writer(fp)
+    writer.writerow(["Depth"] + COLUMNS)
+    for row in rows:
+        writer.writerow([row.depth, row.kind] + row.columns)
+
+
+def write_json(rows, fp):
+    """Writes rows as a JSON array of objects, one row per line.
+    Args:
+        rows (iterable): the dicomtree.Row objects to write
+        fp (file): the text file to write to
+    """
+    fp.write("[")
+    separator = "\n"
+    for row in rows:
+        record = {
+            "depth": row.depth,
+            "type": row.kind,
+            "tag": row.columns[0],
+            "description": row.columns[1],
+            "vr": row.columns[2],
+            "vm": row.columns[3],
+            "value": row.columns[4],
+            "path": list(row.path) if row.path is not None else None,
+        }
+        fp.write(separator + json.dumps(record))
+        separator = ",\n"
+    fp.write("\n]\n")
+
+
+WRITERS = {"text": write_text, "json": write_json, "csv": write_csv}
+
+
+class DatasetCache(object):
+    """Least recently used cache of parsed DICOM files, which can read files
+    in the background before they are needed.
+    Args:
+        size (int): the maximum number of files to keep
+        workers (int): the number of background threads for prefetching
+    """
+    def __init__(self, size=32, workers=2):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def get(self, filename, defer=True):
+        """Returns a parsed file, reading it if it is not in the cache. If the
+        file is being prefetched, waits for that to finish.
+        Args:
+            filename (str): the path of the DICOM file
+            defer (bool): whether to leave large values on disk
+        Returns:
+            dicomtree.CacheEntry: the dataset and its rows
+        """
+        key = (os.path.abspath(filename), defer)
+        with self._lock:
+            future = self._entries.get(key)
+            if future is not None:
+                self._entries.move_to_end(key)
+            else:
+                future = self._add(key)
+        if self._claim(future):
+            self._load(key, future)
+        return future.result()
+
+    def prefetch(self, filenames, defer=True):
+        """Starts reading files in the background, unless they are cached.
+        Args:
+            filenames (list): the paths of the DICOM files
+            defer (bool): whether to leave large values on disk
+        """
+        for filename in filenames:
+            key = (os.path.abspath(filename), defer)
+            with self._lock:
+                if key in self._entries:
+                    continue
+                future = self._add(key)
+            self._executor.submit(self._prefetch, key, future)
+
+    def clear(self):
+        """Removes all files from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def _add(self, key):
+        future = Future()
+        self._entries[key] = future
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return future
+
+    def _claim(self, future):
+        # Makes sure that only one thread reads a file
+        with self._lock:
+            if future.running() or future.done():
+                return False
+            return future.set_running_or_notify_cancel()
+
+    def _prefetch(self, key, future):
+        if self._claim(future):
+            self._load(key, future)
+
+    def _load(self, key, future):
+        try:
+            dataset = read_dataset(key[0], key[1])
+            future.set_result(CacheEntry(dataset, list(walk(dataset, key[1]))))
+        except Exception as e:
+            future.set_exception(e)
+            with self._lock:
+                if self._entries.get(key) is future:
+                    del self._entries[key]
+
+
+def parse_tag(s):
+    """Parses a tag given as keyword (PatientID), as group and element
+    ((0010,0020) or 0010,0020) or as a single hex number (00100020).
+    Args:
+        s (str): the tag
+    Returns:
+        pydicom.tag.BaseTag: the tag
+    """
+    tag = tag_for_keyword(s)
+    if tag is not None:
+        return Tag(tag)
+    s = s.strip("()").replace(",", "")
+    try:
+        return Tag(int(s, 16))
+    except ValueError:
+        raise ValueError("Unknown tag: " + s)
+
+
+def filter_rows(rows, tags):
+    """Filters rows on tags. A row is kept if its own tag or the tag of one of
+    its enclosing sequences is in the given tags. The sequences and items
+    enclosing a kept row are kept as well, as are the two top level rows.
+    Args:
+        rows (iterable): the dicomtree.Row objects to filter
+        tags (set): the tags to keep
+    Returns:
+        generator: the filtered dicomtree.Row objects
+    """
+    # Enclosing rows by depth, with a flag that tells whether they were written
+    ancestors = []
+    for row in rows:
+        del ancestors[row.depth:]
+        if row.path is None or any(tag in tags for tag in row.path[::2]):
+            for ancestor in ancestors:
+                if not ancestor[1]:
+                    ancestor[1] = True
+                    yield ancestor[0]
+            ancestors.append([row, True])
+            yield row
+        else:
+            ancestors.append([row, False])
+
+
+def open_output(filename):
+    """Opens a buffered text file to write a dump to.
+    Args:
+        filename (str): the path of the file
+    Returns:
+        file: the opened file
+    """
+    return open(filename, "w", encoding="utf-8", newline="", buffering=OUTPUT_BUFFER_SIZE)
+
+
+def dump(dataset, fp, fmt="text", defer=True, tags=None):
+    """Writes the dump of a dataset to a file, straight from the dataset.
+    Args:
+        dataset (pydicom.dataset.Dataset): the dataset
+        fp (file): the text file to write to
+        fmt (str): the output format: text, json or csv
+        defer (bool): whether to summarize large values instead of converting
+            them
+        tags (set): if given, only these tags are dumped (see filter_rows)
+    """
+    rows = walk(dataset, defer)
+    if tags:
+        rows = filter_rows(rows, tags)
+    WRITERS[fmt](rows, fp)
+
+
+def dump_file(filename, outfile, fmt="text", defer=True, tags=None):
+    """Reads a DICOM file and writes its dump to another file.
+    Args:
+        filename (str): the path of the DICOM file
+        outfile (str): the path of the output file
+        fmt (str): the output format: text, json or csv
+        defer (bool): whether to leave large values on disk
+        tags (set): if given, only these tags are dumped
+    """
+    dataset = read_dataset(filename, defer)
+    with open_output(outfile) as fp:
+        dump(dataset, fp, fmt, defer, tags)
+
+
+def find_files(paths):
+    """Lists the files to dump. Folders are searched recursively.
+    Args:
+        paths (list): paths of files and folders
+    Returns:
+        list: (path, relative path) tuples, where the relative path is relative
+        to the folder the file was found in; for files given directly, it is
+        relative to the common folder of those files
+    """
+    plain = [path for path in paths if not os.path.isdir(path)]
+    try:
+        common = os.path.commonpath([os.path.abspath(os.path.dirname(path)) for path in plain]) if plain else ""
+    except ValueError:
+        # Files on different drives
+        common = None
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            if common is None:
+                files.append((path, os.path.basename(path)))
+            else:
+                files.append((path, os.path.relpath(os.path.abspath(path), common)))
+            continue
+        for root, dirs, filenames in os.walk(path):
+            dirs.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(root, filename)
+                files.append((filepath, os.path.relpath(filepath, path)))
+    return files
+
+
+def _dump_job(job):
+    filename, outfile, fmt, defer, tags = job
+    try:
+        folder = os.path.dirname(outfile)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        dump_file(filename, outfile, fmt, defer, tags)
+    except Exception as e:
+        return "{0}: {1}".format(filename, e)
+    return None
+
+
+def dump_files(paths, outdir, fmt="text", defer=True, tags=None, jobs=None):
+    """Dumps all given files and all files in the given folders in parallel.
+    Every file gets its own dump file in the output folder, at the same
+    relative path as the file in its input folder.
+    Args:
+        paths (list): paths of files and folders
+        outdir (str): the output folder
+        fmt (str): the output format: text, json or csv
+        defer (bool): whether to leave large values on disk
+        tags (set): if given, only these tags are dumped
+        jobs (int): the number of worker processes, by default the number of
+            CPUs
+    Returns:
+        list: error messages for the files that could not be dumped, including
+        files whose dump would overwrite that of another file
+    """
+    work = []
+    errors = []
+    outfiles = {}
+    for filepath, relpath in find_files(paths):
+        outfile = os.path.join(outdir, relpath + FORMATS[fmt])
+        key = os.path.normcase(os.path.normpath(outfile))
+        if key in outfiles:
+            errors.append("{0}: same dump file {1} as {2}".format(filepath, outfile, outfiles[key]))
+            continue
+        outfiles[key] = filepath
+        work.append((filepath, outfile, fmt, defer, tags))
+    if jobs == 1:
+        results = map(_dump_job, work)
+        return errors + [r for r in results if r is not None]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(_dump_job, work, chunksize=16)
+        return errors + [r for r in results if r is not None]
+
+
+def dump_stream(paths, fp, fmt="text", defer=True, tags=None):
+    """Dumps all given files and all files in the given folders one after
+    another to a single stream. Each dump is preceded by a line with the file
+    path for text, CSV gets a File column, and JSON output is one array of
+    {"file": path, "rows": [...]} objects. Files that cannot be dumped are
+    skipped.
+    Args:
+        paths (list): paths of files and folders
+        fp (file): the text file to write to
+        fmt (str): the output format: text, json or csv
+        defer (bool): whether to leave large values on disk
+        tags (set): if given, only these tags are dumped
+    Returns:
+        list: error messages for the files that could not be dumped
+    """
+    errors = []
+    writer = csv.writer(fp) if fmt == "csv" else None
+    if fmt == "csv":
+        writer.writerow(["File", "Depth"] + COLUMNS)
+    elif fmt == "json":
+        fp.write("[")
+    separator = "\n"
+    for filepath, _ in find_files(paths):
+        # Each dump is completed in memory, so a failing file leaves no
+        # partial output
+        buffer = io.StringIO(newline="")
+        try:
+            rows = walk(read_dataset(filepath, defer), defer)
+            if tags:
+                rows = filter_rows(rows, tags)
+            if fmt == "csv":
+                rows_writer = csv.writer(buffer)
+                for row in rows:
+                    rows_writer.writerow([filepath, row.depth, row.kind] + row.columns)
+            elif fmt == "json":
+                buffer.write('{"file": ' + json.dumps(filepath) + ', "rows": ')
+                write_json(rows, buffer)
+                buffer.write("}")
+            else:
+                buffer.write("File\t" + filepath + "\n")
+                write_text(rows, buffer)
+        except Exception as e:
+            errors.append("{0}: {1}".format(filepath, e))
+            continue
+        if fmt == "json":
+            fp.write(separator)
+            separator = ",\n"
+        fp.write(buffer.getvalue())
+    if fmt == "json":
+        fp.write("\n]\n")
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dump DICOM files as text, JSON or CSV.")
+    parser.add_argument("paths", nargs="+", help="DICOM files or folders to dump")
+    parser.add_argument("-f", "--format", choices=sorted(FORMATS), default="text", help="output format")
+    parser.add_argument("-o", "--outdir", help="folder for the dump files; if omitted, dumps are written to stdout")
+    parser.add_argument("-t", "--tag", action="append", help="only dump this tag (keyword or gggg,eeee); can be repeated")
+    parser.add_argument("-j", "--jobs", type=int, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--no-defer", action="store_true", help="convert large values instead of summarizing them")
+    args = parser.parse_args(argv)
+    defer = not args.no_defer
+    tags = set(parse_tag(t) for t in args.tag) if args.tag else None
+
+    if args.outdir is None:
+        errors = dump_stream(args.paths, sys.stdout, args.format, defer, tags)
+    else:
+        errors = dump_files(args.paths, args.outdir, args.format, defer, tags, args.jobs)
+    for error in errors:
+        sys.stderr.write(error + "\n")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())